@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+import tweetdb.benchmark as tdbb
+import tweetdb.tweetdb as tdb
+import argparse
+import tempfile
+import shutil
+import json
+import sys
+import os
+
+
+def wire(args):
+    stream = tdbb.SyntheticStream(seed=args.seed)
+    return tdbb.bench_wire(stream.statuses(args.num_tweets),
+                           args.batch_size)
+
+
+def tokenize(args):
+    stream = tdbb.SyntheticStream(seed=args.seed)
+    return tdbb.bench_tokenize([stream.raw()['text']
+                                for i in range(args.num_tweets)])
+
+
+def ingest(args):
+    '''
+    with a parmfile its database and ingest settings are used (its tables
+    are dropped), otherwise a scratch SQLite database
+    '''
+    scratch = tempfile.mkdtemp()
+    if args.parmfile is not None:
+        parmdata = tdb.read_parmdata(args.parmfile)
+    else:
+        parmdata = {'files': {'log_file': None},
+                    'database': {'db_type': 'sqlite',
+                                 'db_host': os.path.join(scratch,
+                                                         'bench.db')},
+                    'settings': {'langs': ['ALL'],
+                                 'log_interval': 60,
+                                 'image_storage': {'method': 'file'},
+                                 'batch': {'size': args.batch_size,
+                                           'interval': 500},
+                                 'wire': {'batch_size': 50,
+                                          'interval': 500}}}
+    if args.fanin:
+        parmdata['settings']['sqlite'] = {}
+        parmdata['settings']['fanin'] = {}
+    # a benchmark mustn't wait on the network, or replay old spills
+    settings = parmdata['settings']
+    settings['get_images'] = False
+    settings['image_storage']['path'] = os.path.join(scratch, 'images')
+    for section in ('spill', 'routing', 'trending'):
+        settings.pop(section, None)
+
+    stream = tdbb.SyntheticStream(seed=args.seed)
+    try:
+        return tdbb.bench_ingest(parmdata, stream.statuses(args.num_tweets),
+                                 args.consumers, args.rate, args.timeout,
+                                 args.modes)
+    finally:
+        shutil.rmtree(scratch)
+
+
+def main():
+    # command line option parsing stuff
+    parser = argparse.ArgumentParser(description="Benchmark pieces of the "
+                                     "tweet ingest pipeline on a synthetic "
+                                     "stream.")
+    parser.add_argument("-n", "--num-tweets", type=int, default=10000,
+                        dest="num_tweets",
+                        help="number of synthetic tweets to use")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="random seed for the synthetic stream")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="write results as JSON to this file")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    wire_parser = subparsers.add_parser("wire", help="queue wire format: "
+                                        "bytes per tweet and pickle time")
+    wire_parser.add_argument("-b", "--batch-size", type=int, default=50,
+                             dest="batch_size",
+                             help="statuses per queue message")
+    wire_parser.set_defaults(func=wire)
+
+    tokenize_parser = subparsers.add_parser("tokenize", help="tweet text "
+                                            "tokenizing, tweets/second")
+    tokenize_parser.set_defaults(func=tokenize)
+
+    ingest_parser = subparsers.add_parser("ingest", help="end-to-end "
+                                          "ingest from a stand-in stream, "
+                                          "tweets/second and time per "
+                                          "stage")
+    ingest_parser.add_argument("-c", "--consumers", type=int, nargs='+',
+                               default=[1, 2, 4],
+                               help="numbers of consumers (writer threads "
+                               "in inproc mode) to run scenarios with")
+    ingest_parser.add_argument("-m", "--modes", type=str, nargs='+',
+                               default=['process'],
+                               choices=['process', 'inproc'],
+                               help="ingest modes to run scenarios in: "
+                               "producer and consumer processes, or "
+                               "threads of a single process")
+    ingest_parser.add_argument("-p", "--parmfile", type=str, default=None,
+                               help="YAML parameter file of a scratch "
+                               "database (its tables are dropped and "
+                               "recreated for each scenario) and ingest "
+                               "settings; a temporary SQLite database "
+                               "otherwise")
+    ingest_parser.add_argument("-b", "--batch-size", type=int, default=500,
+                               dest="batch_size",
+                               help="consumer batch size without a "
+                               "parmfile")
+    ingest_parser.add_argument("-f", "--fanin", action="store_true",
+                               help="without a parmfile, tune SQLite and "
+                               "fan the consumers in to a single writer")
+    ingest_parser.add_argument("-r", "--rate", type=float, default=None,
+                               help="stream at most this many tweets/second")
+    ingest_parser.add_argument("-t", "--timeout", type=float, default=600,
+                               help="give up on a scenario after this "
+                               "many seconds")
+    ingest_parser.set_defaults(func=ingest)
+
+    args = parser.parse_args()
+    results = {'benchmark': args.benchmark,
+               'num_tweets': args.num_tweets,
+               'seed': args.seed,
+               'results': args.func(args)}
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    sys.stdout.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
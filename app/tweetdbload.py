@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+import tweetdb.tweetdb as tdb
+import tweetdb.bulkload as tdbl
+import logging
+import argparse
+import sys
+import time
+
+
+def main():
+    # command line option parsing stuff
+    parser = argparse.ArgumentParser(description="Bulk load archived " +
+                                     "stream captures (JSON-lines, " +
+                                     "optionally gzipped).")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        dest="workers",
+                        help="number of loader processes (default: one "
+                        "per cpu)")
+    parser.add_argument("-b", "--batch-size", type=int, default=5000,
+                        dest="batch_size",
+                        help="tweets written per transaction")
+    parser.add_argument("-u", "--upgrade", default=False, action="store_true",
+                        dest="upgradeflag",
+                        help="add any tables, columns and indexes missing "
+                        "from an existing database first")
+    parser.add_argument("-v", "--verbose", default=False, action="store_true",
+                        dest="verbose",
+                        help="log to screen as well as logfile")
+
+    parser.add_argument("parmfile", type=str, help='YAML parameter file')
+    parser.add_argument("files", type=str, nargs='+',
+                        help='files of captured statuses, one per line')
+
+    args = parser.parse_args()
+
+    # parse YAML parmfile
+    parmdata = tdb.read_parmdata(args.parmfile)
+
+    # set up the logger
+    logFormatter = logging.Formatter("%(asctime)s [%(filename)-5.5s] "
+                                     "[%(levelname)-5.5s] [%(processName)-5s] "
+                                     "%(message)s")
+    rootLogger = logging.getLogger('__name__')
+    rootLogger.setLevel('INFO')
+
+    if parmdata['files']['log_file'] is not None:
+        fileHandler = logging.FileHandler(parmdata['files']['log_file'],
+                                          mode='a')
+        fileHandler.setFormatter(logFormatter)
+        rootLogger.addHandler(fileHandler)
+
+    if args.verbose:
+        consoleHandler = logging.StreamHandler(sys.stdout)
+        consoleHandler.setFormatter(logFormatter)
+        rootLogger.addHandler(consoleHandler)
+
+    rootLogger.info('Starting bulk load of %d files.' % len(args.files))
+    engine = tdb.get_sql_engine(parmdata)
+    if args.upgradeflag:
+        tdb.upgrade_tables(engine)
+    else:
+        tdb.create_tables(engine)
+
+    start = time.time()
+    results = tdbl.bulk_load(parmdata, args.files, args.workers,
+                             args.batch_size)
+    elapsed = time.time() - start
+    n_read = sum(stats['read'] for stats in results)
+    rootLogger.info('Done: %d tweets read, %d new, in %.1f seconds '
+                    '(%.0f tweets/second).' %
+                    (n_read, sum(stats['new'] for stats in results),
+                     elapsed, n_read / max(elapsed, 1e-6)))
+
+if __name__ == '__main__':
+    main()
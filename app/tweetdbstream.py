@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
 import tweetdb.tweetdb as tdb
+from tweetdb.inproc import InprocIngest
+from tweetdb.supervisor import ConsumerSupervisor
 import logging
 import argparse
 import sys
@@ -8,6 +10,21 @@ import time
 from multiprocessing import cpu_count, Queue
 
 
+def roll_partitions(engine, last_roll):
+    '''
+    The periodic roll of the partitions.  Returns when it last succeeded,
+    so that a failure (eg the database being locked by a writer) is
+    retried on the main loop's next tick rather than ending ingest.
+    '''
+    try:
+        tdb.roll_partitions(engine)
+    except Exception:
+        logging.getLogger('__name__').exception('Failed to roll partitions, '
+                                                'will retry.')
+        return last_roll
+    return time.time()
+
+
 def main():
     # command line option parsing stuff
     parser = argparse.ArgumentParser(description="Capture and store" +
@@ -24,6 +41,31 @@ def main():
                               action="store_true", dest="createflag",
                               default=False,
                               help="create a new set of tables")
+    parser.add_argument("-u", "--upgrade", default=False, action="store_true",
+                        dest="upgradeflag",
+                        help="add any tables, columns and indexes missing "
+                        "from an existing database")
+    parser.add_argument("--prune-images", default=False, action="store_true",
+                        dest="pruneflag",
+                        help="delete stored images no tweet refers to, "
+                        "then exit")
+    parser.add_argument("--rebuild-rollup", default=False,
+                        action="store_true", dest="rollupflag",
+                        help="recount the hashtag rollup from the stored "
+                        "tweets, then exit")
+    parser.add_argument("--backfill-cells", default=False,
+                        action="store_true", dest="cellflag",
+                        help="compute the grid cells of geotags stored "
+                        "without one, then exit")
+    parser.add_argument("--normalize-langs", default=False,
+                        action="store_true", dest="langflag",
+                        help="normalize the language codes of tweets "
+                        "stored before ingest did, then exit")
+    parser.add_argument("-i", "--inproc", default=False, action="store_true",
+                        dest="inprocflag",
+                        help="stream and write tweets with threads of a "
+                        "single process (plus a tokenizing pool) instead "
+                        "of producer and consumer processes")
     parser.add_argument("-v", "--verbose", default=False, action="store_true",
                         dest="verbose",
                         help="log to screen as well as logfile")
@@ -60,8 +102,6 @@ def main():
     auth = tdb.get_oauth(parmdata)
     rootLogger.info('Connecting to database.')
     engine = tdb.get_sql_engine(parmdata)
-    rootLogger.info('Setting up data queue.')
-    queue = Queue(100)
     
     # handle the drop/create table cases first
     if args.dropflag:
@@ -71,6 +111,28 @@ def main():
 
     if args.createflag:
         tdb.create_tables(engine)
+
+    if args.upgradeflag:
+        tdb.upgrade_tables(engine)
+
+    if args.pruneflag:
+        tdb.prune_images(tdb.get_sql_session(parmdata))
+        return
+
+    if args.rollupflag:
+        tdb.rebuild_hashtag_rollup(tdb.get_sql_session(parmdata))
+        return
+
+    if args.cellflag:
+        tdb.backfill_geotag_cells(tdb.get_sql_session(parmdata))
+        return
+
+    if args.langflag:
+        tdb.normalize_tweet_langs(tdb.get_sql_session(parmdata))
+        return
+
+    # with partitioning, create the coming periods and drop expired ones
+    tdb.roll_partitions(engine)
   
     # spin up the tweet handlers
     if parmdata['settings']['num_consumers'] > cpu_count():
@@ -86,37 +148,225 @@ def main():
                         'Twitter API limits you to 2.')
         parmdata['settings']['num_producers'] = 2
 
+    '''
+    SQLite allows one writer at a time, so either there's just the one
+    consumer, or with a fanin section the consumers hand their rows to a
+    single writer process
+    '''
+    fanindata = parmdata['settings'].get('fanin')
+    if parmdata['database']['db_type'].upper() != "SQLITE":
+        fanindata = None
     if parmdata['database']['db_type'].upper() == "SQLITE":
-        rootLogger.info('Requested %d threads '
-                        % parmdata['settings']['num_consumers'] +
-                        'but SQLite supports only 1.')
-        parmdata['settings']['num_consumers'] = 1
+        if fanindata is None:
+            rootLogger.info('Requested %d threads '
+                            % parmdata['settings']['num_consumers'] +
+                            'but SQLite supports only 1.')
+            parmdata['settings']['num_consumers'] = 1
         parmdata['settings']['num_producers'] = 1
 
-    consumers = []
-    for i in range(parmdata['settings']['num_consumers']):
-        consumers.append(tdb.tweet_consumer(queue, engine, parmdata,
-                                            name="consumer_%d" % i))
-        consumers[i].start()
+    '''
+    with an autoscale section a supervisor adds and retires consumers as
+    the load changes, which needs them all on the one queue
+    '''
+    autodata = parmdata['settings'].get('autoscale')
+    if autodata is not None and \
+       parmdata['settings'].get('routing') is not None:
+        rootLogger.info('Not autoscaling: with routing each consumer has '
+                        'a queue of its own.')
+        autodata = None
+    elif autodata is not None and fanindata is None and \
+            parmdata['database']['db_type'].upper() == "SQLITE":
+        rootLogger.info('Not autoscaling: SQLite supports only 1 consumer '
+                        'without fan-in.')
+        autodata = None
+
+    # count trending hashtags and words in memory for the web app
+    trenddata = parmdata['settings'].get('trending')
+    trend_queue = None
+    if trenddata is not None:
+        trend_queue = Queue(1000)
+        tdb.TrendServer(trend_queue, (trenddata.get('host', 'localhost'),
+                                      trenddata.get('port', 6010)),
+                        trenddata.get('authkey'),
+                        trenddata.get('capacity', 1000),
+                        trenddata.get('slice', 60),
+                        60 * trenddata.get('window', 60),
+                        parmdata['settings']['log_interval'],
+                        name="trends").start()
+
+    # collect the processes' metrics (for the supervisor, and to serve to
+    # Prometheus)
+    metricsdata = parmdata['settings'].get('metrics')
+    metrics_queue = None
+    if metricsdata is not None or autodata is not None:
+        metrics_queue = Queue(1000)
+        collector = tdb.MetricsCollector(metrics_queue)
+    if metricsdata is not None:
+        tdb.MetricsServer(collector, (metricsdata.get('host', 'localhost'),
+                                      metricsdata.get('port', 9108)))
+
+    # or run the whole pipeline as threads of this process
+    if args.inprocflag:
+        ingest = InprocIngest(parmdata, auth, trend_queue, metrics_queue)
+        ingest.start()
+        last_roll = time.time()
+        while True:
+            try:
+                time.sleep(1)
+                ingest.check_writers()
+                if time.time() - last_roll > 3600:
+                    last_roll = roll_partitions(engine, last_roll)
+            except KeyboardInterrupt:
+                rootLogger.info('Keyboard interrupt detected.  Depleting '
+                                'queue and preparing to shutdown.')
+                ingest.close()
+                return
+
+    '''
+    either all consumers share one queue, or with routing each consumer
+    gets its own and producers hash every tweet to one of them
+    '''
+    rootLogger.info('Setting up data queue.')
+    routedata = parmdata['settings'].get('routing')
+    spilldata = parmdata['settings'].get('spill')
+    if routedata is None:
+        queues = [Queue(100)]
+        partitions = [None]
+    else:
+        rootLogger.info('Routing tweets to consumers by %s.' %
+                        routedata.get('key', 'userid'))
+        queues = [Queue(100) for i in
+                  range(parmdata['settings']['num_consumers'])]
+        partitions = range(len(queues))
+
+    # let producers overflow to disk rather than blocking the stream
+    producer_queues = queues
+    if spilldata is not None:
+        producer_queues = []
+        for queue, partition in zip(queues, partitions):
+            path = tdb.spill_path(parmdata, partition)
+            tdb.recover_spill(path)
+            producer_queues.append(tdb.SpillQueue(queue, path,
+                                                  spilldata.get('segment_size',
+                                                                64) * 2 ** 20,
+                                                  spilldata.get('segment_age',
+                                                                10)))
+    if routedata is None:
+        producer_queue = producer_queues[0]
+    else:
+        producer_queue = tdb.PartitionedQueue(producer_queues,
+                                              routedata.get('key', 'userid'))
+
+    '''
+    in fan-in mode the writer posts new tweets to the trend server, and
+    acknowledges the consumers' batches on a queue per consumer slot.
+    There are slots for twice as many consumers as may run, as retiring
+    consumers keep theirs until they exit.
+    '''
+    row_queue = None
+    ack_queues = []
+    slots = {}
+    consumer_trend_queue = trend_queue
+    if fanindata is not None:
+        rootLogger.info('Fanning %d consumers in to a single writer.' %
+                        parmdata['settings']['num_consumers'])
+        row_queue = Queue(fanindata.get('queue_size', 100))
+        max_consumers = parmdata['settings']['num_consumers']
+        if autodata is not None:
+            max_consumers = max(max_consumers,
+                                autodata.get('max', cpu_count()))
+        ack_queues = [Queue() for i in range(2 * max_consumers)]
+        tdb.tweet_writer(row_queue, parmdata, name="writer",
+                         trend_queue=trend_queue,
+                         metrics_queue=metrics_queue,
+                         ack_queues=ack_queues).start()
+        consumer_trend_queue = None
+
+    def start_consumer(name, stop_event=None, queue=queues[0],
+                       partition=None):
+        slot = None
+        if ack_queues:
+            slot = [i for i in range(len(ack_queues))
+                    if i not in slots or not slots[i].is_alive()][0]
+        consumer = tdb.tweet_consumer(queue, engine, parmdata, name=name,
+                                      partition=partition,
+                                      trend_queue=consumer_trend_queue,
+                                      metrics_queue=metrics_queue,
+                                      row_queue=row_queue,
+                                      stop_event=stop_event,
+                                      ack_queue=ack_queues[slot]
+                                      if ack_queues else None,
+                                      slot=slot)
+        consumer.start()
+        if slot is not None:
+            slots[slot] = consumer
+        return consumer
+
+    supervisor = None
+    if autodata is not None:
+        supervisor = ConsumerSupervisor(start_consumer, queues[0], collector,
+                                        autodata.get('min', 1),
+                                        autodata.get('max', cpu_count()),
+                                        autodata.get('interval', 10),
+                                        autodata.get('high_depth', 50),
+                                        autodata.get('low_depth', 2),
+                                        autodata.get('max_commit_ms', 1000),
+                                        autodata.get('up_samples', 3),
+                                        autodata.get('down_samples', 6),
+                                        autodata.get('cooldown', 60))
+        supervisor.start(parmdata['settings']['num_consumers'])
+    else:
+        for i in range(parmdata['settings']['num_consumers']):
+            if routedata is None:
+                start_consumer("consumer_%d" % i)
+            else:
+                start_consumer("consumer_%d" % i, queue=queues[i],
+                               partition=partitions[i])
+
+    # replay anything left spilled from the last run before reconnecting
+    if spilldata is not None:
+        waiting = sum(tdb.pending_segments(tdb.spill_path(parmdata, p))
+                      for p in partitions)
+        while waiting > 0:
+            rootLogger.info('Replaying %d spilled segments before '
+                            'connecting to Twitter.' % waiting)
+            time.sleep(10)
+            waiting = sum(tdb.pending_segments(tdb.spill_path(parmdata, p))
+                          for p in partitions)
 
     # begin streaming to database
     producers = []
     for i in range(parmdata['settings']['num_producers']):
-        producers.append(tdb.tweet_producer(auth, queue, parmdata,
-                                            name="producer_%d" % i))
+        producers.append(tdb.tweet_producer(auth, producer_queue, parmdata,
+                                            name="producer_%d" % i,
+                                            metrics_queue=metrics_queue))
         producers[i].start()
   
     #    while queue.qsize() > 0:
+    last_report = time.time()
+    last_roll = time.time()
     while True:
         try:
             time.sleep(1)
+            if supervisor is not None:
+                supervisor.step()
+            if time.time() - last_roll > 3600:
+                last_roll = roll_partitions(engine, last_roll)
+            if routedata is not None and \
+               time.time() - last_report > parmdata['settings']['log_interval']:
+                # make any skew between the partitions visible
+                rootLogger.info('Queue depths by consumer: %s.' %
+                                ', '.join('%d' % queue.qsize()
+                                          for queue in queues))
+                last_report = time.time()
         except KeyboardInterrupt:
             rootLogger.info('Keyboard interrupt detected.  Depleting queue ' +
                             'and preparing to shutdown.')
             for producer in producers:
                 producer.close()
             
-            while queue.qsize() > 0:
+            while sum(queue.qsize() for queue in queues) > 0 or \
+                    (row_queue is not None and row_queue.qsize() > 0):
                 time.sleep(1)
             return
 
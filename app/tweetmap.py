@@ -19,7 +19,7 @@ mydb = tdba.DatabaseInterrogator('/data/config/stream.conf')
 @app.route('/')
 def index():
     minutes = 5
-    pprint.pprint(mydb.getPopularHashtags(tdba.getEarlierTime(minutes=minutes)))
+    pprint.pprint(mydb.getTrendingHashtags(minutes=minutes))
 
 
 if __name__ == "__main__":
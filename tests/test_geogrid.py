@@ -0,0 +1,140 @@
+from __future__ import division
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+import tweetdb.tweetdb as tdb
+from tweetdb.analysis import DatabaseInterrogator
+from tweetdb.benchmark import SyntheticStream
+from tweetdb.geogrid import cell_ranges, geo_cell, grid_xy
+from tweetdb.wire import encode, decode
+
+# (south, west, north, east), including ones crossing the antimeridian and
+# ones at the poles
+BOXES = [(-10, -20, 30, 45),
+         (40.5, -74.3, 41, -73.6),
+         (-20, 170, 20, -170),
+         (-60, 100, 60, -100),
+         (85, -180, 90, 180),
+         (-90, -180, -80, 180),
+         (80, 150, 90, -150)]
+
+
+def in_box(latitude, longitude, box):
+    south, west, north, east = box
+    if not south <= latitude <= north:
+        return False
+    if west > east:
+        return longitude >= west or longitude <= east
+    return west <= longitude <= east
+
+
+def box_points(rand, box, n):
+    # points inside box, its corners among them
+    south, west, north, east = box
+    if west > east:
+        east += 360
+    points = [(south, west), (south, east), (north, west), (north, east)]
+    points.extend((rand.uniform(south, north), rand.uniform(west, east))
+                  for i in range(n))
+    return [(latitude, longitude - 360 if longitude > 180 else longitude)
+            for latitude, longitude in points]
+
+
+def covering(ranges, latitude, longitude):
+    cell = geo_cell(latitude, longitude)
+    return any(low <= cell <= high for low, high in ranges)
+
+
+class CellRangesTest(unittest.TestCase):
+
+    def test_ranges_cover_box(self):
+        rand = random.Random(7)
+        for box in BOXES:
+            south, west, north, east = box
+            if west > east:
+                # split at the antimeridian, as getGeotagsInBox does
+                ranges = cell_ranges(south, west, north, 180) + \
+                    cell_ranges(south, -180, north, east)
+            else:
+                ranges = cell_ranges(*box)
+            for latitude, longitude in box_points(rand, box, 1000):
+                self.assertTrue(covering(ranges, latitude, longitude),
+                                '%s not covered for %s' %
+                                ((latitude, longitude), box))
+
+    def test_ranges_sorted_and_disjoint(self):
+        for box in BOXES:
+            if box[1] > box[3]:
+                continue
+            ranges = cell_ranges(*box)
+            for (low, high), (nextlow, nexthigh) in zip(ranges, ranges[1:]):
+                self.assertTrue(low <= high < nextlow - 1)
+
+
+class GeotagQueryTest(unittest.TestCase):
+    '''
+    The box and tile queries of DatabaseInterrogator against brute force
+    over the raw points, stored in SQLite
+    '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.parmdata = {
+            'files': {'log_file': None},
+            'database': {'db_type': 'sqlite',
+                         'db_host': os.path.join(self.tempdir, 'tweets.db')},
+            'settings': {'langs': ['ALL'], 'log_interval': 60,
+                         'get_images': False}}
+        tdb.create_tables(tdb.get_sql_engine(self.parmdata))
+        self.start = datetime.utcnow() - timedelta(hours=1)
+
+        rand = random.Random(11)
+        self.points = [(rand.uniform(-90, 90), rand.uniform(-180, 180))
+                       for i in range(1500)]
+        for box in BOXES:
+            self.points.extend(box_points(rand, box, 50))
+        stream = SyntheticStream(seed=11, dupe_rate=0)
+        statuses = [decode(encode(status))
+                    for status in stream.statuses(len(self.points))]
+        for status, (latitude, longitude) in zip(statuses, self.points):
+            status.lang = 'en'
+            status.geo = {'coordinates': [latitude, longitude]}
+        session = tdb.get_sql_session(self.parmdata)
+        self.assertEqual(tdb.add_tweets(statuses, session),
+                         (len(self.points), 0))
+        session.close()
+        self.db = DatabaseInterrogator(None, self.parmdata)
+
+    def tearDown(self):
+        self.db.session.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_box_matches_brute_force(self):
+        for box in BOXES:
+            south, west, north, east = box
+            found = sorted((latitude, longitude) for latitude, longitude,
+                           date in self.db.getGeotagsInBox(self.start, south,
+                                                           west, north, east))
+            expected = sorted(point for point in self.points
+                              if in_box(point[0], point[1], box))
+            self.assertTrue(expected)
+            self.assertEqual(found, expected, box)
+
+    def test_tiles_add_up(self):
+        for zoom in (0, 3, 8):
+            tiles = self.db.getGeotagTiles(self.start, zoom)
+            self.assertEqual(sum(count for x, y, count in tiles),
+                             len(self.points))
+            expected = {}
+            for latitude, longitude in self.points:
+                tile = grid_xy(latitude, longitude, zoom)
+                expected[tile] = expected.get(tile, 0) + 1
+            self.assertEqual(dict(((x, y), count)
+                                  for x, y, count in tiles), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
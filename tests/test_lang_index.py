@@ -0,0 +1,83 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import event
+import tweetdb.tweetdb as tdb
+from tweetdb.analysis import DatabaseInterrogator
+
+
+class LangIndexTest(unittest.TestCase):
+    '''
+    The window queries of DatabaseInterrogator have to reach their tweets
+    through ix_Tweet_lang_date_tweetid, which they only can if they
+    compare the stored (normalized) lang column directly
+    '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.parmdata = {
+            'files': {'log_file': None},
+            'database': {'db_type': 'sqlite',
+                         'db_host': os.path.join(self.tempdir, 'tweets.db')},
+            'settings': {'langs': ['ALL'], 'log_interval': 60,
+                         'get_images': False}}
+        self.engine = tdb.get_sql_engine(self.parmdata)
+        tdb.create_tables(self.engine)
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        self.db = DatabaseInterrogator(None, self.parmdata)
+        self.start = datetime.utcnow() - timedelta(hours=1)
+
+    def tearDown(self):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+        self.db.session.close()
+        shutil.rmtree(self.tempdir)
+
+    def record(self, connection, cursor, statement, parameters, context,
+               executemany):
+        self.statements.append((statement, parameters))
+
+    def check(self, query):
+        # run query, then check the plan of each Tweet query it made
+        self.statements = []
+        query()
+        statements = [(statement, parameters)
+                      for statement, parameters in self.statements
+                      if '"Tweet".lang' in statement]
+        self.assertTrue(statements)
+        for statement, parameters in statements:
+            self.assertTrue(re.search(r'"Tweet"\.lang = \?', statement),
+                            statement)
+            self.assertFalse(re.search(r'\w\(\s*"Tweet"\.lang', statement),
+                             statement)
+            self.assertTrue('en' in parameters)
+            plan = [row[3] for row in self.engine.execute(
+                'EXPLAIN QUERY PLAN ' + statement, parameters)]
+            self.assertTrue([line for line in plan if re.search(
+                r'INDEX ix_Tweet_lang_date_tweetid \(lang=\? AND date>\?',
+                line)], '%s\n%s' % (statement, '\n'.join(plan)))
+
+    def test_get(self):
+        self.check(lambda: self.db.getTweets(self.start, lang='EN'))
+        self.check(lambda: self.db.getGeotagLocations(self.start,
+                                                      lang='En'))
+
+    def test_page(self):
+        self.check(lambda: self.db.pageTweets(self.start))
+        self.check(lambda: self.db.pageTweets(self.start,
+                                              after=(self.start, 5)))
+        self.check(lambda: self.db.pageGeotagLocations(self.start))
+
+    def test_iter(self):
+        self.check(lambda: list(self.db.iterTweets(self.start)))
+        self.check(lambda: list(self.db.iterGeotagLocations(self.start)))
+
+    def test_tiles(self):
+        self.check(lambda: self.db.getGeotagTiles(self.start))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+import tweetdb.tweetdb as tdb
+from tweetdb.benchmark import SyntheticStream
+from tweetdb.partitions import SQLitePartitions
+from tweetdb.wire import encode, decode
+
+
+class SQLitePartitionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'tweets.db')
+        self.parmdata = {
+            'files': {'log_file': None},
+            'database': {'db_type': 'sqlite', 'db_host': self.path},
+            'settings': {'langs': ['ALL'], 'log_interval': 60,
+                         'get_images': False,
+                         'partitioning': {'period': 'day', 'ahead': 0,
+                                          'retention': 3}}}
+        self.engine = tdb.get_sql_engine(self.parmdata)
+        tdb.create_tables(self.engine)
+        self.partitioning = tdb.get_partitioning(self.engine)
+        self.today = self.partitioning.start(datetime.utcnow())
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def statuses(self, n, dates):
+        stream = SyntheticStream(seed=5, dupe_rate=0)
+        statuses = [decode(encode(status)) for status in stream.statuses(n)]
+        for i, status in enumerate(statuses):
+            status.created_at = dates[i % len(dates)] + timedelta(hours=1)
+        return statuses
+
+    def count(self, session, name, table='Tweet'):
+        return session.execute('SELECT count(*) FROM "%s"."%s"' %
+                               (name, table)).scalar()
+
+    def test_retention_has_to_fit(self):
+        self.assertRaises(ValueError, SQLitePartitions, tdb.Base.metadata,
+                          tdb.PARTITIONED_TABLES, self.path, period='day',
+                          ahead=2, retention=30)
+        self.assertRaises(ValueError, SQLitePartitions, tdb.Base.metadata,
+                          tdb.PARTITIONED_TABLES, self.path, period='day')
+        SQLitePartitions(tdb.Base.metadata, tdb.PARTITIONED_TABLES,
+                         self.path, period='week', ahead=2, retention=6)
+
+    def test_new_periods_reach_pooled_connections(self):
+        # a pooled connection from before tomorrow's file was created
+        engine = create_engine('sqlite:///' + self.path, poolclass=QueuePool,
+                               pool_size=1)
+        event.listen(engine, 'connect', self.partitioning.attach)
+        event.listen(engine, 'checkout', self.partitioning.checkout)
+        connection = engine.connect()
+        self.assertEqual(self.partitioning.attached(connection),
+                         set(['main', 'temp', 'default',
+                              self.partitioning.name(self.today)]))
+        connection.close()
+
+        tomorrow = self.partitioning.next(self.today)
+        tdb.roll_partitions(self.engine, tomorrow)
+        session = sessionmaker(bind=engine)()
+        self.assertEqual(tdb.add_tweets(self.statuses(100, [tomorrow]),
+                                        session), (100, 0))
+        self.assertEqual(self.count(session,
+                                    self.partitioning.name(tomorrow)), 100)
+        self.assertEqual(self.count(session, 'default'), 0)
+        session.close()
+        engine.dispose()
+
+    def test_ids_unique_across_periods(self):
+        yesterday = self.today - timedelta(days=1)
+        self.partitioning.ensure(self.engine, yesterday, self.today)
+        session = tdb.get_sql_session(self.parmdata)
+        tdb.add_tweets(self.statuses(300, [yesterday, self.today]), session)
+        for name in (self.partitioning.name(yesterday),
+                     self.partitioning.name(self.today)):
+            self.assertTrue(self.count(session, name, 'Mention') > 0)
+        for table, key in (('Hashtag', 'hashid'), ('Mention', 'mentionid'),
+                           ('URLData', 'urlid'), ('TweetWord', 'id')):
+            ids = [row[0] for row in session.execute(
+                'SELECT "%s" FROM "%s"' % (key, table))]
+            self.assertEqual(len(ids), len(set(ids)), table)
+        session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
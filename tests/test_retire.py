@@ -0,0 +1,97 @@
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Queue, Event
+from sqlalchemy import func
+import tweetdb.tweetdb as tdb
+from tweetdb.benchmark import SyntheticStream
+
+
+class RetireTest(unittest.TestCase):
+    '''
+    A consumer asked to stop has to write the statuses it has already
+    taken off the queue, and replay the rest of a spill segment it has
+    claimed, before exiting
+    '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.statuses = list(SyntheticStream(seed=2).statuses(400))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def parmdata(self, name, **settings):
+        parmdata = {
+            'files': {'log_file': None},
+            'database': {'db_type': 'sqlite',
+                         'db_host': os.path.join(self.tempdir,
+                                                 '%s.db' % name)},
+            'settings': {'langs': ['ALL'], 'log_interval': 60,
+                         'get_images': False,
+                         'image_storage': {'method': 'database'}}}
+        parmdata['settings'].update(settings)
+        tdb.create_tables(tdb.get_sql_engine(parmdata))
+        return parmdata
+
+    def count(self, parmdata):
+        session = tdb.get_sql_session(parmdata)
+        n = session.query(func.count(tdb.Tweet.tweetid)).scalar()
+        session.close()
+        return n
+
+    def test_pending(self):
+        for batch_size in (1, 20):
+            parmdata = self.parmdata('pending_%d' % batch_size,
+                                     batch={'size': batch_size,
+                                            'interval': 100})
+            queue = Queue(10)
+            listener = tdb.database_listener(None, queue, 60, 50, 100000,
+                                             ['ALL'])
+            for status in self.statuses[:50]:
+                listener.on_status(status)
+            stop_event = Event()
+            consumer = tdb.tweet_consumer(queue, None, parmdata,
+                                          stop_event=stop_event)
+            consumer.pending.extend(queue.get())
+            stop_event.set()
+            consumer.run()
+            self.assertEqual(len(consumer.pending), 0)
+            self.assertEqual(self.count(parmdata), 50)
+
+    def test_spill(self):
+        parmdata = self.parmdata('spill', batch={'size': 20, 'interval': 100},
+                                 spill={'path': os.path.join(self.tempdir,
+                                                             'spill')})
+        path = tdb.spill_path(parmdata)
+        queue = Queue(1)
+        for statuses in (self.statuses[:200], self.statuses[200:]):
+            spill_queue = tdb.SpillQueue(queue, path)
+            listener = tdb.database_listener(None, spill_queue, 60, 50,
+                                             100000, ['ALL'])
+            queue.put([])
+            for status in statuses:
+                listener.on_status(status)
+            listener.flush()
+            spill_queue.seal()
+            queue.get()
+        first, second = sorted(glob.glob(os.path.join(path, '*.seg')))
+
+        stop_event = Event()
+        consumer = tdb.tweet_consumer(queue, None, parmdata,
+                                      stop_event=stop_event)
+        consumer.spill.poll_interval = 0
+        consumer.pending.extend(consumer.spill.next_batch())
+        stop_event.set()
+        consumer.run()
+        # the first segment is written and deleted, the second not claimed
+        self.assertEqual(self.count(parmdata),
+                         len(set(status.id for status in
+                                 self.statuses[:200])))
+        self.assertEqual(glob.glob(os.path.join(path, '*.seg*')), [second])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+from __future__ import division
+import random
+import unittest
+from tweetdb.routing import partition
+
+
+def snowflake(rand, millis):
+    # timestamp, datacenter, worker, and a sequence number which is
+    # nearly always 0
+    sequence = rand.randint(0, 3) if rand.random() < 0.05 else 0
+    return (millis << 22) | (rand.randint(0, 31) << 17) | \
+        (rand.randint(0, 31) << 12) | sequence
+
+
+class PartitionTest(unittest.TestCase):
+
+    def spread(self, ids, n):
+        counts = [0] * n
+        for value in ids:
+            counts[partition(value, n)] += 1
+        return counts
+
+    def test_snowflake_tweetids(self):
+        rand = random.Random(3)
+        start = 1420070400000 - 1288834974657
+        ids = [snowflake(rand, start + 13 * i) for i in range(10000)]
+        for n in (2, 4, 8):
+            counts = self.spread(ids, n)
+            for count in counts:
+                self.assertTrue(abs(count - len(ids) / n) < 0.1 * len(ids) / n,
+                                'uneven spread over %d: %s' % (n, counts))
+
+    def test_sequential_userids(self):
+        for n in (2, 4, 8):
+            counts = self.spread(range(10 ** 6, 10 ** 6 + 8000), n)
+            self.assertTrue(max(counts) - min(counts) < 0.1 * 8000 / n)
+
+
+if __name__ == '__main__':
+    unittest.main()
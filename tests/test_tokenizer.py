@@ -0,0 +1,45 @@
+import unittest
+from tweetdb.tweetdb import tweet_words
+from tweetdb.words import TweetTokenizer
+from tweetdb.benchmark import GOLDEN_TEXTS, SyntheticStream
+
+
+class TokenizerTest(unittest.TestCase):
+    '''
+    TweetTokenizer has to split every text exactly as tweet_words does,
+    or the words stored would depend on which one was used
+    '''
+
+    def setUp(self):
+        self.tokenizer = TweetTokenizer()
+        stream = SyntheticStream(seed=1)
+        self.texts = GOLDEN_TEXTS + [stream.raw()['text']
+                                     for i in range(2000)]
+
+    def test_golden_texts(self):
+        for text in GOLDEN_TEXTS:
+            self.assertEqual(self.tokenizer.tokenize(text), tweet_words(text),
+                             'tokenizer differs on %r' % text)
+
+    def test_synthetic_texts(self):
+        for text in self.texts:
+            self.assertEqual(self.tokenizer.tokenize(text), tweet_words(text),
+                             'tokenizer differs on %r' % text)
+
+    def test_unique(self):
+        self.assertEqual(self.tokenizer.tokenize(u'words Words other words',
+                                                 unique=True),
+                         [u'words', u'other'])
+        for text in self.texts:
+            words = tweet_words(text)
+            self.assertEqual(self.tokenizer.tokenize(text, unique=True),
+                             sorted(set(words), key=words.index))
+
+    def test_batch(self):
+        self.assertEqual(self.tokenizer.tokenize_batch(self.texts),
+                         [self.tokenizer.tokenize(text, unique=True)
+                          for text in self.texts])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+from __future__ import division
+import os
+import time
+import random
+import socket
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from multiprocessing import Queue
+import tweetdb.tweetdb as tdb
+from tweetdb.analysis import DatabaseInterrogator
+from tweetdb.benchmark import SyntheticStream
+from tweetdb.trending import SpaceSaving, TrendFeed, TrendServer, \
+    query_trends
+from tweetdb.wire import encode, decode
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+    def test_bounds(self):
+        rand = random.Random(1)
+        summary = SpaceSaving(100)
+        true = {}
+        for i in range(50000):
+            item = min(int(rand.paretovariate(1.0)), 100000)
+            summary.add(item)
+            true[item] = true.get(item, 0) + 1
+        self.assertTrue(len(summary.buckets) <= 100)
+        for item, count, error in summary.items():
+            self.assertTrue(count - error <= true[item] <= count)
+        # anything seen more than n/capacity times is counted
+        for item, n in true.items():
+            if n > 50000 / 100:
+                self.assertTrue(item in summary.buckets)
+
+
+class TrendServerAuthTest(unittest.TestCase):
+
+    def test_needs_authkey(self):
+        for authkey in (None, ''):
+            self.assertRaises(ValueError, TrendServer, Queue(1),
+                              ('localhost', free_port()), authkey)
+            self.assertRaises(ValueError, query_trends,
+                              ('localhost', free_port()), authkey, 'hashtag',
+                              'en', 60)
+
+
+class TrendingHashtagsTest(unittest.TestCase):
+    '''
+    The trend server's answers against the exact counts of HashtagRollup
+    for a skewed stream loaded into SQLite
+    '''
+
+    capacity = 10
+    k = 10
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        port = free_port()
+        self.parmdata = {
+            'files': {'log_file': None},
+            'database': {'db_type': 'sqlite',
+                         'db_host': os.path.join(self.tempdir, 'tweets.db')},
+            'settings': {'langs': ['ALL'], 'log_interval': 60,
+                         'get_images': False,
+                         'trending': {'port': port, 'authkey': 'secret'}}}
+        tdb.create_tables(tdb.get_sql_engine(self.parmdata))
+        self.queue = Queue(1000)
+        self.server = TrendServer(self.queue, ('localhost', port), 'secret',
+                                  capacity=self.capacity, slice_length=60,
+                                  window=3600)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.join()
+        shutil.rmtree(self.tempdir)
+
+    def load(self, n_tweets):
+        # Zipf distributed hashtags, spread over the last five minutes
+        stream = SyntheticStream(seed=3, n_hashtags=500)
+        statuses = [decode(encode(status))
+                    for status in stream.statuses(n_tweets)]
+        now = datetime.utcnow()
+        for i, status in enumerate(statuses):
+            status.created_at = now - timedelta(seconds=i * 300 / n_tweets)
+        session = tdb.get_sql_session(self.parmdata)
+        feed = TrendFeed(self.queue)
+        for i in range(0, n_tweets, 500):
+            tdb.add_tweets(statuses[i:i + 500], session, trends=feed)
+            feed.flush()
+        session.close()
+        # the server reads its queue every second
+        while not self.queue.empty():
+            time.sleep(0.1)
+        time.sleep(2)
+
+    def test_top_hashtags(self):
+        self.load(6000)
+        db = DatabaseInterrogator(None, self.parmdata)
+        start = datetime.utcnow() - timedelta(minutes=10)
+        exact = db.getPopularHashtags(start, lang='en')
+        true = dict(exact)
+        trending = db.getTrendingHashtags(minutes=10, lang='en',
+                                          limit=self.k)
+        self.assertEqual(len(trending), self.k)
+
+        # the counts the server gives bound the true counts
+        for tag, count, error in trending:
+            self.assertTrue(count - error <= true.get(tag, 0) <= count,
+                            '%s: %d (%d) vs %d' % (tag, count, error,
+                                                   true.get(tag, 0)))
+
+        '''
+        counts are overestimates, so one of the exact top k can only be
+        left out for k items estimated at least as frequent
+        '''
+        trending_tags = set(tag for tag, count, error in trending)
+        lowest = trending[-1][1]
+        for tag, total in exact[:self.k]:
+            self.assertTrue(tag in trending_tags or total <= lowest,
+                            '%s (%d) missing from %r' % (tag, total,
+                                                         trending))
+        # the clear leaders are there in order
+        self.assertEqual([tag for tag, count, error in trending[:3]],
+                         [tag for tag, total in exact[:3]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,8 +8,14 @@ URL = "https://github.com/starkshift/tweetdb"
 LICENSE = "MIT"
 
 import tweetdb as tdb
-from tweetdb import User, Tweet, Hashtag, Geotag, Mention, URLData, Media
+from trending import query_trends
+from snapshot import Snapshot, export_snapshot
+from geogrid import MAX_ZOOM, cell_ranges, deinterleave
+from tweetdb import User, Tweet, Hashtag, Geotag, Mention, URLData, Media, \
+    HashtagLexicon, HashtagRollup
 import sqlalchemy as sa
+import numpy as np
+from itertools import islice
 from datetime import datetime as dt
 from datetime import timedelta
 
@@ -18,6 +24,88 @@ def getEarlierTime(hours=0, minutes=0, seconds=0):
     return dt.utcnow() - timedelta(hours=hours, minutes=minutes,
                                    seconds=seconds)
 
+
+'''
+columns returned by the iter/page methods, which always start with the
+(date, tweetid) key rows are ordered and paged by
+'''
+TWEET_COLUMNS = (Tweet.date, Tweet.tweetid, Tweet.userid, Tweet.lang,
+                 Tweet.text, Tweet.rtcount, Tweet.fvcount, Tweet.source)
+GEOTAG_COLUMNS = (Tweet.date, Tweet.tweetid, Geotag.latitude,
+                  Geotag.longitude)
+
+
+'''
+Helpers for snapshots written by DatabaseInterrogator.exportSnapshot
+(see tweetdb.snapshot).  They work on the memory mapped columns directly,
+so no tweets are turned into python objects.
+'''
+
+
+def loadSnapshot(path):
+    return Snapshot(path)
+
+
+def snapshotTweets(snapshot, lang=None):
+    # boolean mask of a language's rows in the tweet_ columns, or None
+    if lang is None:
+        return None
+    return snapshot['tweet_lang'] == \
+        snapshot.strings['lang'].code(tdb.normalize_lang(lang))
+
+
+def countByLang(snapshot):
+    # (lang, count) pairs, most common first
+    counts = np.bincount(snapshot['tweet_lang'],
+                         minlength=len(snapshot.strings['lang']))
+    return [(snapshot.strings['lang'][code], int(counts[code]))
+            for code in np.argsort(-counts, kind='mergesort')]
+
+
+def countHashtags(snapshot, lang=None, limit=None):
+    # (hashtag, count) pairs, most common first
+    tags = snapshot['hashtag_tag']
+    mask = snapshotTweets(snapshot, lang)
+    if mask is not None:
+        tags = tags[mask[snapshot['hashtag_tweet']]]
+    counts = np.bincount(tags, minlength=len(snapshot.strings['hashtag']))
+    codes = np.argsort(-counts, kind='mergesort')[:np.count_nonzero(counts)]
+    return [(snapshot.strings['hashtag'][code], int(counts[code]))
+            for code in codes[:limit]]
+
+
+def timeHistogram(snapshot, bin_seconds=60, lang=None):
+    '''
+    Tweets per bin_seconds, as arrays of bin start times (datetime64) and
+    counts
+    '''
+    dates = snapshot['tweet_date']
+    mask = snapshotTweets(snapshot, lang)
+    if mask is not None:
+        dates = dates[mask]
+    if not len(dates):
+        return np.array([], dtype='datetime64[s]'), np.array([], dtype=int)
+    first = dates[0] // bin_seconds * bin_seconds
+    counts = np.bincount((dates - first) // bin_seconds)
+    starts = first + bin_seconds * np.arange(len(counts))
+    return starts.astype('datetime64[s]'), counts
+
+
+def geotagHistogram(snapshot, bins=(180, 360), lang=None):
+    '''
+    Geotags binned over the whole globe, as (counts, latitude edges,
+    longitude edges) from numpy.histogram2d
+    '''
+    latitude = snapshot['geotag_latitude']
+    longitude = snapshot['geotag_longitude']
+    mask = snapshotTweets(snapshot, lang)
+    if mask is not None:
+        rows = mask[snapshot['geotag_tweet']]
+        latitude, longitude = latitude[rows], longitude[rows]
+    return np.histogram2d(latitude, longitude, bins=bins,
+                          range=[[-90, 90], [-180, 180]])
+
+
 class DatabaseInterrogator(object):
     def getTweets(self, start, stop=None, lang='en', limit=None):
         if stop is None:
@@ -26,7 +114,7 @@ class DatabaseInterrogator(object):
         thisQuery = self.session.query(Tweet).\
                     filter(Tweet.date >= start).\
                     filter(Tweet.date <= stop).\
-                    filter(sa.func.upper(Tweet.lang) == lang.upper())
+                    filter(Tweet.lang == tdb.normalize_lang(lang))
 
         if limit is not None:
             return thisQuery.limit(limit).all()
@@ -41,33 +129,173 @@ class DatabaseInterrogator(object):
                     filter(Tweet.date >= start).\
                     filter(Tweet.date <= stop).\
                     filter(Geotag.tweetid == Tweet.tweetid).\
-                    filter(sa.func.upper(Tweet.lang) == lang.upper())
+                    filter(Tweet.lang == tdb.normalize_lang(lang))
 
         if limit is not None:
             return thisQuery.limit(limit).all()
         else:
             return thisQuery.all()
 
-    def getPopularHashtags(self, start, stop=None, lang='en', limit=None):
+    def iterTweets(self, start, stop=None, lang='en', chunk_size=1000,
+                   after=None):
+        '''
+        Yield the tweets of a window as lists of up to chunk_size
+        TWEET_COLUMNS rows, in (date, tweetid) order, streamed from a
+        server-side cursor so memory stays flat however big the window
+        '''
+        return self.iterChunks(self.windowQuery(TWEET_COLUMNS, start, stop,
+                                                lang, after), chunk_size)
+
+    def pageTweets(self, start, stop=None, lang='en', limit=1000,
+                   after=None):
+        '''
+        One page of up to limit TWEET_COLUMNS rows.  For the next page pass
+        after=page[-1][:2], the (date, tweetid) of the last row.
+        '''
+        return self.windowQuery(TWEET_COLUMNS, start, stop, lang,
+                                after).limit(limit).all()
+
+    def iterGeotagLocations(self, start, stop=None, lang='en',
+                            chunk_size=1000, after=None):
+        # as iterTweets, for GEOTAG_COLUMNS rows
+        return self.iterChunks(self.windowQuery(GEOTAG_COLUMNS, start, stop,
+                                                lang, after).
+                               filter(Geotag.tweetid == Tweet.tweetid),
+                               chunk_size)
+
+    def pageGeotagLocations(self, start, stop=None, lang='en', limit=1000,
+                            after=None):
+        # as pageTweets, for GEOTAG_COLUMNS rows
+        return self.windowQuery(GEOTAG_COLUMNS, start, stop, lang, after).\
+            filter(Geotag.tweetid == Tweet.tweetid).limit(limit).all()
+
+    def windowQuery(self, columns, start, stop, lang, after):
+        # columns of the tweets in a window, after the key (date, tweetid)
+        if stop is None:
+            stop = dt.utcnow()
+
+        thisQuery = self.session.query(*columns).\
+            filter(Tweet.date >= start).\
+            filter(Tweet.date <= stop).\
+            filter(Tweet.lang == tdb.normalize_lang(lang))
+
+        if after is not None:
+            date, tweetid = after
+            thisQuery = thisQuery.filter(sa.or_(Tweet.date > date,
+                                                sa.and_(Tweet.date == date,
+                                                        Tweet.tweetid >
+                                                        tweetid)))
+        return thisQuery.order_by(Tweet.date, Tweet.tweetid)
+
+    def iterChunks(self, thisQuery, chunk_size):
+        rows = iter(thisQuery.yield_per(chunk_size))
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def getGeotagsInBox(self, start, south, west, north, east, stop=None,
+                        lang='en', limit=None):
+        '''
+        Geotag locations inside a bounding box, found through the indexed
+        grid cell ranges covering the box.  A box with west > east crosses
+        the antimeridian, and is searched as the two boxes either side.
+        '''
+        if stop is None:
+            stop = dt.utcnow()
+
+        if west > east:
+            boxes = [(west, 180), (-180, east)]
+        else:
+            boxes = [(west, east)]
+        inBoxes = sa.or_(*[sa.and_(sa.or_(*[Geotag.cell.between(low, high)
+                                            for low, high in
+                                            cell_ranges(south, boxwest,
+                                                        north, boxeast)]),
+                                   Geotag.longitude.between(boxwest,
+                                                            boxeast))
+                           for boxwest, boxeast in boxes])
+        thisQuery = self.session.query(Geotag.latitude, Geotag.longitude,
+                                       Tweet.date).\
+            filter(inBoxes).\
+            filter(Geotag.latitude.between(south, north)).\
+            filter(Geotag.tweetid == Tweet.tweetid).\
+            filter(Tweet.date >= start).\
+            filter(Tweet.date <= stop).\
+            filter(Tweet.lang == tdb.normalize_lang(lang))
+
+        if limit is not None:
+            return thisQuery.limit(limit).all()
+        else:
+            return thisQuery.all()
+
+    def getGeotagTiles(self, start, zoom=8, stop=None, lang='en'):
+        '''
+        Geotag counts per grid tile at a zoom level (2**zoom by 2**zoom
+        tiles over the globe, see tweetdb.geogrid) as (x, y, count); use
+        geogrid.tile_bounds for the tiles' coordinates
+        '''
         if stop is None:
             stop = dt.utcnow()
 
-        thisQuery = self.session.query(Hashtag.tag,
-                                       sa.func.count(Hashtag.tag).\
-                                       label('total')).\
-            group_by(Hashtag.tag).join(Tweet).\
-            filter(Hashtag.tweetid == Tweet.tweetid).\
-            filter(sa.func.upper(Tweet.lang) == lang.upper()).\
+        tile = (Geotag.cell / 4 ** (MAX_ZOOM - zoom)).label('tile')
+        thisQuery = self.session.query(tile, sa.func.count()).\
+            filter(Geotag.cell.isnot(None)).\
+            filter(Geotag.tweetid == Tweet.tweetid).\
             filter(Tweet.date >= start).\
             filter(Tweet.date <= stop).\
-            order_by('total desc')
+            filter(Tweet.lang == tdb.normalize_lang(lang)).\
+            group_by(tile)
+
+        return [deinterleave(int(code)) + (count,)
+                for code, count in thisQuery]
+
+    def getPopularHashtags(self, start, stop=None, lang='en', limit=None):
+        '''
+        Hashtag counts summed over the minute buckets of HashtagRollup, so
+        start is effectively rounded down to the minute
+        '''
+        if stop is None:
+            stop = dt.utcnow()
+
+        total = sa.func.sum(HashtagRollup.count).label('total')
+        thisQuery = self.session.query(HashtagLexicon.hashtagtext, total).\
+            filter(HashtagRollup.hashtagid == HashtagLexicon.hashtagid).\
+            filter(HashtagRollup.lang == tdb.normalize_lang(lang)).\
+            filter(HashtagRollup.bucket >= tdb.minute_bucket(start)).\
+            filter(HashtagRollup.bucket <= stop).\
+            group_by(HashtagLexicon.hashtagtext).\
+            order_by(total.desc())
 
         if limit is not None:
             return thisQuery.limit(limit).all()
         else:
             return thisQuery.all()
 
+    def getTrendingHashtags(self, minutes=5, lang='en', limit=10):
+        # (hashtag, count, error) from the trend server, no database query
+        return self.getTrending('hashtag', minutes, lang, limit)
+
+    def getTrendingWords(self, minutes=5, lang='en', limit=10):
+        return self.getTrending('word', minutes, lang, limit)
+
+    def getTrending(self, kind, minutes, lang, limit):
+        trenddata = self.parmdata['settings']['trending']
+        return query_trends((trenddata.get('host', 'localhost'),
+                             trenddata.get('port', 6010)),
+                            trenddata.get('authkey'), kind,
+                            tdb.normalize_lang(lang), 60 * minutes, limit)
+
+    def exportSnapshot(self, path, start, stop=None, lang=None,
+                       chunk_size=100000):
+        # write a window to a columnar snapshot, see loadSnapshot
+        return export_snapshot(self.session, path, start, stop, lang,
+                               chunk_size)
+
     def refresh_session(self):
+        # hand the old session's connection back to the (shared) pool
+        self.session.close()
         self.session = tdb.get_sql_session(self.parmdata)
 
     def __init__(self, parmfile, parmdata=None):
@@ -0,0 +1,419 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Synthetic tweet streams and benchmarks for the ingest pipeline."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+import os
+import time
+import random
+import resource
+import cPickle
+import threading
+import tweepy
+from datetime import datetime as dt
+from multiprocessing import Queue, active_children
+from tweepy.models import Status
+from sqlalchemy import select, func
+from wire import encode, decode
+from words import TweetTokenizer
+from metrics import metrics, MetricsCollector
+from tweetdb import tweet_words, tweet_consumer, tweet_writer, \
+    database_listener, get_sql_engine, create_tables, Base, Tweet
+from inproc import InprocIngest
+
+LANGS = [('en', 0.35), ('ja', 0.15), ('es', 0.1), ('ar', 0.08),
+         ('pt', 0.07), ('und', 0.07), ('ko', 0.05), ('fr', 0.04),
+         ('tr', 0.04), ('in', 0.05)]
+
+SOURCES = ['<a href="http://twitter.com/download/iphone" '
+           'rel="nofollow">Twitter for iPhone</a>',
+           '<a href="http://twitter.com/download/android" '
+           'rel="nofollow">Twitter for Android</a>',
+           '<a href="http://twitter.com" rel="nofollow">Twitter Web Client</a>']
+
+
+# awkward cases for the tokenizer, checked along with the synthetic texts
+GOLDEN_TEXTS = [u'',
+                u'   ',
+                u'Hello World',
+                u'"Quoted text," she said!',
+                u'RT @someone: check http://t.co/abc and www.example.com now',
+                u'a@b.com mail me@ home@',
+                u'trailing www. and http:// markers',
+                u'#hashtag ##double #a#b x#y #',
+                u'ab abc ABCD a1 a12 1abc abc1',
+                u'word... ?word? !!word!! ;word: \'word\'',
+                u'mid.dle pun,ct u-s_e',
+                u'tabs\tand\nnew\r\nlines\x0bvt\x0cff',
+                u'non\xa0breaking\u3000ideographic\x1cseparators\x85nel',
+                u'caf\xe9 na\xefve \u0130stanbul \u65e5\u672c\u8a9e',
+                u'http://example.com/@user @user/http://x',
+                u'duplicate duplicate words words words',
+                'byte string with \xc2\xa0 utf-8 bytes']
+
+
+class SyntheticStream(object):
+    '''
+    Generates tweepy-shaped statuses with roughly sample-stream-like
+    shape: a heavy-tailed mix of repeat authors, Zipf distributed words
+    and hashtags, mentions, urls, (frequently re-tweeted) media, a few
+    geotags and the occasional duplicate tweetid.  Seeded, so the same
+    arguments always produce the same stream.
+    '''
+
+    def __init__(self, seed=0, n_users=10000, n_words=20000,
+                 n_hashtags=2000, n_images=500, media_rate=0.1,
+                 geo_rate=0.02, dupe_rate=0.01):
+        self.random = random.Random(seed)
+        self.api = tweepy.API()
+        self.n_users = n_users
+        self.words = ['w%x' % i for i in range(n_words)]
+        self.hashtags = ['tag%x' % i for i in range(n_hashtags)]
+        self.n_images = n_images
+        self.media_rate = media_rate
+        self.geo_rate = geo_rate
+        self.dupe_rate = dupe_rate
+        self.next_id = 10 ** 17
+        self.seen = []
+
+    def zipf(self, n):
+        # heavy-tailed index into a list of n items
+        return min(int(self.random.paretovariate(1.1)) - 1, n - 1)
+
+    def lang(self):
+        x = self.random.random()
+        for lang, p in LANGS:
+            x -= p
+            if x < 0:
+                return lang
+        return LANGS[-1][0]
+
+    def user(self):
+        userid = self.zipf(self.n_users) + 1
+        return {'id': userid,
+                'id_str': str(userid),
+                'screen_name': 'user%d' % userid,
+                'name': 'User %d' % userid,
+                'location': None if userid % 3 else 'Somewhere',
+                'description': 'Account number %d' % userid,
+                'followers_count': 10 * userid,
+                'friends_count': userid,
+                'statuses_count': self.next_id % 100000,
+                'created_at': 'Wed Oct 10 20:19:24 +0000 2012',
+                'time_zone': None,
+                'geo_enabled': bool(userid % 2),
+                'verified': userid < 10,
+                'lang': 'en'}
+
+    def raw(self):
+        # the raw json of one status
+        if self.seen and self.random.random() < self.dupe_rate:
+            tweetid = self.random.choice(self.seen)
+        else:
+            self.next_id += self.random.randint(1, 1000)
+            tweetid = self.next_id
+            self.seen.append(tweetid)
+            if len(self.seen) > 10000:
+                self.seen = self.seen[-5000:]
+
+        words = [self.words[self.zipf(len(self.words))]
+                 for i in range(self.random.randint(3, 20))]
+        tags = [self.hashtags[self.zipf(len(self.hashtags))]
+                for i in range(min(int(self.random.expovariate(2.0)), 5))]
+        mentions = [self.zipf(self.n_users) + 1
+                    for i in range(min(int(self.random.expovariate(1.5)),
+                                       4))]
+        urls = ['http://example.com/%d' % self.random.randint(0, 10 ** 6)
+                for i in range(int(self.random.random() < 0.2))]
+        text = ' '.join(['@user%d' % m for m in mentions] + words +
+                        ['#' + tag for tag in tags] +
+                        ['https://t.co/%x' % hash(url) for url in urls])
+        entities = {'hashtags': [{'text': tag, 'indices': [0, 0]}
+                                 for tag in tags],
+                    'user_mentions': [{'id': m, 'id_str': str(m),
+                                       'screen_name': 'user%d' % m,
+                                       'name': 'User %d' % m,
+                                       'indices': [0, 0]}
+                                      for m in mentions],
+                    'urls': [{'url': 'https://t.co/%x' % hash(url),
+                              'expanded_url': url,
+                              'display_url': url[7:],
+                              'indices': [0, 0]} for url in urls],
+                    'symbols': []}
+        if self.random.random() < self.media_rate:
+            image = self.zipf(self.n_images)
+            entities['media'] = [{'id': image,
+                                  'type': 'photo',
+                                  'media_url_https':
+                                  'https://pbs.twimg.com/media/img%d.jpg' %
+                                  image}]
+        geo = None
+        if self.random.random() < self.geo_rate:
+            geo = {'type': 'Point',
+                   'coordinates': [self.random.uniform(-60, 70),
+                                   self.random.uniform(-180, 180)]}
+        return {'id': tweetid,
+                'id_str': str(tweetid),
+                'text': text,
+                'lang': self.lang(),
+                'created_at': dt.utcnow().
+                strftime('%a %b %d %H:%M:%S +0000 %Y'),
+                'source': self.random.choice(SOURCES),
+                'retweet_count': self.zipf(1000),
+                'favorite_count': self.zipf(1000),
+                'geo': geo,
+                'coordinates': None,
+                'place': None,
+                'in_reply_to_status_id': None,
+                'truncated': False,
+                'entities': entities,
+                'user': self.user()}
+
+    def statuses(self, n):
+        for i in range(n):
+            yield Status.parse(self.api, self.raw())
+
+
+def bench_wire(statuses, batch_size=50):
+    '''
+    Compare putting whole Status objects on the queue (one pickle per
+    tweet) with sending batches of encoded statuses.  Reports bytes per
+    tweet and the pickle/unpickle time per tweet in microseconds.
+    '''
+    statuses = list(statuses)
+    n = len(statuses)
+    results = {}
+
+    start = time.time()
+    pickles = [cPickle.dumps(status, cPickle.HIGHEST_PROTOCOL)
+               for status in statuses]
+    dumped = time.time()
+    for data in pickles:
+        cPickle.loads(data)
+    loaded = time.time()
+    results['status'] = {'bytes_per_tweet': sum(map(len, pickles)) / n,
+                         'pickle_us': 1e6 * (dumped - start) / n,
+                         'unpickle_us': 1e6 * (loaded - dumped) / n}
+
+    start = time.time()
+    pickles = [cPickle.dumps([encode(status) for status in
+                              statuses[i:i + batch_size]],
+                             cPickle.HIGHEST_PROTOCOL)
+               for i in range(0, n, batch_size)]
+    dumped = time.time()
+    for data in pickles:
+        [decode(record) for record in cPickle.loads(data)]
+    loaded = time.time()
+    results['wire'] = {'bytes_per_tweet': sum(map(len, pickles)) / n,
+                       'pickle_us': 1e6 * (dumped - start) / n,
+                       'unpickle_us': 1e6 * (loaded - dumped) / n}
+    return results
+
+
+def bench_tokenize(texts, batch_size=500):
+    '''
+    Tokenizing throughput of tweet_words against TweetTokenizer (one text
+    at a time, and in batches).  Raises AssertionError if the tokenizer
+    ever disagrees with tweet_words.
+    '''
+    texts = GOLDEN_TEXTS + list(texts)
+    tokenizer = TweetTokenizer()
+    mismatches = [text for text in texts
+                  if tweet_words(text) != tokenizer.tokenize(text)]
+    assert not mismatches, 'tokenizer differs on %r' % mismatches[:5]
+
+    results = {}
+    start = time.time()
+    for text in texts:
+        tweet_words(text)
+    results['tweet_words'] = len(texts) / (time.time() - start)
+
+    start = time.time()
+    for text in texts:
+        tokenizer.tokenize(text)
+    results['tokenize'] = len(texts) / (time.time() - start)
+
+    start = time.time()
+    for i in range(0, len(texts), batch_size):
+        tokenizer.tokenize_batch(texts[i:i + batch_size])
+    results['tokenize_batch'] = len(texts) / (time.time() - start)
+    return {'tweets_per_second': results, 'golden_texts': len(texts)}
+
+
+class FakeStream(object):
+    '''
+    In-process stand-in for tweepy.streaming.Stream: sample() feeds a
+    listener a fixed list of statuses (at no more than rate a second, if
+    given) and then disconnects, as the stream would
+    '''
+
+    def __init__(self, listener, statuses, rate=None):
+        self.listener = listener
+        self.statuses = statuses
+        self.rate = rate
+        self.running = False
+
+    def sample(self):
+        self.running = True
+        start = time.time()
+        for idx, status in enumerate(self.statuses):
+            if not self.running:
+                break
+            if self.rate is not None:
+                delay = start + idx / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.listener.on_status(status)
+        self.running = False
+        self.listener.on_disconnect('end of benchmark stream')
+
+    def disconnect(self):
+        self.running = False
+
+
+def bench_ingest(parmdata, statuses, consumers=(1, 2, 4), rate=None,
+                 timeout=600, modes=('process',)):
+    '''
+    End-to-end ingest: a FakeStream feeds the statuses to a
+    database_listener, which queues them (in the wire format, batched as
+    the parmfile's wire section says) for tweet_consumers to write to the
+    parmfile's database, once for each number of consumers.  With a
+    fanin section and SQLite the consumers hand their rows to a
+    tweet_writer, as in tweetdbstream.  In the 'inproc' mode an
+    InprocIngest is fed instead, with each number of writer threads.
+    The tweet tables are dropped and recreated before each scenario, so
+    point this at a scratch database.
+    '''
+    statuses = list(statuses)
+    return [bench_scenario(parmdata, statuses, n, rate, timeout, mode=mode)
+            for mode in modes for n in consumers]
+
+
+def _rss(pids):
+    # resident memory of the processes in MB (0 where /proc can't tell)
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%d/statm' % pid) as f:
+                total += int(f.read().split()[1])
+        except (IOError, ValueError, IndexError):
+            pass
+    return total * resource.getpagesize() / 2 ** 20
+
+
+def bench_scenario(parmdata, statuses, num_consumers, rate=None,
+                   timeout=600, poll_interval=0.25, mode='process'):
+    '''
+    One ingest scenario.  Reports tweets/second from the first status
+    until every distinct tweet has been written, the time spent in each
+    stage (summed over processes, see metrics), the queue depth and the
+    resident memory of this process and its children.
+    '''
+    engine = get_sql_engine(parmdata)
+    Base.metadata.drop_all(engine)
+    create_tables(engine)
+    session = engine.connect()
+    n_unique = len(set(status.id for status in statuses))
+
+    # the consumers (and this process, as the producer) publish metrics
+    interval = 0.5
+    settings = parmdata['settings']
+    settings['metrics'] = {'interval': interval}
+    metrics_queue = Queue(1000)
+    collector = MetricsCollector(metrics_queue)
+    metrics.configure(metrics_queue, 'producer_0', interval)
+
+    processes = []
+    row_queue = None
+    fanindata = settings.get('fanin')
+    if mode == 'inproc':
+        settings['inproc'] = dict(settings.get('inproc') or {},
+                                  writers=num_consumers)
+        ingest = InprocIngest(parmdata, metrics_queue=metrics_queue)
+        ingest.start()
+        queue, listener = ingest.queue, ingest.listener
+        processes = ingest.writers
+    else:
+        ack_queues = [None] * num_consumers
+        if fanindata is not None and engine.dialect.name == 'sqlite':
+            row_queue = Queue(fanindata.get('queue_size', 100))
+            ack_queues = [Queue() for i in range(num_consumers)]
+            processes.append(tweet_writer(row_queue, parmdata,
+                                          name='writer',
+                                          metrics_queue=metrics_queue,
+                                          ack_queues=ack_queues))
+        queue = Queue(100)
+        processes.extend(tweet_consumer(queue, engine, parmdata,
+                                        name='consumer_%d' % i,
+                                        metrics_queue=metrics_queue,
+                                        row_queue=row_queue,
+                                        ack_queue=ack_queues[i],
+                                        slot=None if row_queue is None
+                                        else i)
+                         for i in range(num_consumers))
+        for process in processes:
+            process.start()
+
+        wiredata = settings.get('wire') or {}
+        listener = database_listener(None, queue, settings['log_interval'],
+                                     wiredata.get('batch_size', 1),
+                                     wiredata.get('interval', 500))
+    stream = FakeStream(listener, statuses, rate)
+    thread = threading.Thread(target=stream.sample)
+    thread.daemon = True
+
+    depths, rss = [], []
+    n_written = 0
+    start = time.time()
+    thread.start()
+    while time.time() - start < timeout:
+        time.sleep(poll_interval)
+        depths.append(queue.qsize())
+        rss.append(_rss([os.getpid()] +
+                        [child.pid for child in active_children()]))
+        n_written = session.execute(select([func.count()]).
+                                    select_from(Tweet.__table__)).scalar()
+        if n_written >= n_unique or \
+           not all(process.is_alive() for process in processes):
+            break
+    elapsed = time.time() - start
+    stream.disconnect()
+    thread.join()
+
+    # let the last of the metrics come in
+    time.sleep(2 * interval)
+    metrics.publish()
+    time.sleep(2 * interval)
+    if mode == 'inproc':
+        ingest.close()
+    else:
+        for process in processes:
+            process.terminate()
+            process.join()
+    metrics.configure(None, None)
+    session.close()
+    engine.dispose()
+
+    summary = collector.summary()
+    for stage in summary['stages'].values():
+        stage['mean_ms'] = 1000 * stage['seconds'] / max(stage['count'], 1)
+    return {'mode': mode,
+            'consumers': num_consumers,
+            'fanin': row_queue is not None,
+            'database': engine.dialect.name,
+            'tweets': len(statuses),
+            'unique_tweets': n_unique,
+            'written': n_written,
+            'completed': n_written >= n_unique,
+            'seconds': elapsed,
+            'tweets_per_second': len(statuses) / elapsed,
+            'queue_depth': {'mean': sum(depths) / max(len(depths), 1),
+                            'max': max(depths or [0])},
+            'rss_mb': {'mean': sum(rss) / max(len(rss), 1),
+                       'max': max(rss or [0])},
+            'counters': summary['counters'],
+            'stages': summary['stages']}
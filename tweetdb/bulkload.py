@@ -0,0 +1,217 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Parallel bulk loading of archived stream captures."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+Raw stream captures are kept as (optionally gzipped) JSON-lines files,
+one status (or delete/limit notice) per line.  bulk_load hands whole
+files to a pool of worker processes, each of which parses its files
+straight into the wire format (no tweepy Status objects), applies the
+language filter and writes them in large batches through add_tweets,
+with its own lexicon and user caches and with child rows going through
+COPY on Postgres.  SQLite only allows one writer at a time, so there the
+workers take turns writing.
+
+Images are not fetched: backfilling months of tweets shouldn't mean
+downloading months of images.
+'''
+
+import os
+import gzip
+import json
+import time
+import logging
+from multiprocessing import Pool, Lock
+from sqlalchemy.exc import IntegrityError, OperationalError
+from wire import encode_json, decode
+from cache import UserCache
+from tweetdb import get_sql_session, new_hashtag_lexicon, \
+    new_word_lexicon, add_tweets, add_user, add_tweet, language_set, \
+    normalize_lang, retryable
+
+# get rootLogger
+log = logging.getLogger("__name__")
+
+# per-worker state, set up by init_worker
+worker = {}
+
+
+def read_records(filename, stats):
+    '''
+    Yield the encoded statuses in a JSON-lines file (gzipped if its name
+    ends in .gz), counting lines which aren't statuses in stats['skipped']
+    '''
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+                if 'delete' in data or 'user' not in data:
+                    # delete, limit and other stream notices
+                    raise ValueError
+                record = encode_json(data)
+            except (ValueError, KeyError, TypeError):
+                stats['skipped'] += 1
+                continue
+            yield record
+
+
+def init_worker(parmdata, langs, batch_size, lock):
+    worker['session'] = get_sql_session(parmdata)
+    worker['sqlite'] = parmdata['database']['db_type'].upper() == 'SQLITE'
+    worker['lock'] = lock
+    worker['languages'] = langs
+    worker['batch_size'] = batch_size
+    worker['log_interval'] = parmdata['settings']['log_interval']
+
+    cachedata = parmdata['settings'].get('lexicon_cache') or {}
+    worker['hashtag_lexicon'] = new_hashtag_lexicon(cachedata.get('size',
+                                                                  100000))
+    worker['word_lexicon'] = new_word_lexicon(cachedata.get('size', 100000))
+    if cachedata.get('warm', False):
+        worker['hashtag_lexicon'].warm(worker['session'])
+        worker['word_lexicon'].warm(worker['session'])
+        worker['session'].commit()
+
+    cachedata = parmdata['settings'].get('user_cache') or {}
+    worker['user_cache'] = UserCache(cachedata.get('size', 100000),
+                                     cachedata.get('staleness', 3600))
+
+
+def rollback():
+    # lexicon ids added by the rolled back transaction are now invalid
+    worker['session'].rollback()
+    worker['hashtag_lexicon'].clear()
+    worker['word_lexicon'].clear()
+
+
+def write_batch(batch, attempts=3):
+    '''
+    Returns the number of new and duplicate tweets.  A batch which loses
+    a deadlock to another worker writing some of the same users or terms
+    is rolled back and written again, up to attempts times in all, and
+    then one tweet at a time.
+    '''
+    session = worker['session']
+    for attempt in range(attempts):
+        try:
+            return add_tweets(batch, session,
+                              hashtag_lexicon=worker['hashtag_lexicon'],
+                              word_lexicon=worker['word_lexicon'],
+                              user_cache=worker['user_cache'], copy=True)
+        except IntegrityError:
+            '''
+            another worker beat us to one of the batch's users, tweets or
+            lexicon entries; fall back to adding it one tweet at a time
+            '''
+            rollback()
+            break
+        except OperationalError as e:
+            if not retryable(e):
+                raise
+            log.info('Retrying a batch of %d tweets: %s' %
+                     (len(batch), str(e.orig)))
+            rollback()
+    n_new, n_dupes = 0, 0
+    for status in batch:
+        try:
+            add_user(status.author, session, worker['user_cache'])
+            if add_tweet(status, session,
+                         hashtag_lexicon=worker['hashtag_lexicon'],
+                         word_lexicon=worker['word_lexicon']):
+                n_new += 1
+            else:
+                n_dupes += 1
+        except IntegrityError:
+            n_dupes += 1
+            rollback()
+        except OperationalError as e:
+            if not retryable(e):
+                raise
+            log.info('Skipping tweet %d which could not be written: %s' %
+                     (status.id, str(e.orig)))
+            rollback()
+    return n_new, n_dupes
+
+
+def flush_batch(batch):
+    if worker['sqlite']:
+        with worker['lock']:
+            return write_batch(batch)
+    return write_batch(batch)
+
+
+def load_file(filename):
+    '''
+    Load one file, logging progress every log_interval seconds.  Returns
+    a dict of counts and timings for the file.
+    '''
+    name = os.path.basename(filename)
+    languages = worker['languages']
+    stats = {'file': filename, 'read': 0, 'skipped': 0, 'filtered': 0,
+             'new': 0, 'dupes': 0}
+    start = last_log = time.time()
+    batch = []
+    for record in read_records(filename, stats):
+        stats['read'] += 1
+        if languages is not None and \
+           normalize_lang(record[2]) not in languages:
+            stats['filtered'] += 1
+            continue
+        batch.append(decode(record))
+        if len(batch) >= worker['batch_size']:
+            n_new, n_dupes = flush_batch(batch)
+            stats['new'] += n_new
+            stats['dupes'] += n_dupes
+            batch = []
+            if time.time() - last_log > worker['log_interval']:
+                last_log = time.time()
+                log.info('%s: %d tweets read, %d new (%.0f tweets/second).'
+                         % (name, stats['read'], stats['new'],
+                            stats['read'] / (last_log - start)))
+    if batch:
+        n_new, n_dupes = flush_batch(batch)
+        stats['new'] += n_new
+        stats['dupes'] += n_dupes
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def bulk_load(parmdata, filenames, workers=None, batch_size=5000):
+    '''
+    Load the statuses in filenames into the database using a pool of
+    worker processes (one per cpu by default).  Returns the per-file
+    stats, in the order the files finished.
+    '''
+    pool = Pool(workers, init_worker,
+                (parmdata, language_set(parmdata['settings']['langs']),
+                 batch_size, Lock()))
+    results = []
+    start = time.time()
+    n_read = 0
+    try:
+        for stats in pool.imap_unordered(load_file, filenames):
+            results.append(stats)
+            n_read += stats['read']
+            log.info('Loaded %s: %d tweets read, %d new, %d duplicates, '
+                     '%d filtered by language, %d other lines skipped, '
+                     'in %.1f seconds (%.0f tweets/second).' %
+                     (stats['file'], stats['read'], stats['new'],
+                      stats['dupes'], stats['filtered'], stats['skipped'],
+                      stats['seconds'],
+                      stats['read'] / max(stats['seconds'], 1e-6)))
+            log.info('%d of %d files done, %.0f tweets/second overall.' %
+                     (len(results), len(filenames),
+                      n_read / (time.time() - start)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
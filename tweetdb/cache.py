@@ -0,0 +1,197 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "In-process caches used by the tweet ingest pipeline."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+import time
+from collections import OrderedDict
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+
+def chunks(seq, size):
+    # break a sequence into lists of at most size elements
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+class LRUCache(object):
+    '''
+    Bounded mapping which evicts its least recently used entry once it
+    holds maxsize entries
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def discard(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+
+class LexiconCache(LRUCache):
+    '''
+    text -> id cache sitting in front of one of the lexicon tables
+    (HashtagLexicon or TweetLexicon).  Anything not in the cache is
+    resolved for the whole batch at once, inserting new terms as needed.
+
+    Ids of terms inserted by a transaction which is later rolled back
+    would be stale, so owners should clear() the cache on rollback.
+    '''
+
+    def __init__(self, table, textcol, idcol, maxsize=100000):
+        LRUCache.__init__(self, maxsize)
+        self.table = table
+        self.textcol = table.c[textcol]
+        self.idcol = table.c[idcol]
+        self.hits = 0
+        self.misses = 0
+
+    def warm(self, session):
+        # preload up to maxsize of the most recently added terms
+        query = select([self.idcol, self.textcol]).\
+            order_by(self.idcol.desc()).limit(self.maxsize)
+        for termid, text in reversed(session.execute(query).fetchall()):
+            self.put(text, termid)
+        return len(self)
+
+    def lookup(self, session, texts):
+        # map each of texts onto its lexicon id
+        ids = {}
+        missing = set()
+        for text in texts:
+            if text in ids or text in missing:
+                continue
+            termid = self.get(text)
+            if termid is None:
+                missing.add(text)
+            else:
+                ids[text] = termid
+        self.hits += len(ids)
+        self.misses += len(missing)
+        if missing:
+            for text, termid in self.resolve(session, missing).items():
+                self.put(text, termid)
+                ids[text] = termid
+        return ids
+
+    def resolve(self, session, texts):
+        '''
+        Look up (and if need be insert) texts in the lexicon table.  On
+        Postgres this is a single INSERT ... ON CONFLICT DO NOTHING
+        statement which also selects the terms that already existed.
+        '''
+        ids = {}
+        # insert terms in the same order as everyone else, so concurrent
+        # writers wait for each other instead of deadlocking
+        texts = sorted(texts)
+        if session.get_bind().dialect.name == 'postgresql':
+            for chunk in chunks(texts, 1000):
+                ins = pg_insert(self.table).\
+                    values([{self.textcol.name: text} for text in chunk]).\
+                    on_conflict_do_nothing().\
+                    returning(self.idcol, self.textcol).cte('ins')
+                query = select([ins.c[self.idcol.name],
+                                ins.c[self.textcol.name]]).\
+                    union_all(select([self.idcol, self.textcol]).
+                              where(self.textcol.in_(chunk)))
+                ids.update((row[1], row[0])
+                           for row in session.execute(query))
+        else:
+            ids.update(self.select(session, texts))
+            new = set(texts).difference(ids)
+            if new:
+                session.execute(self.table.insert(),
+                                [{self.textcol.name: text} for text in new])
+
+        # terms committed by someone else after our statement began
+        new = set(texts).difference(ids)
+        if new:
+            ids.update(self.select(session, new))
+        return ids
+
+    def select(self, session, texts):
+        ids = {}
+        for chunk in chunks(texts, 500):
+            ids.update((row[1], row[0]) for row in
+                       session.execute(select([self.idcol, self.textcol]).
+                                       where(self.textcol.in_(chunk))))
+        return ids
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+
+class UserCache(LRUCache):
+    '''
+    userid -> (profile fingerprint, time of last write) for authors we've
+    recently written, so that repeat appearances of an unchanged author
+    don't rewrite their User row.
+
+    Follower/friend/status counts change with nearly every tweet, so they
+    are left out of the fingerprint and only refreshed once an entry is
+    older than staleness seconds.
+    '''
+
+    def __init__(self, maxsize=100000, staleness=3600):
+        LRUCache.__init__(self, maxsize)
+        self.staleness = staleness
+        self.writes = 0
+        self.skips = 0
+
+    @staticmethod
+    def fingerprint(author):
+        return hash((author.screen_name, author.name, author.location,
+                     author.description, author.time_zone,
+                     author.geo_enabled, author.verified))
+
+    def needs_write(self, author, now=None):
+        if now is None:
+            now = time.time()
+        entry = self.get(author.id)
+        if entry is None or entry[0] != self.fingerprint(author) or \
+           now - entry[1] > self.staleness:
+            self.writes += 1
+            return True
+        self.skips += 1
+        return False
+
+    def written(self, authors, now=None):
+        # record authors whose rows have been committed
+        if now is None:
+            now = time.time()
+        for author in authors:
+            self.put(author.id, (self.fingerprint(author), now))
+
+    def reset_counters(self):
+        self.writes = 0
+        self.skips = 0
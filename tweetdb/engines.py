@@ -0,0 +1,124 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Connection pooling shared within, and safe across, processes."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+Everything in a process using the same database shares one engine, and
+so one connection pool (see get_sql_engine).  Engines are kept per
+process id: a process forked from one which already had an engine
+builds its own rather than using the inherited one.  The inherited
+engine is deliberately not disposed of, since its connections share
+their sockets with the parent's and closing them would break the
+parent's connections, and as a last line of defence guard_fork
+invalidates any inherited connection which does get checked out in the
+wrong process.
+'''
+
+import os
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+from metrics import metrics
+
+
+class TimedQueuePool(QueuePool):
+    '''
+    QueuePool which keeps track of how long checkouts take (waiting for
+    a free connection, connecting and any pre-ping), as the pool_checkout
+    stage in metrics and in n_checkouts/wait_time for logging
+    '''
+
+    def __init__(self, creator, **kwargs):
+        QueuePool.__init__(self, creator, **kwargs)
+        self.reset_counters()
+
+    def connect(self):
+        return self.timed(QueuePool.connect)
+
+    def unique_connection(self):
+        # what engines check connections out with
+        return self.timed(QueuePool.unique_connection)
+
+    def timed(self, checkout):
+        start = time.time()
+        try:
+            return checkout(self)
+        finally:
+            wait = time.time() - start
+            self.n_checkouts += 1
+            self.wait_time += wait
+            metrics.observe('pool_checkout', wait)
+
+    def reset_counters(self):
+        self.n_checkouts = 0
+        self.wait_time = 0
+
+
+def pool_options(url, pooldata):
+    '''
+    create_engine keyword arguments for the parmfile's pool section.
+    SQLite file databases keep SQLAlchemy's default (unpooled) NullPool,
+    so only pre-ping and recycle apply to them.
+    '''
+    options = {'pool_pre_ping': pooldata.get('pre_ping', False),
+               'pool_recycle': pooldata.get('recycle', -1)}
+    if not url.startswith('sqlite'):
+        options.update(poolclass=TimedQueuePool,
+                       pool_size=pooldata.get('size', 5),
+                       max_overflow=pooldata.get('overflow', 10),
+                       pool_timeout=pooldata.get('timeout', 30))
+    return options
+
+
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # a connection made by another process mustn't be used (or closed)
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection belongs to process %d, '
+                                     'not %d.' %
+                                     (connection_record.info['pid'],
+                                      os.getpid()))
+
+
+def guard_fork(engine):
+    event.listen(engine, 'connect', _remember_pid)
+    event.listen(engine, 'checkout', _check_pid)
+
+
+def sqlite_pragmas(sqlitedata):
+    '''
+    connect event handler for SQLite engines, setting the pragmas of the
+    parmfile's sqlite section on the main and any attached databases:
+    write-ahead logging (so readers and the writer don't block each
+    other) and syncing only at checkpoints, plus bigger page and mmap
+    caches for the main database
+    '''
+    schema_pragmas = [('journal_mode', sqlitedata.get('journal_mode',
+                                                      'wal')),
+                      ('synchronous', sqlitedata.get('synchronous',
+                                                     'normal'))]
+    connection_pragmas = [('cache_size',
+                           -1024 * sqlitedata.get('cache_size_mb', 64)),
+                          ('mmap_size',
+                           2 ** 20 * sqlitedata.get('mmap_size_mb', 256))]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA database_list')
+        schemas = [row[1] for row in cursor.fetchall() if row[1] != 'temp']
+        for schema in schemas:
+            for name, value in schema_pragmas:
+                cursor.execute('PRAGMA "%s".%s = %s' % (schema, name, value))
+        for name, value in connection_pragmas:
+            cursor.execute('PRAGMA %s = %d' % (name, value))
+        cursor.close()
+    return set_pragmas
@@ -0,0 +1,104 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Fixed grid cell codes for geotags."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+Geotags are given a cell on a fixed latitude/longitude grid: at zoom z
+the globe is split into 2**z columns of longitude by 2**z rows of
+latitude, and a cell's code interleaves the bits of its column (x) and
+row (y), a Morton or Z-order code.  Cells are stored at MAX_ZOOM, and
+since the code of the enclosing cell at a coarser zoom z is just
+
+    cell >> 2 * (MAX_ZOOM - z)   (ie cell / 4 ** (MAX_ZOOM - z))
+
+tiles can be aggregated in SQL by integer division, and any area maps to
+a small number of contiguous ranges of codes, which an index on the cell
+column can answer.
+'''
+
+MAX_ZOOM = 24
+
+
+def _spread(v):
+    # put a zero bit between each of the bits of v
+    v &= 0xFFFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+def _compact(v):
+    # inverse of _spread, keeping the even bits of v
+    v &= 0x5555555555555555
+    v = (v | (v >> 1)) & 0x3333333333333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+    v = (v | (v >> 16)) & 0x00000000FFFFFFFF
+    return v
+
+
+def interleave(x, y):
+    return _spread(x) | (_spread(y) << 1)
+
+
+def deinterleave(code):
+    return _compact(code), _compact(code >> 1)
+
+
+def grid_xy(latitude, longitude, zoom=MAX_ZOOM):
+    # column and row of the cell containing a point
+    n = 2 ** zoom
+    x = int((longitude + 180) / 360 * n)
+    y = int((latitude + 90) / 180 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def geo_cell(latitude, longitude):
+    # code of the MAX_ZOOM cell containing a point
+    if latitude is None or longitude is None:
+        return None
+    return interleave(*grid_xy(latitude, longitude))
+
+
+def tile_bounds(x, y, zoom):
+    # (south, west, north, east) of a cell
+    n = 2 ** zoom
+    return (y / n * 180 - 90, x / n * 360 - 180,
+            (y + 1) / n * 180 - 90, (x + 1) / n * 360 - 180)
+
+
+def cell_ranges(south, west, north, east, max_cells=64):
+    '''
+    Inclusive (low, high) ranges of MAX_ZOOM cell codes covering a
+    bounding box.  The box is covered with at most max_cells cells of the
+    finest zoom that allows it, so the ranges may take in a little more
+    than the box; filter on latitude/longitude as well for exact results.
+    A box crossing the antimeridian has to be split in two (as
+    getGeotagsInBox does).
+    '''
+    zoom = MAX_ZOOM
+    while True:
+        x0, y0 = grid_xy(south, west, zoom)
+        x1, y1 = grid_xy(north, east, zoom)
+        if zoom == 0 or (x1 - x0 + 1) * (y1 - y0 + 1) <= max_cells:
+            break
+        zoom -= 1
+    codes = sorted(interleave(x, y) for x in range(x0, x1 + 1)
+                   for y in range(y0, y1 + 1))
+    shift = 2 * (MAX_ZOOM - zoom)
+    ranges = []
+    for code in codes:
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return [(low << shift, ((high + 1) << shift) - 1) for low, high in ranges]
@@ -0,0 +1,346 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Single process, threaded tweet ingest."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+An alternative to the producer and consumer processes (tweetdbstream
+--inproc): the stream reader, the database writers and the media
+fetchers are threads of one process, handing statuses to each other
+through an in-memory queue, so nothing is pickled on the way and the
+whole of ingest costs one process's memory.  They spend nearly all of
+their time waiting on Twitter or the database, with the GIL released.
+The CPU heavy part, tokenizing, goes to a pool of worker processes.
+
+Each writer thread has its own session and lexicon and user caches, and
+writes batches with tweet_rows and write_rows as a batched
+tweet_consumer does.  SQLite gets a single writer.  Spilling and routing
+don't apply, there being just the one queue.
+'''
+
+import time
+import signal
+import logging
+import threading
+import requests
+import tweepy
+from Queue import Queue, Empty
+from multiprocessing import Pool, cpu_count
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from cache import UserCache
+from mediafetch import MediaFetcher, ImageStore
+from trending import TrendFeed
+from metrics import metrics
+from tweetdb import tokenizer, tweet_rows, write_rows, add_media, \
+    database_listener, tweet_consumer, get_sql_engine, get_sql_session, \
+    new_hashtag_lexicon, new_word_lexicon, retryable
+
+# get rootLogger
+log = logging.getLogger("__name__")
+
+
+def _ignore_interrupts():
+    # pool workers leave ^C to the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _tokenize(texts):
+    return tokenizer.tokenize_batch(texts)
+
+
+class InprocIngest(object):
+    '''
+    The whole ingest pipeline in this process.  Without auth nothing is
+    streamed, and statuses can be fed to listener directly.
+    '''
+
+    def __init__(self, parmdata, auth=None, trend_queue=None,
+                 metrics_queue=None):
+        settings = parmdata['settings']
+        self.parmdata = parmdata
+        self.auth = auth
+        self.stream = None
+        self.active = threading.Event()
+
+        '''
+        there are writers writer threads (writing batches of up to the
+        batch section's size), tokenize_processes pool processes (0 to
+        tokenize on the writer threads), and the stream blocks once
+        queue_size lists of statuses are waiting
+        '''
+        inprocdata = settings.get('inproc') or {}
+        self.n_writers = inprocdata.get('writers', 2)
+        if get_sql_engine(parmdata).dialect.name == 'sqlite':
+            self.n_writers = 1
+        self.n_processes = inprocdata.get('tokenize_processes',
+                                          cpu_count() - 1)
+        self.queue = Queue(inprocdata.get('queue_size', 100))
+        self.pool = None
+
+        wiredata = settings.get('wire') or {}
+        self.listener = database_listener(None, self.queue,
+                                          settings['log_interval'],
+                                          wiredata.get('batch_size', 50),
+                                          wiredata.get('interval', 500),
+                                          settings['langs'], wire=False)
+
+        self.fetcher = None
+        self.fetchdata = settings.get('media_fetch') or {}
+        self.trend_queue = trend_queue
+        self.metrics_queue = metrics_queue
+        self.writers = []
+
+    def start(self):
+        if self.metrics_queue is not None:
+            metrics.configure(self.metrics_queue, 'inproc',
+                              (self.parmdata['settings'].get('metrics') or
+                               {}).get('interval', 5))
+
+        # the pool is forked before any of the ingest's threads are started
+        if self.n_processes > 0:
+            log.info('Tokenizing in %d processes.' % self.n_processes)
+            self.pool = Pool(self.n_processes, _ignore_interrupts)
+
+        settings = self.parmdata['settings']
+        if settings['get_images']:
+            image_path = None
+            if settings['image_storage']['method'].upper() == 'FILE':
+                image_path = settings['image_storage']['path']
+            self.fetcher = MediaFetcher(tweet_consumer.https,
+                                        ImageStore(image_path,
+                                                   self.fetchdata.get(
+                                                       'url_cache_size',
+                                                       100000)),
+                                        self.fetchdata.get('threads', 4),
+                                        self.fetchdata.get('queue_size',
+                                                           1000),
+                                        self.fetchdata.get('per_host', 4),
+                                        self.fetchdata.get('timeout', 10),
+                                        self.fetchdata.get('retries', 2))
+
+        self.active.set()
+        log.info('Starting %d writer threads.' % self.n_writers)
+        self.writers = [IngestWriter(self, name='writer_%d' % i)
+                        for i in range(self.n_writers)]
+        for writer in self.writers:
+            writer.start()
+
+        if self.auth is not None:
+            thread = threading.Thread(target=self.read_stream,
+                                      name='stream')
+            thread.daemon = True
+            thread.start()
+
+    def read_stream(self):
+        # as tweet_producer, reconnecting until closed
+        while self.active.is_set():
+            try:
+                self.stream = tweepy.streaming.Stream(self.auth,
+                                                      self.listener,
+                                                      timeout=60)
+                log.info("Streaming API connected.  Adding tweets to queue.")
+                self.stream.sample()
+            except requests.packages.urllib3.exceptions.ProtocolError:
+                pass
+            except Exception as e:
+                log.error(str(e))
+                pass
+
+    def check_writers(self):
+        '''
+        Replace any writer thread which has died, so that what's queued
+        still gets written.  The main loop should call this now and then.
+        '''
+        for i, writer in enumerate(self.writers):
+            if not writer.is_alive() and \
+               (self.active.is_set() or self.queue.unfinished_tasks):
+                log.error('%s died, starting another.' % writer.name)
+                self.writers[i] = IngestWriter(self, name=writer.name)
+                self.writers[i].start()
+
+    def tokenize(self, texts):
+        # tokenize_batch, in a pool process
+        return self.pool.apply(_tokenize, (texts,))
+
+    def close(self):
+        '''
+        Stop streaming, wait for the writers to finish what's queued, then
+        stop them and the pool
+        '''
+        self.active.clear()
+        if self.stream is not None:
+            log.info("Disconnecting Twitter stream.")
+            self.stream.disconnect()
+        self.listener.flush()
+        while self.queue.unfinished_tasks:
+            self.check_writers()
+            time.sleep(1)
+        for writer in self.writers:
+            writer.join()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+class IngestWriter(threading.Thread):
+    '''
+    Takes lists of statuses off the ingest's queue and writes them to the
+    database in batches, like a batched tweet_consumer
+    '''
+
+    def __init__(self, ingest, name=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.ingest = ingest
+        self.queue = ingest.queue
+        settings = ingest.parmdata['settings']
+        self.log_interval = settings['log_interval']
+        self.get_images = settings['get_images']
+        self.metrics_interval = (settings.get('metrics') or
+                                 {}).get('interval', 5)
+
+        batchdata = settings.get('batch') or {}
+        self.batch_size = batchdata.get('size', 500)
+        self.batch_interval = batchdata.get('interval', 1000) / 1000
+
+        cachedata = settings.get('lexicon_cache') or {}
+        self.hashtag_lexicon = new_hashtag_lexicon(cachedata.get('size',
+                                                                 100000))
+        self.word_lexicon = new_word_lexicon(cachedata.get('size', 100000))
+        cachedata = settings.get('user_cache') or {}
+        self.user_cache = UserCache(cachedata.get('size', 100000),
+                                    cachedata.get('staleness', 3600))
+
+        self.trends = None
+        if ingest.trend_queue is not None:
+            self.trends = TrendFeed(ingest.trend_queue)
+
+        # some diagnostic variables
+        self.last_time = time.time()
+        self.n_tweets = 0
+        self.n_dupes = 0
+
+    def run(self):
+        self.session = get_sql_session(self.ingest.parmdata)
+        while self.ingest.active.is_set() or self.queue.unfinished_tasks:
+            batch, n_lists = self.next_batch()
+            try:
+                if batch:
+                    self.write(batch)
+            finally:
+                # else close() would wait forever on a writer which died
+                for i in range(n_lists):
+                    self.queue.task_done()
+            self.add_media()
+            self.status_update()
+        self.session.close()
+
+    def next_batch(self):
+        '''
+        Wait (up to the metrics interval) for the first list of statuses,
+        then keep pulling until the batch is full or the flush interval
+        has passed.  Returns the batch and the number of lists taken.
+        '''
+        try:
+            batch = list(self.queue.get(True, self.metrics_interval))
+        except Empty:
+            return [], 0
+        n_lists = 1
+        deadline = time.time() + self.batch_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.extend(self.queue.get(True, remaining))
+            except Empty:
+                break
+            n_lists += 1
+        return batch, n_lists
+
+    def write(self, batch):
+        tokenize = None
+        if self.ingest.pool is not None:
+            tokenize = self.ingest.tokenize
+        rows, authors = tweet_rows(batch, self.user_cache, self.get_images,
+                                   tokenize)
+        '''
+        another writer may add some of the same users or lexicon entries
+        first, in which case they're there to be found the second time,
+        or deadlock with us (or, on SQLite, hold the database locked), in
+        which case the batch is tried again
+        '''
+        for attempt in range(3):
+            try:
+                with metrics.time('write_batch'):
+                    n_new, n_dupes = write_rows(self.session, rows, None,
+                                                None, self.hashtag_lexicon,
+                                                self.word_lexicon,
+                                                self.ingest.fetcher,
+                                                trends=self.trends)
+                break
+            except SQLAlchemyError as e:
+                self.rollback()
+                if not isinstance(e, IntegrityError) and not retryable(e):
+                    log.exception('Dropping %d tweets which could not be '
+                                  'written.' % len(rows['tweets']))
+                    metrics.count('tweets_dropped', len(rows['tweets']))
+                    return
+                metrics.count('batch_fallbacks')
+        else:
+            log.error('Dropping %d tweets which could not be written.' %
+                      len(rows['tweets']))
+            metrics.count('tweets_dropped', len(rows['tweets']))
+            return
+        self.user_cache.written(authors)
+        self.n_tweets += n_new
+        self.n_dupes += n_dupes
+        metrics.count('tweets_new', n_new)
+        metrics.count('tweets_duplicate', n_dupes)
+        if self.trends is not None:
+            self.trends.flush()
+
+    def add_media(self):
+        # write the Media rows of any images the fetchers have finished
+        if self.ingest.fetcher is None:
+            return
+        rows = self.ingest.fetcher.completed()
+        if rows:
+            missing = add_media(self.session, rows)
+            self.session.commit()
+            self.ingest.fetcher.written(rows, missing)
+
+    def rollback(self):
+        # lexicon ids added by the rolled back transaction are now invalid
+        self.session.rollback()
+        self.hashtag_lexicon.clear()
+        self.word_lexicon.clear()
+
+    def status_update(self):
+        if metrics.due():
+            metrics.set('queue_depth', self.queue.qsize())
+            metrics.publish()
+
+        elapsed_time = time.time() - self.last_time
+        if elapsed_time > self.log_interval:
+            log.info("%s writing %f tweets/second (%f/sec discarded as "
+                     "duplicates), %d lists of tweets waiting." %
+                     (self.name, self.n_tweets/elapsed_time,
+                      self.n_dupes/elapsed_time, self.queue.qsize()))
+            log.info("Lexicon cache hits/misses: %d/%d words, "
+                     "%d/%d hashtags." %
+                     (self.word_lexicon.hits, self.word_lexicon.misses,
+                      self.hashtag_lexicon.hits, self.hashtag_lexicon.misses))
+            if self.trends is not None and self.trends.n_dropped:
+                log.info("Trend server behind, dropped %d tweets." %
+                         self.trends.n_dropped)
+                self.trends.n_dropped = 0
+            self.last_time = time.time()
+            self.n_tweets = 0
+            self.n_dupes = 0
+            self.word_lexicon.reset_counters()
+            self.hashtag_lexicon.reset_counters()
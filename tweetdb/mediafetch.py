@@ -0,0 +1,275 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Background fetching and storage of tweeted media."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+import os
+import zlib
+import hashlib
+import logging
+import threading
+import urllib3
+from Queue import Queue, Full
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+from cache import LRUCache
+from metrics import metrics
+
+# get rootLogger
+log = logging.getLogger("__name__")
+
+
+class ImageStore(object):
+    '''
+    Content-addressed image storage.  Images are keyed by the sha1 of
+    their bytes, so an image tweeted (or retweeted) many times is only
+    written to disk, or compressed for the database, once.  A bounded
+    url -> content hash cache lets already known media_url_https values
+    skip the download entirely.
+
+    Known stored content is remembered with the local_filename of its
+    ImageData row (or True, storing blobs), as the file keeps the
+    extension of whichever url first stored it.
+    '''
+
+    def __init__(self, image_path=None, maxurls=100000):
+        self.image_path = image_path
+        self.urls = LRUCache(maxurls)
+        self.stored = LRUCache(maxurls)
+        self.lock = threading.Lock()
+
+    def warm(self, rows):
+        # preload (url, contenthash, local_filename) of previously stored
+        # media
+        with self.lock:
+            for url, contenthash, local_filename in rows:
+                self.urls.put(url, contenthash)
+                self.stored.put(contenthash, local_filename or True)
+        return len(self.urls)
+
+    def known(self, url):
+        with self.lock:
+            return self.urls.get(url)
+
+    def path(self, contenthash, extension=''):
+        return os.path.join(self.image_path, contenthash[0:2],
+                            contenthash[2:4], contenthash + extension)
+
+    def filename(self, contenthash, url):
+        '''
+        local_filename for content fetched from url: that of its ImageData
+        row if it is known to be stored, or else where put stores it
+        '''
+        if self.image_path is None:
+            return None
+        with self.lock:
+            filename = self.stored.get(contenthash)
+        if filename is None or filename is True:
+            filename = self.path(contenthash, os.path.splitext(url)[1])
+        return filename
+
+    def committed(self, mediarows):
+        '''
+        Remember the urls and content of Media rows once they have been
+        committed.  Until then a rolled back transaction could lose the
+        only ImageData row of the content.
+        '''
+        with self.lock:
+            for mediarow in mediarows:
+                self.urls.put(mediarow['url'], mediarow['contenthash'])
+                self.stored.put(mediarow['contenthash'],
+                                mediarow['local_filename'] or True)
+
+    def forget(self, mediarows):
+        # content of these Media rows is no longer stored (pruned since)
+        with self.lock:
+            for mediarow in mediarows:
+                self.urls.discard(mediarow['url'])
+                self.stored.discard(mediarow['contenthash'])
+
+    def put(self, rawdata, url):
+        '''
+        Store rawdata under its content hash.  Returns the hash and, unless
+        the content is known to have been committed already, the ImageData
+        row for it.
+        '''
+        contenthash = hashlib.sha1(rawdata).hexdigest()
+        with self.lock:
+            if self.stored.get(contenthash):
+                return contenthash, None
+
+        row = {'contenthash': contenthash,
+               'size': len(rawdata),
+               'blob': None,
+               'local_filename': None}
+        if self.image_path is None:
+            row['blob'] = zlib.compress(rawdata)
+        else:
+            row['local_filename'] = self.path(contenthash,
+                                              os.path.splitext(url)[1])
+            dirname = os.path.dirname(row['local_filename'])
+            if not os.path.exists(row['local_filename']):
+                if not os.path.exists(dirname):
+                    try:
+                        os.makedirs(dirname, mode=0777)
+                    except OSError:
+                        # another fetcher got there first
+                        pass
+                with open(row['local_filename'], 'wb') as f:
+                    f.write(rawdata)
+        return contenthash, row
+
+
+def fetch_image(https, store, tweetid, url, timeout=None, retries=None):
+    '''
+    Fetch (unless its url is already known to the store) and store one
+    tweeted image.  Returns the Media row and the ImageData row, the
+    latter being None when the content was already stored.
+    '''
+    contenthash = store.known(url)
+    imagerow = None
+    if contenthash is None:
+        response = https.request('GET', url, timeout=timeout,
+                                 retries=retries)
+        if response.status != 200:
+            raise urllib3.exceptions.HTTPError('HTTP %d fetching %s' %
+                                               (response.status, url))
+        contenthash, imagerow = store.put(response.data, url)
+    mediarow = {'tweetid': tweetid,
+                'url': url,
+                'native_filename': os.path.split(url)[1],
+                'contenthash': contenthash,
+                'local_filename': store.filename(contenthash, url)}
+    if imagerow is not None:
+        mediarow['local_filename'] = imagerow['local_filename']
+    return mediarow, imagerow
+
+
+def remove_files(filenames, workers=8):
+    # delete files in parallel, ignoring any which are already gone
+    def remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+    pool = ThreadPool(workers)
+    try:
+        pool.map(remove, filenames)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class MediaFetcher(object):
+    '''
+    Pool of threads which download tweeted images outside of the
+    consumer's database transaction.  Jobs go onto a bounded work queue
+    (and are dropped if it is full); finished (Media, ImageData) rows are
+    collected until the consumer picks them up with completed() and
+    writes them.
+    '''
+
+    def __init__(self, https, store, num_threads=4,
+                 queue_size=1000, per_host=4, timeout=10, retries=2):
+        self.https = https
+        self.store = store
+        self.per_host = per_host
+        self.timeout = urllib3.Timeout(total=timeout)
+        self.retries = urllib3.Retry(retries, backoff_factor=0.5)
+        self.jobs = Queue(queue_size)
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.done = []
+        # jobs submitted and not yet finished
+        self.n_pending = 0
+
+        # some diagnostic variables
+        self.n_fetched = 0
+        self.n_failed = 0
+        self.n_dropped = 0
+
+        for i in range(num_threads):
+            thread = threading.Thread(target=self.work,
+                                      name='media_fetcher_%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, tweetid, idx, url):
+        # queue an image for download, returns False if the queue is full
+        try:
+            with self.lock:
+                self.jobs.put_nowait((tweetid, idx, url))
+                self.n_pending += 1
+            return True
+        except Full:
+            with self.lock:
+                self.n_dropped += 1
+            metrics.count('media_dropped')
+            return False
+
+    def completed(self):
+        # hand over the rows finished since the last call
+        with self.lock:
+            done, self.done = self.done, []
+        return done
+
+    def written(self, rows, missing=()):
+        '''
+        Called once rows handed over by completed() have been committed,
+        with the content hashes add_media found no stored content for.
+        The store remembers the rest, and those are forgotten and fetched
+        again.
+        '''
+        self.store.committed([mediarow for mediarow, imagerow in rows
+                              if mediarow['contenthash'] not in missing])
+        refetch = [mediarow for mediarow, imagerow in rows
+                   if mediarow['contenthash'] in missing]
+        self.store.forget(refetch)
+        for mediarow in refetch:
+            self.submit(mediarow['tweetid'], None, mediarow['url'])
+
+    def host_slot(self, url):
+        # semaphore limiting concurrent requests to url's host
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+    def work(self):
+        while True:
+            tweetid, idx, url = self.jobs.get()
+            try:
+                with self.host_slot(url):
+                    with metrics.time('media_fetch'):
+                        rows = fetch_image(self.https, self.store, tweetid,
+                                           url, self.timeout, self.retries)
+            except Exception as e:
+                metrics.count('media_failed')
+                log.info('Could not fetch media \'%s\': %s' % (url, str(e)))
+                with self.lock:
+                    self.n_failed += 1
+                    self.n_pending -= 1
+                continue
+            with self.lock:
+                self.done.append(rows)
+                self.n_pending -= 1
+                self.n_fetched += 1
+            metrics.count('media_fetched')
+
+    def busy(self):
+        # whether any fetches are waiting or under way
+        return self.n_pending > 0
+
+    def reset_counters(self):
+        # returns the counts of images fetched, failed and dropped until now
+        with self.lock:
+            counts = self.n_fetched, self.n_failed, self.n_dropped
+            self.n_fetched = 0
+            self.n_failed = 0
+            self.n_dropped = 0
+        return counts
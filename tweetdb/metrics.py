@@ -0,0 +1,304 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Ingest pipeline counters and per-stage latency histograms."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+Each producer and consumer process records counters, gauges and
+per-stage latency histograms into the module level metrics registry, so
+the stages deep inside add_tweets can time themselves without a handle
+being passed down every call.  Recording is a dict lookup, a bisect and
+a few additions under a lock (media fetcher threads share the registry),
+cheap enough to leave on, and a no-op until the process is configured
+with a queue.
+
+Every interval seconds a process ships what it has recorded since the
+last time to the MetricsCollector in the main process, which keeps the
+running totals per process and renders them in the Prometheus text
+format for the MetricsServer:
+
+    tweetdb_tweets_new_total{process="consumer_0"} 1234
+    tweetdb_stage_seconds_bucket{process="consumer_0",stage="commit",le="0.01"} 56
+    tweetdb_queue_depth{process="consumer_0"} 3
+'''
+
+import time
+import logging
+import threading
+from bisect import bisect_left
+from Queue import Empty, Full
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+# get rootLogger
+log = logging.getLogger("__name__")
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    # counts of observations per bucket (the last one unbounded), and sum
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        for idx, n in enumerate(other.counts):
+            self.counts[idx] += n
+        self.sum += other.sum
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.stage, time.time() - self.start)
+
+
+class Metrics(object):
+    '''
+    One process's registry.  Counters and histograms hold what has been
+    recorded since the last publish; gauges hold their latest value.
+    '''
+
+    def __init__(self):
+        self.queue = None
+        self.process = None
+        self.interval = 5
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.last_publish = time.time()
+        self.n_dropped = 0
+
+    def configure(self, queue, process, interval=5):
+        # start recording, for publishing to queue as process
+        self.queue = queue
+        self.process = process
+        self.interval = interval
+        self.reset()
+
+    def count(self, name, n=1):
+        if self.queue is None:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        if self.queue is None:
+            return
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, stage, seconds):
+        if self.queue is None:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def time(self, stage):
+        # context manager observing the time spent in the block
+        return _Timer(self, stage)
+
+    def due(self):
+        return self.queue is not None and \
+            time.time() - self.last_publish > self.interval
+
+    def publish(self, force=False):
+        '''
+        Send what has been recorded since the last publish to the
+        collector, if the interval has passed (or with force).  Never
+        blocks; if the queue is full the data is kept for the next attempt.
+        '''
+        if self.queue is None or not (force or self.due()):
+            return
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+            gauges = dict(self.gauges)
+        self.last_publish = time.time()
+        try:
+            self.queue.put_nowait((self.process, counters, gauges,
+                                   dict((stage, (histogram.counts,
+                                                 histogram.sum))
+                                        for stage, histogram in
+                                        histograms.items())))
+        except Full:
+            self.n_dropped += 1
+            with self.lock:
+                for name, n in counters.items():
+                    self.counters[name] = self.counters.get(name, 0) + n
+                for stage, histogram in histograms.items():
+                    if stage in self.histograms:
+                        histogram.merge(self.histograms[stage])
+                    self.histograms[stage] = histogram
+
+
+# this process's registry
+metrics = Metrics()
+
+
+class MetricsCollector(object):
+    '''
+    Keeps the running totals of the snapshots published to queue, by
+    process, on a daemon thread of the main process
+    '''
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        thread = threading.Thread(target=self.collect,
+                                  name='metrics_collector')
+        thread.daemon = True
+        thread.start()
+
+    def collect(self):
+        while True:
+            try:
+                process, counters, gauges, histograms = self.queue.get(True,
+                                                                       1)
+            except Empty:
+                continue
+            except (EOFError, IOError):
+                # the queue's gone (a publisher was killed mid-message)
+                return
+            with self.lock:
+                self.add(process, counters, gauges, histograms)
+
+    def add(self, process, counters, gauges, histograms):
+        for name, n in counters.items():
+            key = (name, process)
+            self.counters[key] = self.counters.get(key, 0) + n
+        for name, value in gauges.items():
+            self.gauges[(name, process)] = value
+        for stage, (counts, total) in histograms.items():
+            key = (stage, process)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.counts = [a + b for a, b in
+                                zip(histogram.counts, counts)]
+            histogram.sum += total
+
+    def summary(self):
+        '''
+        The totals summed over processes: {'counters': {name: n},
+        'stages': {stage: {'count': n, 'seconds': total}}}
+        '''
+        counters, stages = {}, {}
+        with self.lock:
+            for (name, process), n in self.counters.items():
+                counters[name] = counters.get(name, 0) + n
+            for (stage, process), histogram in self.histograms.items():
+                totals = stages.setdefault(stage, {'count': 0, 'seconds': 0})
+                totals['count'] += sum(histogram.counts)
+                totals['seconds'] += histogram.sum
+        return {'counters': counters, 'stages': stages}
+
+    def totals(self):
+        '''
+        The totals by process: {process: {'counters': {name: n},
+        'stages': {stage: (count, seconds)}}}
+        '''
+        totals = {}
+        with self.lock:
+            for (name, process), n in self.counters.items():
+                totals.setdefault(process, {'counters': {}, 'stages': {}})
+                totals[process]['counters'][name] = n
+            for (stage, process), histogram in self.histograms.items():
+                totals.setdefault(process, {'counters': {}, 'stages': {}})
+                totals[process]['stages'][stage] = (sum(histogram.counts),
+                                                    histogram.sum)
+        return totals
+
+    def render(self):
+        # the totals in the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            for name in sorted(set(name for name, process in self.counters)):
+                lines.append('# TYPE tweetdb_%s_total counter' % name)
+                lines.extend('tweetdb_%s_total{process="%s"} %d' %
+                             (name, process, n)
+                             for (key, process), n in
+                             sorted(self.counters.items()) if key == name)
+            for name in sorted(set(name for name, process in self.gauges)):
+                lines.append('# TYPE tweetdb_%s gauge' % name)
+                lines.extend('tweetdb_%s{process="%s"} %s' %
+                             (name, process, repr(value))
+                             for (key, process), value in
+                             sorted(self.gauges.items()) if key == name)
+            if self.histograms:
+                lines.append('# TYPE tweetdb_stage_seconds histogram')
+            for (stage, process), histogram in sorted(
+                    self.histograms.items()):
+                labels = 'process="%s",stage="%s"' % (process, stage)
+                n = 0
+                for bound, count in zip(BUCKETS + ('+Inf',),
+                                        histogram.counts):
+                    n += count
+                    lines.append('tweetdb_stage_seconds_bucket{%s,le="%s"} %d'
+                                 % (labels, bound, n))
+                lines.append('tweetdb_stage_seconds_sum{%s} %s' %
+                             (labels, repr(histogram.sum)))
+                lines.append('tweetdb_stage_seconds_count{%s} %d' %
+                             (labels, n))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(HTTPServer):
+    '''
+    Serves a collector's render() to Prometheus (at any path) from a
+    daemon thread
+    '''
+
+    def __init__(self, collector, address):
+        HTTPServer.__init__(self, address, _MetricsHandler)
+        self.collector = collector
+        log.info("Serving metrics on http://%s:%d/metrics." % address)
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='metrics_server')
+        thread.daemon = True
+        thread.start()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.collector.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes aren't worth a line in the log each
+        pass
@@ -0,0 +1,366 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Time partitioned storage for tweets and their child rows."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+Tweet and its child tables (which carry a copy of the tweet's date) can
+be split into one partition per day or week, so indexes stay the size of
+a period and retention is a matter of dropping whole partitions rather
+than deleting rows.
+
+Postgres uses declarative RANGE partitioning on date.  Partitioned
+tables can't have unique keys which don't include the partition key, so
+there the primary keys become (id, date), tweets are upserted on
+(tweetid, date), and there are no foreign keys to or from the
+partitioned tables.  A DEFAULT partition catches rows with no partition.
+
+SQLite has no partitioning, so each period gets a database file of its
+own next to the main one (<db_host>.p<yyyymmdd>, plus <db_host>.default)
+which is ATTACHed to every connection, with TEMP views of the same names
+as the tables gluing the periods together for queries.  Views are read
+only, so writes have to be routed to the right file, which add_tweets
+does.  SQLite can attach at most 10 databases, the default file and one
+left free for retention taking two, so retention plus ahead may be at
+most 8 periods there (six days of tweets with daily periods, two
+ahead); longer windows need weekly periods or Postgres.  Connections are
+replaced once periods are created or dropped, and each period file
+numbers its rows from a range of its own so ids stay unique across the
+views.
+
+Partition names carry the start of their period, eg "Tweet_p20150301" on
+Postgres and "p20150301" as an attached SQLite schema.
+'''
+
+import os
+import glob
+import logging
+from datetime import datetime as dt
+from datetime import timedelta
+from sqlalchemy import MetaData, PrimaryKeyConstraint, UniqueConstraint, \
+    Integer, create_engine
+from sqlalchemy.exc import DisconnectionError
+
+# get rootLogger
+log = logging.getLogger("__name__")
+
+PERIODS = {'day': 1, 'week': 7}
+
+# SQLite's default limit on attached databases
+MAX_ATTACHED = 10
+
+# ids a SQLite period file numbers its rows from, see SQLitePartitions
+EPOCH = dt(1970, 1, 1)
+ID_RANGE = 2 ** 32
+
+
+def _copy_tables(metadata, names, schema=None, referring=None):
+    '''
+    Copies of the named tables in a new MetaData (optionally in another
+    schema), without their foreign keys (or just those to the referring
+    tables), which can't point in or out of partitions
+    '''
+    copies = MetaData()
+    tables = []
+    for name in names:
+        table = metadata.tables[name].tometadata(copies, schema=schema)
+        for constraint in list(table.foreign_key_constraints):
+            target = constraint.elements[0].target_fullname.split('.')[-2]
+            if referring is None or target in referring:
+                table.constraints.discard(constraint)
+                for element in constraint.elements:
+                    element.parent.foreign_keys.discard(element)
+                    table.foreign_keys.discard(element)
+        tables.append(table)
+    return copies, tables
+
+
+class Partitioning(object):
+    '''
+    Period arithmetic shared by both layouts.  ahead is the number of
+    future periods to keep created; with retention only that many periods
+    (including the current one) are kept.
+    '''
+
+    def __init__(self, metadata, tables, period='day', ahead=2,
+                 retention=None):
+        if period not in PERIODS:
+            raise ValueError('Partition period must be one of %s.' %
+                             ', '.join(sorted(PERIODS)))
+        self.metadata = metadata
+        self.tables = tables
+        self.period = period
+        self.ahead = ahead
+        self.retention = retention
+
+    def start(self, date):
+        # start of the period containing date
+        start = dt(date.year, date.month, date.day)
+        if self.period == 'week':
+            start -= timedelta(days=start.weekday())
+        return start
+
+    def next(self, start):
+        return start + timedelta(days=PERIODS[self.period])
+
+    def name(self, start):
+        return 'p' + start.strftime('%Y%m%d')
+
+    def parse(self, name):
+        # start of the period of a partition name, or None
+        try:
+            return dt.strptime(name[name.rindex('p') + 1:], '%Y%m%d')
+        except ValueError:
+            return None
+
+    def span(self, start, stop):
+        # starts of the periods from the one containing start up to stop
+        start = self.start(start)
+        while start <= stop:
+            yield start
+            start = self.next(start)
+
+    def oldest(self, now):
+        # start of the oldest period retention keeps
+        oldest = self.start(now)
+        for i in range(self.retention - 1):
+            oldest = self.start(oldest - timedelta(days=1))
+        return oldest
+
+    def expired(self, engine, now):
+        # starts of partitions which have fallen out of retention
+        if self.retention is None:
+            return []
+        return [start for start in self.periods(engine)
+                if start < self.oldest(now)]
+
+    def close(self, connection, start):
+        pass
+
+
+class PostgresPartitions(Partitioning):
+    def create(self, engine):
+        '''
+        Create the schema with Tweet and its child tables partitioned by
+        date
+        '''
+        others = [table for table in self.metadata.sorted_tables
+                  if table.name not in self.tables]
+        copies, tables = _copy_tables(self.metadata, self.tables)
+        for table in tables:
+            # unique keys have to include the partition key
+            for constraint in list(table.constraints):
+                if isinstance(constraint, UniqueConstraint) and \
+                   not isinstance(constraint, PrimaryKeyConstraint) and \
+                   'date' not in constraint.columns:
+                    table.constraints.discard(constraint)
+            for index in table.indexes:
+                if index.unique and 'date' not in index.columns:
+                    index.unique = False
+            keys = list(table.primary_key.columns)
+            if table.name != 'Tweet':
+                # the surrogate key is still a serial
+                keys[0].autoincrement = True
+            table.append_constraint(PrimaryKeyConstraint(
+                *(keys + [table.c.date])))
+            table.dialect_kwargs['postgresql_partition_by'] = 'RANGE (date)'
+        copies.create_all(engine)
+        for table in tables:
+            engine.execute('CREATE TABLE IF NOT EXISTS "%s_default" '
+                           'PARTITION OF "%s" DEFAULT' %
+                           (table.name, table.name))
+
+        # the rest of the tables, minus their foreign keys to partitions
+        copies, tables = _copy_tables(self.metadata,
+                                      [table.name for table in others],
+                                      referring=self.tables)
+        copies.create_all(engine)
+
+    def ensure(self, engine, start, stop):
+        # create the partitions of the periods from start to stop
+        for period in self.span(start, stop):
+            for name in self.tables:
+                engine.execute('CREATE TABLE IF NOT EXISTS "%s_%s" '
+                               'PARTITION OF "%s" FOR VALUES '
+                               'FROM (\'%s\') TO (\'%s\')' %
+                               (name, self.name(period), name,
+                                period.isoformat(' '),
+                                self.next(period).isoformat(' ')))
+
+    def periods(self, engine):
+        return sorted(set(self.parse(row[0]) for row in engine.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = 'Tweet'")) - set([None]))
+
+    def open(self, connection, start):
+        # the (quoted) Tweet partition of a period, for retention
+        return '"Tweet_%s"' % self.name(start)
+
+    def drop(self, connection, start):
+        for name in self.tables:
+            connection.execute('DROP TABLE IF EXISTS "%s_%s"' %
+                               (name, self.name(start)))
+
+    def default_table(self, name):
+        return '"%s_default"' % name
+
+
+class SQLitePartitions(Partitioning):
+    def __init__(self, metadata, tables, filename, **kwargs):
+        Partitioning.__init__(self, metadata, tables, **kwargs)
+        '''
+        every period retention keeps has to be attached for queries to
+        see it, leaving a slot for the default file and one for retention
+        '''
+        if self.retention is None or \
+           self.retention + self.ahead > MAX_ATTACHED - 2:
+            raise ValueError('SQLite can attach at most %d databases, so '
+                             'partitioning by %s needs a retention of at '
+                             'most %d periods (%d ahead).' %
+                             (MAX_ATTACHED, self.period,
+                              MAX_ATTACHED - 2 - self.ahead, self.ahead))
+        self.filename = filename
+        self.schemas = {}
+
+    def path(self, name):
+        return '%s.%s' % (self.filename, name)
+
+    def create(self, engine):
+        self.metadata.create_all(engine,
+                                 tables=[table for table in
+                                         self.metadata.sorted_tables
+                                         if table.name not in self.tables])
+        self.create_file('default')
+
+    def create_file(self, name):
+        '''
+        Create a period's (or the default) file.  Each has the ids of its
+        rows start from a range of its own, ID_RANGE ids per day since
+        EPOCH (the default's from 0), so they don't collide in the views.
+        '''
+        if os.path.exists(self.path(name)):
+            return
+        copies, tables = _copy_tables(self.metadata, self.tables)
+        counted = []
+        for table in tables:
+            keys = list(table.primary_key.columns)
+            if len(keys) == 1 and type(keys[0].type) is Integer:
+                table.dialect_kwargs['sqlite_autoincrement'] = True
+                counted.append(table.name)
+        first = 0
+        if name != 'default':
+            first = (self.parse(name) - EPOCH).days * ID_RANGE
+        engine = create_engine('sqlite:///' + self.path(name))
+        copies.create_all(engine)
+        if counted:
+            engine.execute('INSERT INTO sqlite_sequence (name, seq) '
+                           'VALUES (?, ?)', [(table, first)
+                                             for table in counted])
+        engine.dispose()
+
+    def ensure(self, engine, start, stop):
+        for period in self.span(start, stop):
+            self.create_file(self.name(period))
+
+    def periods(self, engine):
+        return sorted(set(self.parse(filename) for filename in
+                          glob.glob(self.path('p*'))) - set([None]))
+
+    def names(self):
+        # the default and most recent period files, as connections attach
+        # them (leaving a slot free for retention to attach expired periods)
+        names = ['default'] + [self.name(start) for start in
+                               self.periods(None)[-(MAX_ATTACHED - 2):]]
+        return [name for name in names if os.path.exists(self.path(name))]
+
+    def attach(self, dbapi_connection, connection_record):
+        '''
+        connect event handler: attach the default and most recent period
+        files, and create the views queries read the tables through
+        '''
+        names = self.names()
+        connection_record.info['partitions'] = names
+        cursor = dbapi_connection.cursor()
+        for name in names:
+            cursor.execute('ATTACH DATABASE ? AS "%s"' % name,
+                           (self.path(name),))
+        if names:
+            for table in self.metadata.sorted_tables:
+                if table.name not in self.tables:
+                    continue
+                columns = ', '.join('"%s"' % column.name
+                                    for column in table.columns)
+                cursor.execute('CREATE TEMP VIEW "%s" AS %s' %
+                               (table.name, ' UNION ALL '.join(
+                                   'SELECT %s FROM "%s"."%s"' %
+                                   (columns, name, table.name)
+                                   for name in names)))
+        cursor.close()
+
+    def checkout(self, dbapi_connection, connection_record,
+                 connection_proxy):
+        '''
+        checkout event handler: a connection attaching other files than
+        there now are (roll_partitions has since created or dropped
+        periods, in whichever process) is replaced by a new one
+        '''
+        if connection_record.info.get('partitions') != self.names():
+            raise DisconnectionError('Partitions have changed.')
+
+    def schema_table(self, name, table):
+        # the copy of a table in an attached schema
+        if name not in self.schemas:
+            copies, tables = _copy_tables(self.metadata, self.tables,
+                                          schema=name)
+            self.schemas[name] = dict((copy.name, copy) for copy in tables)
+        return self.schemas[name][table.name]
+
+    def route(self, connection, table, rows):
+        '''
+        Split rows for a partitioned table by period, as (table copy,
+        rows) pairs; rows of periods which aren't attached go to the
+        default partition
+        '''
+        attached = self.attached(connection)
+        routed = {}
+        for row in rows:
+            name = self.name(self.start(row['date']))
+            if name not in attached:
+                name = 'default'
+            routed.setdefault(name, []).append(row)
+        return [(self.schema_table(name, table), rows)
+                for name, rows in routed.items()]
+
+    def attached(self, connection):
+        return set(row[1] for row in
+                   connection.execute('PRAGMA database_list'))
+
+    def open(self, connection, start):
+        '''
+        Attach an expired period to connection (which mustn't be in a
+        transaction) if it isn't already, returning its (quoted) Tweet table
+        '''
+        name = self.name(start)
+        if name not in self.attached(connection):
+            connection.execute('ATTACH DATABASE ? AS "%s"' % name,
+                               self.path(name))
+            self.opened = name
+        return '"%s"."Tweet"' % name
+
+    def close(self, connection, start):
+        if getattr(self, 'opened', None) == self.name(start):
+            connection.execute('DETACH DATABASE "%s"' % self.opened)
+            self.opened = None
+
+    def drop(self, connection, start):
+        # anything which has the file attached keeps it open until closed
+        os.remove(self.path(self.name(start)))
+
+    def default_table(self, name):
+        return '"default"."%s"' % name
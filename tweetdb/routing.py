@@ -0,0 +1,66 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Hash-partitioned routing of tweets to consumers."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+
+def record_key(record, key):
+    # routing key of an encoded (wire format) status
+    if key == 'userid':
+        return record[-1][0]
+    return record[0]
+
+
+def partition(value, n):
+    '''
+    Spread ids evenly over n partitions.  Snowflake tweetids have mostly
+    zero low bits (the sequence number), so this takes the high bits of
+    a multiplicative hash, the low ones being those of the id itself.
+    '''
+    return (((value * 2654435761) & 0xffffffff) >> 16) % n
+
+
+class PartitionedQueue(object):
+    '''
+    Producer side router which splits each batch of encoded statuses
+    across one queue per consumer by a hash of the userid (or tweetid),
+    so that every user (or tweet) is always handled by the same consumer
+    and consumers never race each other to insert it.
+    '''
+
+    def __init__(self, queues, key='userid'):
+        if key not in ('userid', 'tweetid'):
+            raise ValueError('Can only route on userid or tweetid, '
+                             'not \'%s\'.' % key)
+        self.queues = queues
+        self.key = key
+
+    def put(self, batch):
+        parts = [[] for queue in self.queues]
+        for record in batch:
+            parts[partition(record_key(record, self.key),
+                            len(self.queues))].append(record)
+        for queue, part in zip(self.queues, parts):
+            if part:
+                queue.put(part)
+
+    def expire(self):
+        # seal aged spill segments, when the queues spill
+        for queue in self.queues:
+            if hasattr(queue, 'expire'):
+                queue.expire()
+
+    def seal(self):
+        for queue in self.queues:
+            if hasattr(queue, 'seal'):
+                queue.seal()
+
+    def qsizes(self):
+        return [queue.qsize() for queue in self.queues]
+
+    def qsize(self):
+        return sum(self.qsizes())
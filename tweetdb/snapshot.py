@@ -0,0 +1,272 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Columnar NumPy snapshots of tweet data for analysis."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+export_snapshot writes a time range of Tweet, Geotag and Hashtag data to
+a directory of .npy columns, one file per column:
+
+    tweet_date       int64   seconds since the epoch (UTC)
+    tweet_tweetid    int64
+    tweet_userid     int64
+    tweet_lang       int32   code into the 'lang' strings
+    tweet_source     int32   code into the 'source' strings
+    tweet_rtcount    int32
+    tweet_fvcount    int32
+    geotag_tweet     int64   row of the geotagged tweet in the tweet_ columns
+    geotag_latitude  float64
+    geotag_longitude float64
+    hashtag_tweet    int64   row of the tweet in the tweet_ columns
+    hashtag_tag      int32   code into the 'hashtag' strings
+
+Tweets are in (date, tweetid) order.  Strings are dictionary encoded;
+each string table is a uint8 array of utf-8 text and an int64 array of
+offsets into it.  Snapshot opens everything with numpy memory mapping,
+so nothing is read until it's used and columns can be handed straight to
+vectorized numpy code.  Exporting streams rows from the database in
+chunks, so memory stays flat too.
+'''
+
+import os
+import json
+import calendar
+import numpy as np
+from datetime import datetime as dt
+from sqlalchemy import select, func
+from tweetdb import Tweet, Geotag, Hashtag, HashtagLexicon, normalize_lang
+
+TWEET_COLUMNS = (('date', 'int64'), ('tweetid', 'int64'),
+                 ('userid', 'int64'), ('lang', 'int32'),
+                 ('source', 'int32'), ('rtcount', 'int32'),
+                 ('fvcount', 'int32'))
+
+
+class ColumnWriter(object):
+    '''
+    Appends chunks of values to a column whose length isn't known until
+    the end, then writes it out as a .npy file
+    '''
+
+    def __init__(self, filename, dtype):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.data = open(filename + '.tmp', 'wb')
+        self.n = 0
+
+    def append(self, values):
+        np.asarray(values, dtype=self.dtype).tofile(self.data)
+        self.n += len(values)
+
+    def close(self):
+        self.data.close()
+        with open(self.filename, 'wb') as f:
+            np.lib.format.write_array_header_1_0(
+                f, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                    'fortran_order': False, 'shape': (self.n,)})
+            with open(self.filename + '.tmp', 'rb') as data:
+                while True:
+                    block = data.read(2 ** 20)
+                    if not block:
+                        break
+                    f.write(block)
+        os.remove(self.filename + '.tmp')
+
+
+class StringTableWriter(object):
+    # dictionary encoder for one string table
+    def __init__(self):
+        self.codes = {}
+        self.texts = []
+
+    def code(self, text):
+        code = self.codes.get(text)
+        if code is None:
+            code = self.codes[text] = len(self.texts)
+            self.texts.append(text)
+        return code
+
+    def save(self, path, name):
+        data = [(text or u'').encode('utf-8') for text in self.texts]
+        offsets = np.zeros(len(data) + 1, dtype='int64')
+        np.cumsum([len(text) for text in data], out=offsets[1:])
+        np.save(os.path.join(path, 'strings_%s_offsets.npy' % name), offsets)
+        np.save(os.path.join(path, 'strings_%s_data.npy' % name),
+                np.frombuffer(''.join(data), dtype='uint8'))
+
+
+def _timestamp(date):
+    return calendar.timegm(date.utctimetuple())
+
+
+def _stream(session, query, chunk_size):
+    # the rows of query in chunks, from a server-side cursor
+    result = session.execute(query.execution_options(stream_results=True))
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def _window(query, start, stop, lang):
+    query = query.where(Tweet.date >= start).where(Tweet.date <= stop)
+    if lang is not None:
+        query = query.where(Tweet.lang == normalize_lang(lang))
+    return query
+
+
+def export_snapshot(session, path, start, stop=None, lang=None,
+                    chunk_size=100000):
+    '''
+    Write the tweets (and their geotags and hashtags) from start to stop,
+    of one language or all of them, as a snapshot in directory path.
+    Returns the number of tweets written.
+    '''
+    if stop is None:
+        stop = dt.utcnow()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    strings = {'lang': StringTableWriter(),
+               'source': StringTableWriter(),
+               'hashtag': StringTableWriter()}
+
+    columns = dict((name, ColumnWriter(os.path.join(path, 'tweet_%s.npy' %
+                                                    name), dtype))
+                   for name, dtype in TWEET_COLUMNS)
+    query = _window(select([Tweet.date, Tweet.tweetid, Tweet.userid,
+                            Tweet.lang, Tweet.source, Tweet.rtcount,
+                            Tweet.fvcount]), start, stop, lang).\
+        order_by(Tweet.date, Tweet.tweetid)
+    for rows in _stream(session, query, chunk_size):
+        columns['date'].append([_timestamp(row[0]) for row in rows])
+        columns['tweetid'].append([row[1] for row in rows])
+        columns['userid'].append([row[2] for row in rows])
+        columns['lang'].append([strings['lang'].code(row[3])
+                                for row in rows])
+        columns['source'].append([strings['source'].code(row[4])
+                                  for row in rows])
+        columns['rtcount'].append([row[5] or 0 for row in rows])
+        columns['fvcount'].append([row[6] or 0 for row in rows])
+    for column in columns.values():
+        column.close()
+    n_tweets = columns['tweetid'].n
+
+    '''
+    child rows are written with their tweetid first, then turned into row
+    numbers in the tweet columns with a vectorized search.  Any child rows
+    of tweets which arrived after the tweets were exported are dropped.
+    '''
+    tweetids = np.load(os.path.join(path, 'tweet_tweetid.npy'))
+    order = np.argsort(tweetids)
+    sortedids = tweetids[order]
+
+    def tweet_rows(table, names):
+        filename = os.path.join(path, '%s_tweet.npy' % table)
+        ids = np.load(filename)
+        last = max(len(sortedids) - 1, 0)
+        pos = np.searchsorted(sortedids, ids).clip(0, last)
+        found = sortedids[pos] == ids if len(sortedids) else \
+            np.zeros(len(ids), dtype=bool)
+        np.save(filename, order[pos[found]].astype('int64'))
+        if not found.all():
+            for name in names:
+                filename = os.path.join(path, '%s_%s.npy' % (table, name))
+                np.save(filename, np.load(filename)[found])
+        return int(found.sum())
+
+    geotags = [ColumnWriter(os.path.join(path, 'geotag_%s.npy' % name),
+                            'float64' if name != 'tweet' else 'int64')
+               for name in ('tweet', 'latitude', 'longitude')]
+    query = _window(select([Geotag.tweetid, Geotag.latitude,
+                            Geotag.longitude]).
+                    where(Geotag.tweetid == Tweet.tweetid),
+                    start, stop, lang)
+    for rows in _stream(session, query, chunk_size):
+        for idx, column in enumerate(geotags):
+            column.append([row[idx] for row in rows])
+    for column in geotags:
+        column.close()
+    n_geotags = tweet_rows('geotag', ('latitude', 'longitude'))
+
+    hashtags = [ColumnWriter(os.path.join(path, 'hashtag_tweet.npy'),
+                             'int64'),
+                ColumnWriter(os.path.join(path, 'hashtag_tag.npy'), 'int32')]
+    query = _window(select([Hashtag.tweetid, HashtagLexicon.hashtagtext]).
+                    where(Hashtag.tweetid == Tweet.tweetid).
+                    where(Hashtag.hashtagid == HashtagLexicon.hashtagid),
+                    start, stop, lang)
+    for rows in _stream(session, query, chunk_size):
+        hashtags[0].append([row[0] for row in rows])
+        hashtags[1].append([strings['hashtag'].code(row[1])
+                            for row in rows])
+    for column in hashtags:
+        column.close()
+    n_hashtags = tweet_rows('hashtag', ('tag',))
+
+    for name, table in strings.items():
+        table.save(path, name)
+    with open(os.path.join(path, 'snapshot.json'), 'w') as f:
+        json.dump({'start': start.isoformat(), 'stop': stop.isoformat(),
+                   'lang': lang, 'tweets': n_tweets, 'geotags': n_geotags,
+                   'hashtags': n_hashtags,
+                   'created': dt.utcnow().isoformat()}, f, indent=2)
+    return n_tweets
+
+
+class StringTable(object):
+    # read side of a dictionary encoded string table
+    def __init__(self, path, name):
+        self.data = np.load(os.path.join(path, 'strings_%s_data.npy' % name),
+                            mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'strings_%s_offsets.npy' %
+                                            name), mmap_mode='r')
+        self.codes = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, code):
+        return self.data[self.offsets[code]:self.offsets[code + 1]].\
+            tostring().decode('utf-8')
+
+    def code(self, text):
+        # the code of text, or -1 if it isn't in the table
+        if self.codes is None:
+            self.codes = dict((self[code], code)
+                              for code in range(len(self)))
+        return self.codes.get(text, -1)
+
+    def decode(self, codes):
+        return [self[code] for code in codes]
+
+
+class Snapshot(object):
+    '''
+    A snapshot written by export_snapshot.  Columns are memory mapped
+    numpy arrays, eg snapshot['tweet_date'], and string tables are
+    snapshot.strings['lang'], ['source'] and ['hashtag'].
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'snapshot.json')) as f:
+            self.meta = json.load(f)
+        self.columns = {}
+        self.strings = dict((name, StringTable(path, name))
+                            for name in ('lang', 'source', 'hashtag'))
+
+    def __getitem__(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = \
+                np.load(os.path.join(self.path, name + '.npy'),
+                        mmap_mode='r')
+        return column
+
+    def __len__(self):
+        return self.meta['tweets']
@@ -0,0 +1,209 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Disk-backed overflow for the tweet queue."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+When consumers fall behind the in-memory queue fills up and the stream
+listener blocks, which stalls (and eventually disconnects) the Twitter
+stream.  SpillQueue lets the producer side overflow into append-only
+segment files instead, which consumers claim and replay in order.
+
+Segment files move through these states, by atomic rename:
+
+    <stamp>-<pid>-<seq>.open          being written by a producer
+    <stamp>-<pid>-<seq>.seg           sealed, waiting to be replayed
+    <stamp>-<pid>-<seq>.seg.<pid>     claimed by a consumer
+
+and are deleted once everything in them has been committed.  Each
+record is a 4 byte length followed by a pickled batch of statuses.
+'''
+
+import os
+import time
+import mmap
+import glob
+import struct
+import cPickle
+import logging
+from Queue import Full
+
+# get rootLogger
+log = logging.getLogger("__name__")
+
+HEADER = struct.Struct('<I')
+
+
+def recover_spill(path):
+    '''
+    Return segments left open by a dead producer or claimed by a dead
+    consumer to the pool of sealed segments.  Only call this while no
+    producers or consumers are running.  Returns the number of segments
+    waiting to be replayed.
+    '''
+    if not os.path.isdir(path):
+        return 0
+    for filename in glob.glob(os.path.join(path, '*.open')):
+        os.rename(filename, filename[:-len('.open')] + '.seg')
+    for filename in glob.glob(os.path.join(path, '*.seg.*')):
+        os.rename(filename, filename[:filename.rindex('.seg.') + 4])
+    return pending_segments(path)
+
+
+def pending_segments(path):
+    # number of segments not yet fully replayed and committed
+    return len(glob.glob(os.path.join(path, '*.seg*')))
+
+
+class SpillQueue(object):
+    '''
+    Producer side wrapper around a multiprocessing Queue.  put() never
+    blocks: once the queue is full batches are appended to a segment file
+    until it reaches segment_size bytes or segment_age seconds, at which
+    point it is sealed and the in-memory queue is tried again.
+    '''
+
+    def __init__(self, queue, path, segment_size=64 * 2 ** 20,
+                 segment_age=10):
+        self.queue = queue
+        self.path = path
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.segment = None
+        self.n_spilled = 0
+        self.seq = 0
+
+    def put(self, batch):
+        if self.segment is None:
+            try:
+                self.queue.put_nowait(batch)
+                return
+            except Full:
+                self.open_segment()
+        data = cPickle.dumps(batch, cPickle.HIGHEST_PROTOCOL)
+        self.segment.write(HEADER.pack(len(data)))
+        self.segment.write(data)
+        self.n_spilled += len(batch)
+        if self.segment.tell() > self.segment_size:
+            self.seal()
+        else:
+            self.expire()
+
+    def expire(self):
+        '''
+        Seal the segment once it is segment_age seconds old.  put() checks
+        this itself, but the producer should also call it while the stream
+        is quiet, or the segment can't be replayed until it next puts.
+        '''
+        if self.segment is not None and \
+           time.time() - self.opened > self.segment_age:
+            self.seal()
+
+    def open_segment(self):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # another producer got there first
+                pass
+        self.seq += 1
+        self.filename = os.path.join(self.path, '%020d-%d-%d.open' %
+                                     (int(time.time() * 1e6), os.getpid(),
+                                      self.seq))
+        self.segment = open(self.filename, 'ab')
+        self.opened = time.time()
+        log.info('Queue full, spilling tweets to \'%s\'.' % self.filename)
+
+    def seal(self):
+        if self.segment is not None:
+            self.segment.close()
+            os.rename(self.filename,
+                      self.filename[:-len('.open')] + '.seg')
+            self.segment = None
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class SpillReader(object):
+    '''
+    Consumer side of the spill: claims sealed segments (oldest first) and
+    hands back their batches in order.  Segments which have been read to
+    the end are only deleted by release(), which the consumer calls once
+    it has committed everything it took from them.
+    '''
+
+    def __init__(self, path, poll_interval=1):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.last_poll = 0
+        self.filename = None
+        self.finished = []
+        self.n_replayed = 0
+
+    def claim(self):
+        # claim the oldest sealed segment, if there is one
+        self.last_poll = time.time()
+        for filename in sorted(glob.glob(os.path.join(self.path, '*.seg'))):
+            claimed = '%s.%d' % (filename, os.getpid())
+            try:
+                os.rename(filename, claimed)
+            except OSError:
+                # another consumer got it first
+                continue
+            self.filename = claimed
+            with open(claimed, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    self.data = ''
+                else:
+                    self.data = mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+            self.offset = 0
+            return True
+        return False
+
+    def next_batch(self, claim=True):
+        '''
+        The next spilled batch, or None if there's nothing to replay.
+        Without claim only the segment being replayed is read.
+        '''
+        if self.filename is None:
+            if not claim or \
+               time.time() - self.last_poll < self.poll_interval or \
+               not self.claim():
+                return None
+        while True:
+            end = self.offset + HEADER.size
+            if end <= len(self.data):
+                length = HEADER.unpack(self.data[self.offset:end])[0]
+                if end + length <= len(self.data):
+                    batch = cPickle.loads(self.data[end:end + length])
+                    self.offset = end + length
+                    self.n_replayed += len(batch)
+                    return batch
+            # end of the segment (or a record truncated by a crash)
+            if self.data:
+                self.data.close()
+            self.finished.append(self.filename)
+            self.filename = None
+            if not claim or not self.claim():
+                return None
+
+    def take_finished(self):
+        # segments read to the end, for the caller to release when committed
+        filenames, self.finished = self.finished, []
+        return filenames
+
+    def release(self, filenames=None):
+        '''
+        Delete segments whose contents have all been committed: filenames
+        (taken with take_finished), or all those read to the end
+        '''
+        if filenames is None:
+            filenames = self.take_finished()
+        for filename in filenames:
+            os.remove(filename)
@@ -0,0 +1,205 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Scales the number of tweet consumers with the load."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+ConsumerSupervisor keeps between min_consumers and max_consumers
+consumers running on a shared queue.  Every interval seconds it samples
+the queue depth and, from the consumers' metrics, their throughput and
+the mean commit latency:
+
+  - a backlog (depth at least high_depth) for up_samples samples in a
+    row adds a consumer, unless commits are taking over max_commit_ms,
+    when the database rather than the consumers is the bottleneck and
+    another writer would only make things worse
+  - an all but empty queue (depth at most low_depth) for down_samples
+    samples in a row retires a consumer, provided one fewer could keep
+    up: the busiest a consumer has been seen to be while there was a
+    backlog is taken as its capacity, and the rest have to be able to
+    carry the current load within headroom of theirs
+
+The gap between the depth thresholds, the longer run needed to scale
+down and the cooldown after every change keep the supervisor from
+flapping.  A retired consumer finishes what it has taken off the queue
+before exiting, and consumers which die are replaced.
+'''
+
+import time
+import logging
+from multiprocessing import Event
+
+# get rootLogger
+log = logging.getLogger("__name__")
+
+# counters of the tweets a consumer has dealt with
+THROUGHPUT_COUNTERS = ('tweets_new', 'tweets_duplicate', 'tweets_handed_over')
+
+
+class ConsumerSupervisor(object):
+    '''
+    start_consumer(name, stop_event) starts a consumer and returns it;
+    collector is the MetricsCollector the consumers publish to
+    '''
+
+    def __init__(self, start_consumer, queue, collector, min_consumers=1,
+                 max_consumers=4, interval=10, high_depth=50, low_depth=2,
+                 max_commit_ms=1000, up_samples=3, down_samples=6,
+                 cooldown=60, headroom=0.8):
+        self.start_consumer = start_consumer
+        self.queue = queue
+        self.collector = collector
+        self.min_consumers = min_consumers
+        self.max_consumers = max(max_consumers, min_consumers)
+        self.interval = interval
+        self.high_depth = high_depth
+        self.low_depth = low_depth
+        self.max_commit_ms = max_commit_ms
+        self.up_samples = up_samples
+        self.down_samples = down_samples
+        self.cooldown = cooldown
+        self.headroom = headroom
+
+        # running consumers as (consumer, stop event), oldest first
+        self.consumers = []
+        self.retiring = []
+        self.n_started = 0
+
+        self.capacity = None
+        self.up_streak = 0
+        self.down_streak = 0
+        self.held = False
+        self.last_change = 0
+        self.last_sample = time.time()
+        self.last_totals = collector.totals()
+
+    def start(self, num_consumers):
+        num_consumers = min(max(num_consumers, self.min_consumers),
+                            self.max_consumers)
+        log.info('Autoscaling from %d consumers, between %d and %d.' %
+                 (num_consumers, self.min_consumers, self.max_consumers))
+        for i in range(num_consumers):
+            self.add()
+
+    def add(self):
+        stop_event = Event()
+        consumer = self.start_consumer('consumer_%d' % self.n_started,
+                                       stop_event)
+        self.n_started += 1
+        self.consumers.append((consumer, stop_event))
+
+    def remove(self):
+        # the newest consumer has the coldest caches
+        consumer, stop_event = self.consumers.pop()
+        stop_event.set()
+        self.retiring.append(consumer)
+        log.info('Asked %s to retire.' % consumer.name)
+
+    def step(self, now=None):
+        '''
+        Called regularly from the main loop; samples and decides every
+        interval seconds
+        '''
+        if now is None:
+            now = time.time()
+        self.reap()
+        if now - self.last_sample < self.interval:
+            return
+        self.decide(self.sample(now), now)
+
+    def reap(self):
+        # forget retired consumers which have exited, replace dead ones
+        for consumer in self.retiring:
+            if not consumer.is_alive():
+                log.info('%s retired.' % consumer.name)
+        self.retiring = [consumer for consumer in self.retiring
+                         if consumer.is_alive()]
+        for consumer, stop_event in list(self.consumers):
+            if not consumer.is_alive():
+                log.error('%s exited unexpectedly (exit code %s), '
+                          'replacing it.' % (consumer.name,
+                                             consumer.exitcode))
+                self.consumers.remove((consumer, stop_event))
+                self.add()
+
+    def sample(self, now):
+        '''
+        The queue depth, the tweets/second per running consumer and the
+        mean commit latency (ms) since the last sample
+        '''
+        totals = self.collector.totals()
+        elapsed = now - self.last_sample
+        names = set(consumer.name for consumer, stop_event in self.consumers)
+        n_tweets, n_commits, commit_time = 0, 0, 0
+        for process, total in totals.items():
+            last = self.last_totals.get(process, {'counters': {},
+                                                  'stages': {}})
+            if process in names:
+                n_tweets += sum(total['counters'].get(name, 0) -
+                                last['counters'].get(name, 0)
+                                for name in THROUGHPUT_COUNTERS)
+            count, seconds = total['stages'].get('commit', (0, 0))
+            last_count, last_seconds = last['stages'].get('commit', (0, 0))
+            n_commits += count - last_count
+            commit_time += seconds - last_seconds
+        self.last_totals = totals
+        self.last_sample = now
+        return {'depth': self.queue.qsize(),
+                'consumers': len(self.consumers),
+                'tweets_per_consumer': n_tweets / elapsed /
+                max(len(self.consumers), 1),
+                'commit_ms': 1000 * commit_time / n_commits
+                if n_commits else 0}
+
+    def decide(self, sample, now):
+        n = len(self.consumers)
+        backlog = sample['depth'] >= self.high_depth
+        if backlog:
+            # with a backlog the consumers are as busy as they can be
+            self.capacity = max(self.capacity or 0,
+                                sample['tweets_per_consumer'])
+
+        up = backlog and n < self.max_consumers
+        if up and sample['commit_ms'] > self.max_commit_ms:
+            if not self.held:
+                log.info('Not adding consumers to a backlog of %d while '
+                         'commits take %.1f ms.' %
+                         (sample['depth'], sample['commit_ms']))
+            self.held = True
+            up = False
+        else:
+            self.held = False
+
+        down = sample['depth'] <= self.low_depth and n > self.min_consumers
+        if down and self.capacity is not None:
+            load = sample['tweets_per_consumer'] * n
+            down = load <= self.capacity * self.headroom * (n - 1)
+
+        self.up_streak = self.up_streak + 1 if up else 0
+        self.down_streak = self.down_streak + 1 if down else 0
+        if now - self.last_change < self.cooldown:
+            return
+        if self.up_streak >= self.up_samples:
+            log.info('Scaling up to %d consumers: queue depth %d, %.1f '
+                     'tweets/second per consumer, commits taking %.1f ms.' %
+                     (n + 1, sample['depth'],
+                      sample['tweets_per_consumer'], sample['commit_ms']))
+            self.add()
+        elif self.down_streak >= self.down_samples:
+            log.info('Scaling down to %d consumers: queue depth %d, %.1f '
+                     'tweets/second per consumer (capacity %s), commits '
+                     'taking %.1f ms.' %
+                     (n - 1, sample['depth'],
+                      sample['tweets_per_consumer'],
+                      'unknown' if self.capacity is None else
+                      '%.1f' % self.capacity, sample['commit_ms']))
+            self.remove()
+        else:
+            return
+        self.last_change = now
+        self.up_streak = 0
+        self.down_streak = 0
@@ -0,0 +1,325 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "In-memory trending hashtags and words over sliding windows."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+"What's trending in the last few minutes" shouldn't need the database.
+Consumers post the hashtags and words of each new tweet to a TrendServer
+process, which keeps a Space-Saving summary per time slice, language and
+kind (hashtag/word), so memory is bounded by the summary capacity
+whatever the stream looks like.  Queries come in over a
+multiprocessing.connection socket.
+
+Space-Saving (Metwally et al.) keeps capacity counters; an item which
+isn't counted takes over the smallest counter, inheriting its count as
+its error.  Every item with a true count over n/capacity is kept, and an
+item's true count lies between count - error and count.  Counters are
+kept in a "stream summary", a linked list of buckets of equal count, so
+both counting and reading off the top k are O(1) per item.
+'''
+
+import time
+import heapq
+import logging
+import calendar
+import threading
+from itertools import islice
+from multiprocessing import Process
+from multiprocessing.connection import Listener, Client
+from Queue import Empty, Full
+
+# get rootLogger
+log = logging.getLogger("__name__")
+
+
+class _Bucket(object):
+    # the items with a given count, in a list ordered by count
+    __slots__ = ('count', 'items', 'prev', 'next')
+
+    def __init__(self, count, prev, next):
+        self.count = count
+        self.items = set()
+        self.prev = prev
+        self.next = next
+
+
+class SpaceSaving(object):
+    '''
+    Space-Saving heavy hitters summary of at most capacity items
+    '''
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.buckets = {}
+        self.errors = {}
+        self.lowest = None
+        self.highest = None
+        self.n = 0
+
+    def add(self, item):
+        self.n += 1
+        bucket = self.buckets.get(item)
+        if bucket is None:
+            if len(self.buckets) < self.capacity:
+                self.errors[item] = 0
+            else:
+                # take over the counter of an item with the lowest count
+                bucket = self.lowest
+                victim = bucket.items.pop()
+                bucket.items.add(item)
+                del self.buckets[victim]
+                del self.errors[victim]
+                self.errors[item] = bucket.count
+        self.increment(item, bucket)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def increment(self, item, bucket):
+        # move item from bucket (None for a new item) to the next count up
+        if bucket is None:
+            prev, after, count = None, self.lowest, 1
+        else:
+            prev, after, count = bucket, bucket.next, bucket.count + 1
+        if after is None or after.count != count:
+            after = _Bucket(count, prev, after)
+            if after.prev is None:
+                self.lowest = after
+            else:
+                after.prev.next = after
+            if after.next is None:
+                self.highest = after
+            else:
+                after.next.prev = after
+        after.items.add(item)
+        self.buckets[item] = after
+        if bucket is not None:
+            bucket.items.discard(item)
+            if not bucket.items:
+                self.unlink(bucket)
+
+    def unlink(self, bucket):
+        if bucket.prev is None:
+            self.lowest = bucket.next
+        else:
+            bucket.prev.next = bucket.next
+        if bucket.next is None:
+            self.highest = bucket.prev
+        else:
+            bucket.next.prev = bucket.prev
+
+    def full(self):
+        return len(self.buckets) >= self.capacity
+
+    def minimum(self):
+        # the most an item which isn't counted could have been seen
+        return self.lowest.count if self.full() else 0
+
+    def count(self, item):
+        bucket = self.buckets.get(item)
+        if bucket is None:
+            return self.minimum(), self.minimum()
+        return bucket.count, self.errors[item]
+
+    def top(self, k):
+        # the k most frequent items as (item, count, error), in O(k)
+        result = []
+        bucket = self.highest
+        while bucket is not None and len(result) < k:
+            result.extend((item, bucket.count, self.errors[item])
+                          for item in islice(bucket.items,
+                                             k - len(result)))
+            bucket = bucket.prev
+        return result
+
+    def items(self):
+        for item, bucket in self.buckets.iteritems():
+            yield item, bucket.count, self.errors[item]
+
+
+class TrendWindow(object):
+    '''
+    Space-Saving summaries by (kind, language) for each slice_length
+    second slice of the last window seconds
+    '''
+
+    def __init__(self, capacity=1000, slice_length=60, window=3600):
+        self.capacity = capacity
+        self.slice_length = slice_length
+        self.window = window
+        self.slices = {}
+
+    def start(self, timestamp):
+        return int(timestamp // self.slice_length) * self.slice_length
+
+    def add(self, kind, lang, timestamp, items):
+        start = self.start(timestamp)
+        if start < self.start(time.time() - self.window):
+            # too old to ever be asked about
+            return
+        summaries = self.slices.setdefault(start, {})
+        summary = summaries.get((kind, lang))
+        if summary is None:
+            summary = summaries[(kind, lang)] = SpaceSaving(self.capacity)
+        summary.update(items)
+
+    def expire(self, now):
+        oldest = self.start(now - self.window)
+        for start in [start for start in self.slices if start < oldest]:
+            del self.slices[start]
+
+    def top(self, kind, lang, seconds, k, now=None):
+        '''
+        The k most frequent items of the slices covering the last seconds,
+        as (item, count, error).  A single slice is read directly;
+        otherwise the slices' summaries are merged, with an item missing
+        from a full summary counted (and its error raised) by that
+        summary's minimum.
+        '''
+        if now is None:
+            now = time.time()
+        first = self.start(now - seconds)
+        summaries = [slices[(kind, lang)]
+                     for start, slices in self.slices.iteritems()
+                     if start >= first and (kind, lang) in slices]
+        if not summaries:
+            return []
+        if len(summaries) == 1:
+            return summaries[0].top(k)
+
+        counts, errors = {}, {}
+        for summary in summaries:
+            for item, count, error in summary.items():
+                counts[item] = counts.get(item, 0) + count
+                errors[item] = errors.get(item, 0) + error
+        for summary in summaries:
+            minimum = summary.minimum()
+            if minimum:
+                for item in counts:
+                    if item not in summary.buckets:
+                        counts[item] += minimum
+                        errors[item] += minimum
+        return [(item, count, errors[item]) for item, count in
+                heapq.nlargest(k, counts.iteritems(), key=lambda x: x[1])]
+
+
+class TrendFeed(object):
+    '''
+    Consumer side: collects the hashtags and words of newly written tweets
+    and posts them to the TrendServer's queue.  Never blocks ingest; if
+    the server falls behind events are dropped.
+    '''
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.events = []
+        self.n_dropped = 0
+
+    def add(self, created_at, lang, hashtags, words):
+        self.events.append((calendar.timegm(created_at.utctimetuple()),
+                            lang, hashtags, words))
+
+    def flush(self):
+        if self.events:
+            try:
+                self.queue.put_nowait(self.events)
+            except Full:
+                self.n_dropped += len(self.events)
+            self.events = []
+
+
+class TrendServer(Process):
+    '''
+    Keeps the trend summaries, fed from queue by the consumers' TrendFeeds,
+    and answers query_trends calls at address.  Connections exchange
+    pickles, which can run code when loaded, so clients have to
+    authenticate with authkey.
+    '''
+
+    def __init__(self, queue, address, authkey, capacity=1000,
+                 slice_length=60, window=3600, log_interval=20, name=None):
+        if not authkey:
+            raise ValueError('The trend server needs an authkey.')
+        Process.__init__(self, name=name)
+        log.info("Starting trend server on %s:%d." % address)
+        self.daemon = True
+        self.queue = queue
+        self.address = address
+        self.authkey = authkey
+        self.capacity = capacity
+        self.slice_length = slice_length
+        self.window = window
+        self.log_interval = log_interval
+
+    def run(self):
+        self.trends = TrendWindow(self.capacity, self.slice_length,
+                                  self.window)
+        self.lock = threading.Lock()
+        listener = Listener(self.address, authkey=self.authkey)
+        thread = threading.Thread(target=self.serve, args=(listener,))
+        thread.daemon = True
+        thread.start()
+
+        n_tweets = 0
+        last_log = time.time()
+        while True:
+            try:
+                events = self.queue.get(True, 1)
+            except Empty:
+                events = []
+            with self.lock:
+                for timestamp, lang, hashtags, words in events:
+                    self.trends.add('hashtag', lang, timestamp, hashtags)
+                    self.trends.add('word', lang, timestamp, words)
+                self.trends.expire(time.time())
+            n_tweets += len(events)
+            if time.time() - last_log > self.log_interval:
+                log.info("Counting trends of %f tweets/second." %
+                         (n_tweets / (time.time() - last_log)))
+                n_tweets = 0
+                last_log = time.time()
+
+    def serve(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                log.error('Trend server connection failed: %s' % str(e))
+                continue
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        # answer (kind, lang, seconds, k) queries until the client hangs up
+        try:
+            while True:
+                kind, lang, seconds, k = conn.recv()
+                with self.lock:
+                    result = self.trends.top(kind, lang, seconds, k)
+                conn.send(result)
+        except (EOFError, IOError):
+            pass
+        finally:
+            conn.close()
+
+
+def query_trends(address, authkey, kind, lang, seconds, k=10):
+    '''
+    The top k hashtags or words (kind) of a language over the last seconds
+    from the TrendServer at address, as (item, count, error)
+    '''
+    if not authkey:
+        raise ValueError('Querying the trend server needs its authkey.')
+    conn = Client(address, authkey=authkey)
+    try:
+        conn.send((kind, lang, seconds, k))
+        return conn.recv()
+    finally:
+        conn.close()
@@ -11,22 +11,38 @@ import tweepy
 import pickle
 import urllib3
 import certifi
-import zlib
 import logging
 import requests
-import md5
 import os
 import re
+import time
+from cStringIO import StringIO
+from collections import deque
 from multiprocessing import Process
+from Queue import Empty
 from yaml import load
 from datetime import datetime as dt
-from sqlalchemy import create_engine, ForeignKey
+from sqlalchemy import create_engine, ForeignKey, select, bindparam, \
+    literal_column, inspect, func, event, or_, false
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy import Column, DateTime, Integer, String, Boolean, BigInteger, \
-    Float, Binary
+    Float, Binary, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from cache import LexiconCache, UserCache, chunks
+from mediafetch import MediaFetcher, ImageStore, fetch_image, remove_files
+from wire import encode, decode
+from spill import SpillQueue, SpillReader, recover_spill, pending_segments
+from routing import PartitionedQueue
+from words import TweetTokenizer
+from trending import TrendFeed, TrendServer
+from geogrid import geo_cell
+from partitions import PostgresPartitions, SQLitePartitions
+from metrics import metrics, MetricsCollector, MetricsServer
+from engines import TimedQueuePool, pool_options, guard_fork, \
+    sqlite_pragmas
 
 
 # set up the sql base
@@ -35,6 +51,22 @@ Base = declarative_base()
 # get rootLogger
 log = logging.getLogger("__name__")
 
+# compiled equivalent of tweet_words used by the ingest paths
+tokenizer = TweetTokenizer()
+
+# tables which can be partitioned by date, see partitions
+PARTITIONED_TABLES = ['Tweet', 'Hashtag', 'Mention', 'URLData', 'Geotag',
+                      'TweetWord']
+
+# partitioning of the engines we've set up, by url
+partitionings = {}
+
+# this process's engines by (url, echo, process id), see engines
+engines = {}
+
+# database logins read so far, by login file
+logins = {}
+
 
 def read_parmdata(parmfile):
     # parse a YAML parameter file
@@ -50,16 +82,68 @@ def get_oauth(parmdata):
     return auth
     
 
-def get_sql_engine(parmdata, echo=False):
+def get_sql_url(parmdata):
     if parmdata['database']['db_type'].upper() == 'SQLITE':
-        arg = 'sqlite:///' + parmdata['database']['db_host']
+        return 'sqlite:///' + parmdata['database']['db_host']
     elif parmdata['database']['db_type'].upper() == 'POSTGRES':
-        dblogin = pickle.load(open(parmdata['database']['db_login'], 'rb'))
-        arg = 'postgresql://' + dblogin['username'] + ':' + \
-              dblogin['password'] + '@' \
-              + parmdata['database']['db_host'] \
-              + '/' + parmdata['database']['db_name']
-    return create_engine(arg, echo=echo)
+        if parmdata['database']['db_login'] not in logins:
+            logins[parmdata['database']['db_login']] = \
+                pickle.load(open(parmdata['database']['db_login'], 'rb'))
+        dblogin = logins[parmdata['database']['db_login']]
+        return 'postgresql://' + dblogin['username'] + ':' + \
+            dblogin['password'] + '@' \
+            + parmdata['database']['db_host'] \
+            + '/' + parmdata['database']['db_name']
+
+
+def get_sql_engine(parmdata, echo=False):
+    '''
+    The engine (and connection pool) of parmdata's database, created on
+    first use and shared by everything in this process afterwards.  A
+    forked process gets an engine of its own, see engines.
+    '''
+    arg = get_sql_url(parmdata)
+    key = (arg, echo, os.getpid())
+    if key in engines:
+        return engines[key]
+    engine = create_engine(arg, echo=echo,
+                           **pool_options(arg, parmdata['settings'].
+                                          get('pool') or {}))
+    guard_fork(engine)
+
+    '''
+    with a partitioning section Tweet and its child tables are split up
+    by date, see partitions
+    '''
+    partdata = parmdata['settings'].get('partitioning')
+    if partdata is not None:
+        partitioning = partitionings.get(str(engine.url))
+        kwargs = dict(period=partdata.get('period', 'day'),
+                      ahead=partdata.get('ahead', 2),
+                      retention=partdata.get('retention'))
+        if engine.dialect.name == 'sqlite':
+            if partitioning is None:
+                partitioning = SQLitePartitions(Base.metadata,
+                                                PARTITIONED_TABLES,
+                                                parmdata['database']
+                                                ['db_host'], **kwargs)
+            event.listen(engine, 'connect', partitioning.attach)
+            event.listen(engine, 'checkout', partitioning.checkout)
+        elif partitioning is None:
+            partitioning = PostgresPartitions(Base.metadata,
+                                              PARTITIONED_TABLES, **kwargs)
+        partitionings[str(engine.url)] = partitioning
+
+    # with an sqlite section, tune SQLite (once any partitions are attached)
+    sqlitedata = parmdata['settings'].get('sqlite')
+    if sqlitedata is not None and engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', sqlite_pragmas(sqlitedata))
+    engines[key] = engine
+    return engine
+
+
+def get_partitioning(bind):
+    return partitionings.get(str(bind.url))
 
 
 def get_sql_session(parmdata, echo=False):
@@ -70,7 +154,186 @@ def get_sql_session(parmdata, echo=False):
 
 def create_tables(engine):
     log.info('Creating database tables.')
-    Base.metadata.create_all(engine)
+    partitioning = get_partitioning(engine)
+    if partitioning is None:
+        Base.metadata.create_all(engine)
+    else:
+        log.info('Partitioning tweets by %s.' % partitioning.period)
+        partitioning.create(engine)
+        roll_partitions(engine)
+
+
+def roll_partitions(engine, now=None):
+    '''
+    Create the partitions of the current and next few periods, and drop
+    any which have fallen out of retention (first releasing the images of
+    their tweets).  Rows older than retention are also cleared out of the
+    default partition.
+    '''
+    partitioning = get_partitioning(engine)
+    if partitioning is None:
+        return
+    if now is None:
+        now = dt.utcnow()
+    stop = now
+    for i in range(partitioning.ahead):
+        stop = partitioning.next(partitioning.start(stop))
+    partitioning.ensure(engine, now, stop)
+    if partitioning.retention is None:
+        return
+
+    Session = sessionmaker()
+    for start in partitioning.expired(engine, now):
+        log.info('Dropping tweets partition %s.' % partitioning.name(start))
+        connection = engine.connect()
+        try:
+            table = partitioning.open(connection, start)
+            session = Session(bind=connection)
+            release_media(session, [row[0] for row in session.execute(
+                'SELECT DISTINCT m.tweetid FROM "Media" m '
+                'JOIN %s t ON t.tweetid = m.tweetid' % table)])
+            session.commit()
+            session.close()
+            partitioning.close(connection, start)
+            partitioning.drop(connection, start)
+        except Exception as e:
+            log.error('Failed to drop partition %s: %s' %
+                      (partitioning.name(start), str(e)))
+        finally:
+            connection.close()
+
+    cutoff = partitioning.oldest(now)
+    session = Session(bind=engine)
+    try:
+        release_media(session, [row[0] for row in session.execute(
+            'SELECT DISTINCT m.tweetid FROM "Media" m '
+            'JOIN %s t ON t.tweetid = m.tweetid WHERE t.date < :cutoff' %
+            partitioning.default_table('Tweet'), {'cutoff': cutoff})])
+        for name in partitioning.tables:
+            session.execute('DELETE FROM %s WHERE date < :cutoff' %
+                            partitioning.default_table(name),
+                            {'cutoff': cutoff})
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# whether (postgres) databases have a partitioned Tweet table, by url
+partitioned_tweets = {}
+
+
+def tweet_key(session):
+    '''
+    The conflict key to upsert tweets on: partitioned Postgres tables can
+    only have unique keys including the partition key
+    '''
+    bind = session.get_bind()
+    url = str(bind.url)
+    if url not in partitioned_tweets:
+        partitioned_tweets[url] = bind.dialect.name == 'postgresql' and \
+            session.execute("SELECT relkind FROM pg_class "
+                            "WHERE relname = 'Tweet'").scalar() == 'p'
+    return ('tweetid', 'date') if partitioned_tweets[url] else ('tweetid',)
+
+
+def routed(session, table, rows):
+    '''
+    Rows for a partitionable table as (table, rows) pairs, split by
+    partition where writes have to go to the partitions themselves
+    (SQLite), or all together otherwise
+    '''
+    partitioning = get_partitioning(session.get_bind())
+    if not rows or not isinstance(partitioning, SQLitePartitions) or \
+       table.name not in partitioning.tables:
+        return [(table, rows)]
+    return partitioning.route(session, table, rows)
+
+
+def upgrade_tables(engine):
+    '''
+    Bring the tables of an existing database up to the current schema,
+    creating missing tables and adding missing columns and indexes
+    '''
+    log.info('Upgrading database tables.')
+    tables = Base.metadata.sorted_tables
+    if isinstance(get_partitioning(engine), SQLitePartitions):
+        # those live in the per-period files
+        tables = [table for table in tables
+                  if table.name not in PARTITIONED_TABLES]
+    Base.metadata.create_all(engine, tables=tables)
+    inspector = inspect(engine)
+    for table in tables:
+        columns = set(column['name']
+                      for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                log.info('Adding column %s.%s.' % (table.name, column.name))
+                engine.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' %
+                               (table.name, column.name,
+                                column.type.compile(engine.dialect)))
+        indexes = set(index['name']
+                      for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                log.info('Creating index %s.' % index.name)
+                index.create(engine)
+
+
+def normalize_tweet_langs(session):
+    '''
+    Normalize the language of tweets stored before ingest did (see
+    normalize_lang).  Returns the number of tweets updated.
+    '''
+    tables = [Tweet.__table__]
+    partitioning = get_partitioning(session.get_bind())
+    if isinstance(partitioning, SQLitePartitions):
+        # Tweet is a view over the attached partitions
+        tables = [partitioning.schema_table(name, Tweet.__table__)
+                  for name in partitioning.attached(session)
+                  if name not in ('main', 'temp')]
+    n = 0
+    for table in tables:
+        n += session.execute(
+            table.update().
+            where(or_(table.c.lang.is_(None), table.c.lang == '',
+                      table.c.lang != func.lower(table.c.lang))).
+            values(lang=func.lower(func.coalesce(func.nullif(table.c.lang,
+                                                             ''),
+                                                 'und')))).rowcount
+    session.commit()
+    log.info('Normalized the language of %d tweets.' % n)
+    return n
+
+
+def backfill_geotag_cells(session, chunk_size=10000):
+    '''
+    Fill in the grid cell of geotags stored before Geotag had one, a
+    chunk at a time.  Returns the number of geotags updated.
+    '''
+    table = Geotag.__table__
+    n = 0
+    while True:
+        rows = session.execute(select([table.c.geoid, table.c.latitude,
+                                       table.c.longitude]).
+                               where(table.c.cell.is_(None)).
+                               where(table.c.latitude.isnot(None)).
+                               where(table.c.longitude.isnot(None)).
+                               limit(chunk_size)).fetchall()
+        if not rows:
+            break
+        session.execute(table.update().
+                        where(table.c.geoid == bindparam('b_geoid')).
+                        values(cell=bindparam('cell')),
+                        [{'b_geoid': geoid,
+                          'cell': geo_cell(latitude, longitude)}
+                         for geoid, latitude, longitude in rows])
+        session.commit()
+        n += len(rows)
+        log.info('Backfilled grid cells of %d geotags.' % n)
+    return n
 
 
 def drop_tables(engine):
@@ -88,7 +351,44 @@ def drop_images(parmdata):
                          'deleted.  Proceed? [y/N] ')
     if dropflag.upper() == 'Y':
         log.info('Remove image directory.')
-        os.system('rm -fr "%s"' % image_path)
+        filenames = []
+        for dirpath, dirnames, files in os.walk(image_path):
+            filenames.extend(os.path.join(dirpath, f) for f in files)
+        remove_files(filenames)
+        for dirpath, dirnames, files in os.walk(image_path, topdown=False):
+            os.rmdir(dirpath)
+
+
+def prune_images(session, workers=8):
+    '''
+    Delete stored images which are no longer referenced by any Media row,
+    removing their files in parallel.  Returns the number pruned.
+    '''
+    table = ImageData.__table__
+    '''
+    an image can be referenced again by a consumer between being found
+    unreferenced and being deleted, so only the files of the rows which
+    were actually deleted are removed
+    '''
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        filenames = [row[0] for row in
+                     session.execute(table.delete().
+                                     where(table.c.refcount <= 0).
+                                     returning(table.c.local_filename))]
+    else:
+        if dialect == 'sqlite':
+            # under the write lock nothing can change between the two
+            session.execute(table.delete().where(false()))
+        filenames = [row[0] for row in
+                     session.execute(select([table.c.local_filename]).
+                                     where(table.c.refcount <= 0))]
+        session.execute(table.delete().where(table.c.refcount <= 0))
+    session.commit()
+    remove_files([filename for filename in filenames if filename is not None],
+                 workers)
+    log.info('Pruned %d unreferenced images.' % len(filenames))
+    return len(filenames)
 
 
 def read_timeline(engine, auth, parmdata, userid=None):
@@ -154,62 +454,683 @@ def tweet_words(text):
     return goodwords
 
 
-def add_tweet(tweet, session, get_images=False, image_path=None, https=None):
-    # check if we've already added this tweet
-    if session.query(Tweet).filter(Tweet.tweetid == tweet.id).count() == 0:
-        tweetobj = Tweet(tweet)
-        session.add(tweetobj)
-      
-        for tag in tweet.entities['hashtags']:
-            hashobj = Hashtag(tweet, tag, session)
-            session.merge(hashobj)
-          
-        for mention in tweet.entities['user_mentions']:
-            mentionobj = Mention(tweet, mention)
-            session.merge(mentionobj)
-          
-        for url in tweet.entities['urls']:
-            urlobj = URLData(tweet, url)
-            session.merge(urlobj)
-          
-        if tweet.geo is not None:
-            geotagobj = Geotag(tweet)
-            session.merge(geotagobj)
-                
-        if (get_images) and ('media' in tweet.entities):
-            for idx, media in enumerate(tweet.entities['media']):
-                mediaobj = Media(tweet, media, idx, image_path, https)
-                session.merge(mediaobj)
-
+def add_tweet(tweet, session, get_images=False, image_path=None, https=None,
+              hashtag_lexicon=None, word_lexicon=None, fetcher=None,
+              store=None, trends=None):
+    '''
+    Add a tweet, or refresh its retweet/favorite counts if we've already
+    got it.  Returns True if the tweet was new.  If a MediaFetcher is
+    given images are queued for it once the tweet is committed rather
+    than downloaded here, and if a TrendFeed is given the new tweet's
+    hashtags and words are added to it.
+    '''
+    if isinstance(get_partitioning(session.get_bind()), SQLitePartitions):
+        # rows have to be routed to their partition, which only the batch
+        # path does
+        return add_tweets([tweet], session, get_images, image_path, https,
+                          hashtag_lexicon, word_lexicon, fetcher=fetcher,
+                          store=store, trends=trends)[0] == 1
+
+    if not upsert_rows(session, Tweet.__table__, [_tweet_row(tweet)],
+                       'tweetid', TWEET_UPDATE_COLUMNS,
+                       tweet_key(session)):
         session.commit()
+        return False
+
+    tagids = []
+    for tag in tweet.entities['hashtags']:
+        hashobj = Hashtag(tweet, tag, session, hashtag_lexicon)
+        session.merge(hashobj)
+        tagids.append(hashobj.hashtagid)
+    add_hashtag_counts(session, hashtag_counts([(tweet.created_at,
+                                                 tweet.lang, tagids)]))
+
+    for mention in tweet.entities['user_mentions']:
+        mentionobj = Mention(tweet, mention)
+        session.merge(mentionobj)
+
+    for url in tweet.entities['urls']:
+        urlobj = URLData(tweet, url)
+        session.merge(urlobj)
+
+    if tweet.geo is not None:
+        geotagobj = Geotag(tweet)
+        session.merge(geotagobj)
+
+    media, missing = [], set()
+    if (get_images) and ('media' in tweet.entities) and (fetcher is None):
+        if store is None:
+            store = ImageStore(image_path)
+        media = [fetch_image(https, store, tweet.id, item['media_url_https'])
+                 for item in tweet.entities['media']]
+        missing = add_media(session, media)
+
+    session.commit()
+    if media:
+        media_written(session, https, store, media, missing)
+
+    if (get_images) and ('media' in tweet.entities) and (fetcher is not None):
+        for idx, media in enumerate(tweet.entities['media']):
+            fetcher.submit(tweet.id, idx, media['media_url_https'])
+
+    # process (each distinct) word inside the tweet's body
+    words = tokenizer.tokenize(tweet.text, unique=True)
+    for word in words:
+        wordobj = TweetWord(tweet.id, word, session, word_lexicon,
+                            tweet.created_at)
+        session.merge(wordobj)
+
+    session.commit()
+    if trends is not None:
+        trends.add(tweet.created_at, normalize_lang(tweet.lang),
+                   [tag['text'] for tag in tweet.entities['hashtags']], words)
+    return True
+
+
+def add_user(user, session, user_cache=None):
+    # add a user or refresh their profile.  Returns True if the user was new
+    if user_cache is not None and not user_cache.needs_write(user):
+        return False
+    inserted = upsert_rows(session, User.__table__, [_user_row(user)],
+                           'userid', USER_UPDATE_COLUMNS)
+    session.commit()
+    if user_cache is not None:
+        user_cache.written([user])
+    return bool(inserted)
+
+
+def upsert_rows(session, table, rows, key, update=(), conflict=None):
+    '''
+    Insert rows into table, updating the update columns of any row whose
+    key already exists instead.  Returns the set of keys which were
+    inserted, so duplicates are counted from affected rows rather than
+    from IntegrityErrors:
 
-        # process words inside the tweet's body
-        words = tweet_words(tweet.text)
-        for word in words:
-            wordobj = TweetWord(tweet.id, word, session)
-            session.merge(wordobj)
-        
-        session.commit()
-        
+      Postgres: INSERT ... ON CONFLICT DO UPDATE ... RETURNING (xmax = 0)
+      SQLite:   INSERT of the keys not found (under the write lock),
+                then an UPDATE of the rest
 
-    else:
-        tweetobj = session.query(Tweet).filter(Tweet.tweetid == tweet.id).one()
-        tweetobj.update(tweet)
-        session.add(tweetobj)
-        session.commit()
+    conflict overrides the Postgres conflict target, which defaults to key.
+    '''
+    dialect = session.get_bind().dialect.name
+    inserted = set()
+    # always touch rows in the same order so concurrent writers queue up
+    # behind each other rather than deadlocking
+    rows = sorted(rows, key=lambda row: row[key])
+    if dialect == 'postgresql':
+        for chunk in chunks(rows, 1000):
+            stmt = pg_insert(table).values(chunk)
+            if update:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=conflict or [key],
+                    set_=dict((col, stmt.excluded[col]) for col in update))
+            else:
+                stmt = stmt.on_conflict_do_nothing(
+                    index_elements=conflict or [key])
+            stmt = stmt.returning(table.c[key],
+                                  literal_column('xmax = 0').label('new'))
+            inserted.update(row[0] for row in session.execute(stmt)
+                            if row[1])
+        return inserted
+
+    if dialect == 'sqlite':
+        '''
+        take the write lock first (any write statement does, even one
+        which changes nothing) so nothing else can insert any of the keys
+        between looking them up and inserting the rest
+        '''
+        session.execute(table.delete().where(false()))
+    known = _existing_keys(session, table.c[key],
+                           [row[key] for row in rows])
+    newrows = dict((row[key], row) for row in rows if row[key] not in known)
+    if newrows:
+        session.execute(table.insert(), newrows.values())
+    inserted.update(newrows)
+
+    oldrows = [dict([('b_' + key, row[key])] +
+                    [(col, row[col]) for col in update])
+               for row in rows if row[key] not in inserted]
+    if update and oldrows:
+        session.execute(table.update().
+                        where(table.c[key] == bindparam('b_' + key)),
+                        oldrows)
+    return inserted
+
+
+def retryable(error):
+    '''
+    Whether a database error only means the transaction lost out to a
+    concurrent one (a Postgres deadlock or serialization failure, or a
+    locked SQLite database), so that it can be rolled back and run again
+    '''
+    if not isinstance(error, OperationalError):
+        return False
+    if getattr(error.orig, 'pgcode', None) in ('40P01', '40001'):
+        return True
+    message = str(error.orig).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def _copy_value(value):
+    # one value in the CSV flavour COPY reads, with \N for NULL
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, dt):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '"%s"' % value.replace('"', '""')
+
+
+def insert_rows(session, table, rows, copy=False):
+    '''
+    Plain insert of rows into table, as an executemany; with copy on
+    Postgres the rows are streamed through COPY ... FROM STDIN instead,
+    which is a good deal faster for large batches
+    '''
+    if not rows:
+        return
+    if not copy or session.get_bind().dialect.name != 'postgresql':
+        session.execute(table.insert(), rows)
+        return
+    preparer = session.get_bind().dialect.identifier_preparer
+    columns = rows[0].keys()
+    data = StringIO()
+    for row in rows:
+        data.write(','.join(_copy_value(row[col]) for col in columns))
+        data.write('\n')
+    data.seek(0)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert("COPY %s (%s) FROM STDIN WITH CSV NULL '\\N'" %
+                           (preparer.format_table(table),
+                            ', '.join(preparer.quote(col)
+                                      for col in columns)), data)
+    finally:
+        cursor.close()
 
 
-def add_user(user, session):
-    if session.query(User).filter(User.userid == user.id).count() == 0:
-        userobj = User(user)
-        session.add(userobj)
-        session.commit()
+def add_media(session, rows):
+    '''
+    Write fetched images given as (Media row, ImageData row) pairs as
+    returned by fetch_image: new image content is added to ImageData
+    (content which is there already keeps its row), the reference counts
+    of the content are bumped and a Media row is added for each tweeted
+    image.  Returns the content hashes which turned out not to be stored,
+    whose Media rows are left out.
+    '''
+    if not rows:
+        return set()
+    table = ImageData.__table__
+    refs = {}
+    for mediarow, imagerow in rows:
+        refs[mediarow['contenthash']] = refs.get(mediarow['contenthash'],
+                                                 0) + 1
+    imagerows = dict((imagerow['contenthash'], imagerow)
+                     for mediarow, imagerow in rows if imagerow is not None)
+    if imagerows:
+        inserted = upsert_rows(session, table, imagerows.values(),
+                               'contenthash')
+        '''
+        content stored first (by someone else, or from another url of the
+        batch) keeps its row, whose file may have another url's extension:
+        point the Media rows at that, and remove any other copy put wrote
+        '''
+        stored = dict((contenthash, imagerow['local_filename'])
+                      for contenthash, imagerow in imagerows.items()
+                      if contenthash in inserted)
+        for chunk in chunks(set(imagerows) - inserted, 500):
+            stored.update(session.execute(
+                select([table.c.contenthash, table.c.local_filename]).
+                where(table.c.contenthash.in_(chunk))).fetchall())
+        for mediarow, imagerow in rows:
+            if imagerow is None or mediarow['contenthash'] not in stored:
+                continue
+            local_filename = stored[mediarow['contenthash']]
+            if imagerow['local_filename'] not in (None, local_filename):
+                try:
+                    os.remove(imagerow['local_filename'])
+                except OSError:
+                    pass
+            mediarow['local_filename'] = local_filename
+    '''
+    content the fetchers remember storing may have been pruned by another
+    process since.  Counting the references first means prune_images
+    won't delete it from under us now, then whatever isn't there is
+    missing.
+    '''
+    session.execute(table.update().
+                    where(table.c.contenthash == bindparam('b_contenthash')).
+                    values(refcount=table.c.refcount + bindparam('n')),
+                    [{'b_contenthash': contenthash, 'n': n}
+                     for contenthash, n in refs.items()])
+    missing = set(refs) - _existing_keys(session, table.c.contenthash,
+                                         list(refs))
+    mediarows = [mediarow for mediarow, imagerow in rows
+                 if mediarow['contenthash'] not in missing]
+    if mediarows:
+        session.execute(Media.__table__.insert(), mediarows)
+    return missing
+
+
+def media_written(session, https, store, rows, missing):
+    '''
+    Synchronous counterpart to MediaFetcher.written, for rows written by
+    add_media and since committed: the store remembers what was stored,
+    and the images whose content add_media found missing (pruned since
+    the store remembered it) are forgotten, fetched again and written.
+    '''
+    store.committed([mediarow for mediarow, imagerow in rows
+                     if mediarow['contenthash'] not in missing])
+    refetch = [mediarow for mediarow, imagerow in rows
+               if mediarow['contenthash'] in missing]
+    if not refetch:
+        return
+    store.forget(refetch)
+    rows = []
+    for mediarow in refetch:
+        try:
+            rows.append(fetch_image(https, store, mediarow['tweetid'],
+                                    mediarow['url']))
+        except Exception as e:
+            log.info('Could not fetch media \'%s\': %s' %
+                     (mediarow['url'], str(e)))
+    missing = add_media(session, rows)
+    session.commit()
+    store.committed([mediarow for mediarow, imagerow in rows
+                     if mediarow['contenthash'] not in missing])
+
+
+def release_media(session, tweetids):
+    # delete the Media rows of tweets and drop their image references
+    table = ImageData.__table__
+    refs = {}
+    for chunk in chunks(tweetids, 500):
+        for contenthash, n in session.execute(
+                select([Media.contenthash, func.count()]).
+                where(Media.tweetid.in_(chunk)).
+                where(Media.contenthash.isnot(None)).
+                group_by(Media.contenthash)):
+            refs[contenthash] = refs.get(contenthash, 0) + n
+        session.execute(Media.__table__.delete().
+                        where(Media.tweetid.in_(chunk)))
+    if refs:
+        session.execute(table.update().
+                        where(table.c.contenthash ==
+                              bindparam('b_contenthash')).
+                        values(refcount=table.c.refcount - bindparam('n')),
+                        [{'b_contenthash': contenthash, 'n': n}
+                         for contenthash, n in refs.items()])
+
+
+###########################################################
+#              Hashtag rollup
+###########################################################
+
+
+def normalize_lang(lang):
+    # canonical form of a language code, as stored: lower case, with
+    # twitter's 'und' for unknown
+    return (lang or 'und').lower()
+
+
+def minute_bucket(date):
+    return date.replace(second=0, microsecond=0)
+
+
+def hashtag_counts(tagged):
+    '''
+    Count the hashtags of (date, language, hashtagids) triples by rollup
+    key, ie (minute bucket, language, hashtagid)
+    '''
+    counts = {}
+    for date, lang, tagids in tagged:
+        bucket = minute_bucket(date)
+        lang = normalize_lang(lang)
+        for tagid in tagids:
+            key = (bucket, lang, tagid)
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def add_hashtag_counts(session, counts):
+    '''
+    Add counts (as returned by hashtag_counts) to HashtagRollup, as part
+    of the caller's transaction
+    '''
+    if not counts:
+        return
+    table = HashtagRollup.__table__
+    # always touch rows in the same order so concurrent consumers queue
+    # up behind each other rather than deadlocking
+    rows = [{'bucket': bucket, 'lang': lang, 'hashtagid': tagid, 'count': n}
+            for (bucket, lang, tagid), n in sorted(counts.items())]
+    if session.get_bind().dialect.name == 'postgresql':
+        for chunk in chunks(rows, 1000):
+            stmt = pg_insert(table).values(chunk)
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['bucket', 'lang', 'hashtagid'],
+                set_={'count': table.c.count + stmt.excluded.count}))
+        return
+    # make sure every bucket exists, then bump the counts
+    session.execute(table.insert().prefix_with('OR IGNORE'),
+                    [dict(row, count=0) for row in rows])
+    session.execute(table.update().
+                    where(table.c.bucket == bindparam('b_bucket')).
+                    where(table.c.lang == bindparam('b_lang')).
+                    where(table.c.hashtagid == bindparam('b_hashtagid')).
+                    values(count=table.c.count + bindparam('n')),
+                    [{'b_bucket': row['bucket'], 'b_lang': row['lang'],
+                      'b_hashtagid': row['hashtagid'], 'n': row['count']}
+                     for row in rows])
+
+
+def rebuild_hashtag_rollup(session, start=None):
+    '''
+    Recount HashtagRollup from the Hashtag and Tweet tables, for tweets
+    from start onwards (everything by default).  Only run this while
+    nothing is being ingested, or counts for the rebuilt period may be
+    lost.
+    '''
+    table = HashtagRollup.__table__
+    if session.get_bind().dialect.name == 'postgresql':
+        bucket = func.date_trunc('minute', Tweet.date)
     else:
-        userobj = session.query(User).filter(User.userid == user.id).one()
-        userobj.update(user)
-        session.add(userobj)
+        # the format sqlalchemy stores sqlite DateTimes in
+        bucket = func.strftime('%Y-%m-%d %H:%M:00.000000', Tweet.date)
+    lang = func.lower(func.coalesce(func.nullif(Tweet.lang, ''), 'und'))
+    query = select([bucket, lang, Hashtag.hashtagid, func.count()]).\
+        where(Hashtag.tweetid == Tweet.tweetid).\
+        group_by(bucket, lang, Hashtag.hashtagid)
+    delete = table.delete()
+    if start is not None:
+        start = minute_bucket(start)
+        query = query.where(Tweet.date >= start)
+        delete = delete.where(table.c.bucket >= start)
+    log.info('Rebuilding hashtag rollup%s.' %
+             ('' if start is None else ' from %s' % start))
+    session.execute(delete)
+    session.execute(table.insert().
+                    from_select(['bucket', 'lang', 'hashtagid', 'count'],
+                                query))
+    session.commit()
+
+
+###########################################################
+#              Batched (bulk) write path
+###########################################################
+
+
+def new_hashtag_lexicon(maxsize=100000):
+    return LexiconCache(HashtagLexicon.__table__, 'hashtagtext', 'hashtagid',
+                        maxsize)
+
+
+def new_word_lexicon(maxsize=100000):
+    return LexiconCache(TweetLexicon.__table__, 'wordtext', 'wordid',
+                        maxsize)
+
+
+USER_UPDATE_COLUMNS = ('username', 'name', 'location', 'description',
+                       'numfollowers', 'numfriends', 'numtweets', 'timezone',
+                       'geoloc', 'verified', 'lastupdate')
+
+TWEET_UPDATE_COLUMNS = ('rtcount', 'fvcount')
+
+
+def _user_row(author):
+    return {'userid': author.id,
+            'username': author.screen_name,
+            'name': author.name,
+            'location': author.location,
+            'description': author.description,
+            'numfollowers': author.followers_count,
+            'numfriends': author.friends_count,
+            'numtweets': author.statuses_count,
+            'createdat': author.created_at,
+            'timezone': author.time_zone,
+            'geoloc': author.geo_enabled,
+            'verified': author.verified,
+            'lastupdate': dt.now()}
+
+
+def _tweet_row(tweet):
+    return {'tweetid': tweet.id,
+            'userid': tweet.author.id,
+            'text': tweet.text,
+            'rtcount': tweet.retweet_count,
+            'fvcount': tweet.favorite_count,
+            'lang': normalize_lang(tweet.lang),
+            'date': tweet.created_at,
+            'source': tweet.source}
+
+
+def _existing_keys(session, column, keys):
+    # return the subset of keys already present in column
+    found = set()
+    for chunk in chunks(keys, 500):
+        found.update(row[0] for row in
+                     session.execute(select([column]).
+                                     where(column.in_(chunk))))
+    return found
+
+
+def add_tweets(tweets, session, get_images=False, image_path=None,
+               https=None, hashtag_lexicon=None, word_lexicon=None,
+               user_cache=None, fetcher=None, store=None, copy=False,
+               trends=None):
+    '''
+    Bulk counterpart to add_user/add_tweet: writes a batch of tweets,
+    their authors and all of their child rows using Core inserts inside a
+    single transaction (COPY for the child rows, with copy on Postgres).
+    Returns the number of new tweets and the number of tweets which were
+    already in the database.
+    '''
+    rows, authors = tweet_rows(tweets, user_cache, get_images)
+    result = write_rows(session, rows, image_path, https, hashtag_lexicon,
+                        word_lexicon, fetcher, store, copy, trends)
+    if user_cache is not None:
+        user_cache.written(authors)
+    return result
+
+
+def tweet_rows(tweets, user_cache=None, get_images=False, tokenize=None):
+    '''
+    The half of add_tweets which doesn't need the database: turns a batch
+    of tweets into rows, for write_rows.  Returns the rows and the authors
+    whose rows are included, as
+
+      {'users': {userid: User row},
+       'tweets': {tweetid: Tweet row},
+       'entities': {tweetid: (hashtag texts, Mention rows, URLData rows,
+                              Geotag row or None, words, media urls)}}
+
+    Hashtags and words are resolved against the lexicons by write_rows.
+    Child rows are built for every tweet, as which are new isn't known
+    until they're written.  tokenize, if given, replaces
+    tokenizer.tokenize_batch (eg to tokenize in another process).
+    '''
+    # collapse repeated tweets/authors within the batch, keeping the latest
+    tweets = dict((tweet.id, tweet) for tweet in tweets)
+    authors = dict((tweet.author.id, tweet.author)
+                   for tweet in tweets.values()).values()
+    if user_cache is not None:
+        authors = [author for author in authors
+                   if user_cache.needs_write(author)]
+
+    if tokenize is None:
+        tokenize = tokenizer.tokenize_batch
+    with metrics.time('tokenize'):
+        words = tokenize([tweet.text for tweet in tweets.values()])
+    entities = {}
+    for tweet, tweetwords in zip(tweets.values(), words):
+        mentions = [{'tweetid': tweet.id,
+                     'date': tweet.created_at,
+                     'source': tweet.author.id,
+                     'target': mention['id']}
+                    for mention in tweet.entities['user_mentions']]
+        urls = [{'tweetid': tweet.id,
+                 'date': tweet.created_at,
+                 'url': url['expanded_url']}
+                for url in tweet.entities['urls']]
+        geotag = None
+        if tweet.geo is not None:
+            latitude, longitude = tweet.geo['coordinates'][:2]
+            geotag = {'tweetid': tweet.id,
+                      'date': tweet.created_at,
+                      'latitude': latitude,
+                      'longitude': longitude,
+                      'cell': geo_cell(latitude, longitude)}
+        media = []
+        if (get_images) and ('media' in tweet.entities):
+            media = [item['media_url_https']
+                     for item in tweet.entities['media']]
+        entities[tweet.id] = ([tag['text']
+                               for tag in tweet.entities['hashtags']],
+                              mentions, urls, geotag, tweetwords, media)
+
+    return {'users': dict((author.id, _user_row(author))
+                          for author in authors),
+            'tweets': dict((tweet.id, _tweet_row(tweet))
+                           for tweet in tweets.values()),
+            'entities': entities}, authors
+
+
+def merge_rows(batches):
+    # combine the rows of several tweet_rows batches, later ones winning
+    rows = {'users': {}, 'tweets': {}, 'entities': {}}
+    for batch in batches:
+        for name in rows:
+            rows[name].update(batch[name])
+    return rows
+
+
+def write_rows(session, rows, image_path=None, https=None,
+               hashtag_lexicon=None, word_lexicon=None, fetcher=None,
+               store=None, copy=False, trends=None):
+    '''
+    The database half of add_tweets: writes rows built by tweet_rows in
+    a single transaction.  Returns the number of new tweets and the
+    number of tweets which were already in the database.
+    '''
+    if hashtag_lexicon is None:
+        hashtag_lexicon = new_hashtag_lexicon()
+    if word_lexicon is None:
+        word_lexicon = new_word_lexicon()
+
+    # authors: insert the new ones, refresh the profiles of the rest
+    if rows['users']:
+        with metrics.time('upsert_users'):
+            upsert_rows(session, User.__table__, rows['users'].values(),
+                        'userid', USER_UPDATE_COLUMNS)
+
+    # tweets: insert the new ones, refresh the counts of the rest
+    inserted = set()
+    with metrics.time('upsert_tweets'):
+        for table, tweetrows in routed(session, Tweet.__table__,
+                                       rows['tweets'].values()):
+            inserted.update(upsert_rows(session, table, tweetrows,
+                                        'tweetid', TWEET_UPDATE_COLUMNS,
+                                        tweet_key(session)))
+    n_dupes = len(rows['tweets']) - len(inserted)
+    newtweets = [rows['tweets'][tweetid] for tweetid in inserted]
+    if not newtweets:
+        with metrics.time('commit'):
+            session.commit()
+        return 0, n_dupes
+
+    # resolve all of the new tweets' hashtags and words against the lexicons
+    entities = rows['entities']
+    with metrics.time('lexicon_lookup'):
+        tagids = hashtag_lexicon.lookup(session,
+                                        [tag for tweetid in inserted
+                                         for tag in entities[tweetid][0]])
+        wordids = word_lexicon.lookup(session,
+                                      [word for tweetid in inserted
+                                       for word in entities[tweetid][4]])
+
+    # child rows
+    hashtags, mentions, urls, geotags, tweetwords = [], [], [], [], []
+    media_jobs, media = [], []
+    if (fetcher is None) and (store is None) and \
+       any(entities[tweetid][5] for tweetid in inserted):
+        store = ImageStore(image_path)
+    for tweet in newtweets:
+        tweetid, date = tweet['tweetid'], tweet['date']
+        tags, tweetmentions, tweeturls, geotag, words, images = \
+            entities[tweetid]
+        hashtags.extend({'tweetid': tweetid,
+                         'date': date,
+                         'hashtagid': tagids[tag]} for tag in tags)
+        mentions.extend(tweetmentions)
+        urls.extend(tweeturls)
+        if geotag is not None:
+            geotags.append(geotag)
+        tweetwords.extend({'tweetid': tweetid,
+                           'date': date,
+                           'wordid': wordids[word]} for word in words)
+        for idx, url in enumerate(images):
+            if fetcher is None:
+                media.append(fetch_image(https, store, tweetid, url))
+            else:
+                media_jobs.append((tweetid, idx, url))
+
+    with metrics.time('hashtag_rollup'):
+        add_hashtag_counts(session,
+                           hashtag_counts((tweet['date'], tweet['lang'],
+                                           [tagids[tag] for tag in
+                                            entities[tweet['tweetid']][0]])
+                                          for tweet in newtweets))
+    with metrics.time('insert_children'):
+        for table, childrows in ((Hashtag.__table__, hashtags),
+                                 (Mention.__table__, mentions),
+                                 (URLData.__table__, urls),
+                                 (Geotag.__table__, geotags),
+                                 (TweetWord.__table__, tweetwords)):
+            for table, childrows in routed(session, table, childrows):
+                insert_rows(session, table, childrows, copy)
+    missing = add_media(session, media)
+
+    with metrics.time('commit'):
         session.commit()
-          
+    if media:
+        media_written(session, https, store, media, missing)
+    for job in media_jobs:
+        fetcher.submit(*job)
+    if trends is not None:
+        for tweet in newtweets:
+            tags, words = entities[tweet['tweetid']][0::4]
+            trends.add(tweet['date'], tweet['lang'], tags, words)
+    return len(newtweets), n_dupes
+
+
+def warm_image_store(session, store):
+    # remember the urls of recently stored images, and where they're stored
+    media = Media.__table__
+    images = ImageData.__table__
+    log.info('Warmed image url cache with %d urls.' %
+             store.warm(session.execute(
+                 select([media.c.url, media.c.contenthash,
+                         images.c.local_filename]).
+                 where(media.c.contenthash == images.c.contenthash).
+                 order_by(media.c.mediaid.desc()).
+                 limit(store.urls.maxsize))))
+    session.commit()
+
+
+def spill_path(parmdata, partition=None):
+    # with routing each consumer's queue spills into its own directory
+    path = parmdata['settings']['spill']['path']
+    if partition is not None:
+        path = os.path.join(path, str(partition))
+    return path
+
 
 # class tweet_consumer(threading.Thread):
 class tweet_consumer(Process):
@@ -222,7 +1143,9 @@ class tweet_consumer(Process):
     https = urllib3.PoolManager(cert_reqs="CERT_REQUIRED",
                                 ca_certs=certifi.where())
 
-    def __init__(self, queue, engine, parmdata, name=None):
+    def __init__(self, queue, engine, parmdata, name=None, partition=None,
+                 trend_queue=None, metrics_queue=None, row_queue=None,
+                 stop_event=None, ack_queue=None, slot=None):
         # initialize the thread
 
         Process.__init__(self, name=name)
@@ -235,79 +1158,745 @@ class tweet_consumer(Process):
         # update the log from this thread at this interval
         self.log_interval = parmdata['settings']['log_interval']
  
-        # bind this thread to the database
-        log.info('Establishing database session..')
-        self.session = get_sql_session(parmdata)
+        # the database session is opened in run, in the consumer's process
+        self.parmdata = parmdata
+        self.session = None
 
-        # set the queue to pull tweets from
+        # set the queue to pull (batches of encoded) tweets from
         self.queue = queue
-        '''
-        twitter's stream filtering for languages is currently (March 2015)
-        broken (you need to have a search term in addition to a language
-        in order to filter), but we want the full stream so we'll do the
-        language filter ourselves
-        '''
-        self.languages = parmdata['settings']['langs']
-        for lang in self.languages:
-            log.info('Logging tweets of language \'%s\'.' % lang)
+        self.pending = deque()
+
+        # batches the producers spilled to disk when the queue was full
+        self.spill = None
+        if parmdata['settings'].get('spill') is not None:
+            self.spill = SpillReader(spill_path(parmdata, partition))
 
         # set up whether we're getting tweeted images or not
         self.get_images = parmdata['settings']['get_images']
         log.info('Logging image file data is set to \'%s\'.' % self.get_images)
 
+        self.image_path = None
         if parmdata['settings']['image_storage']['method'].upper() == 'FILE':
             self.image_path = parmdata['settings']['image_storage']['path']
             if self.get_images:
                 log.info('Image data being stored on filesystem at \'%s\''
                          % self.image_path)
         
+        '''
+        optionally drain the queue in batches of up to batch_size tweets
+        (waiting at most batch_interval milliseconds to fill one) and write
+        each batch in a single transaction; without a 'batch' section in
+        the parmfile tweets are written one at a time
+        '''
+        batchdata = parmdata['settings'].get('batch') or {}
+        self.batch_size = batchdata.get('size', 1)
+        self.batch_interval = batchdata.get('interval', 1000) / 1000
+        if self.batch_size > 1:
+            log.info('Writing tweets in batches of up to %d every %d ms.' %
+                     (self.batch_size, self.batch_interval * 1000))
+
+        '''
+        with a media_fetch section images are downloaded by a pool of
+        fetcher threads (started in run) instead of inside the transaction
+        '''
+        self.fetchdata = parmdata['settings'].get('media_fetch')
+        self.fetcher = None
+
+        # content-addressed image store shared by the fetchers
+        self.image_store = ImageStore(self.image_path,
+                                      (self.fetchdata or {}).
+                                      get('url_cache_size', 100000))
+
+        # per-consumer caches of the hashtag and word lexicons
+        cachedata = parmdata['settings'].get('lexicon_cache') or {}
+        self.hashtag_lexicon = new_hashtag_lexicon(cachedata.get('size',
+                                                                 100000))
+        self.word_lexicon = new_word_lexicon(cachedata.get('size', 100000))
+        self.warm_lexicons = cachedata.get('warm', False)
+
+        '''
+        remember which authors we've already written so repeat appearances
+        of an unchanged profile can skip the User write
+        '''
+        cachedata = parmdata['settings'].get('user_cache') or {}
+        self.user_cache = UserCache(cachedata.get('size', 100000),
+                                    cachedata.get('staleness', 3600))
+
+        # feed new tweets to the trend server, if there is one
+        self.trends = None
+        if trend_queue is not None:
+            self.trends = TrendFeed(trend_queue)
+
+        # publish metrics to the collector, if there is one
+        self.metrics_queue = metrics_queue
+        self.metrics_interval = (parmdata['settings'].get('metrics') or
+                                 {}).get('interval', 5)
+
+        '''
+        in fan-in mode the consumer only turns tweets into rows, which are
+        handed to the tweet_writer over row_queue.  The writer acknowledges
+        each batch on ack_queue (the slot'th of its ack_queues) once it
+        has committed it, and until then the batch's authors don't count
+        as written and the spill segments it finished are kept.
+        '''
+        if row_queue is not None and (ack_queue is None or slot is None):
+            raise ValueError('A fan-in consumer needs an ack queue and slot.')
+        self.row_queue = row_queue
+        self.ack_queue = ack_queue
+        self.slot = slot
+        self.n_batches = 0
+        self.unacked = deque()
+
+        # set stop_event to have the consumer finish what it has and exit
+        self.stop_event = stop_event
+
         # some diagnostic variables
         self.last_time = dt.now()
         self.n_tweets = 0
         self.n_dupes = 0
 
     def run(self):
-        while True:
-            status = self.queue.get()
-            if any(status.lang in s for s in self.languages) or \
-               any('ALL' in s.upper() for s in self.languages):
-                '''
-                There is a small chance that two threads will try
-                to add the same user concurrently. This try statement
-                serves to get arround the sqlalchemy IntegrityError
-                which would result
-                '''
-                try:
-                    add_user(status.author, self.session)
-                    add_tweet(status, self.session, self.get_images,
-                              self.image_path, self.https)
+        if self.metrics_queue is not None:
+            metrics.configure(self.metrics_queue, self.name,
+                              self.metrics_interval)
+
+        if self.row_queue is not None:
+            self.run_fanin()
+            self.retire()
+            return
+
+        # bind this process to the database
+        log.info('Establishing database session..')
+        self.session = get_sql_session(self.parmdata)
+
+        if self.get_images:
+            warm_image_store(self.session, self.image_store)
+
+        if self.get_images and self.fetchdata is not None:
+            self.fetcher = MediaFetcher(self.https, self.image_store,
+                                        self.fetchdata.get('threads', 4),
+                                        self.fetchdata.get('queue_size',
+                                                           1000),
+                                        self.fetchdata.get('per_host', 4),
+                                        self.fetchdata.get('timeout', 10),
+                                        self.fetchdata.get('retries', 2))
+
+        if self.warm_lexicons:
+            log.info('Warmed lexicon caches with %d hashtags and %d words.' %
+                     (self.hashtag_lexicon.warm(self.session),
+                      self.word_lexicon.warm(self.session)))
+            self.session.commit()
+
+        if self.batch_size > 1:
+            self.run_batched()
+            self.retire()
+            return
+
+        while self.in_hand() or not self.retiring():
+            try:
+                status = self.next_status()
+            except Empty:
+                break
+            '''
+            There is a small chance that two threads will try
+            to add the same user concurrently. This try statement
+            serves to get arround the sqlalchemy IntegrityError
+            which would result
+            '''
+            try:
+                with metrics.time('write_tweet'):
+                    add_user(status.author, self.session, self.user_cache)
+                    new = add_tweet(status, self.session, self.get_images,
+                                    self.image_path, self.https,
+                                    self.hashtag_lexicon, self.word_lexicon,
+                                    self.fetcher, self.image_store,
+                                    self.trends)
+                if new:
                     self.n_tweets += 1
-                except IntegrityError:
+                    metrics.count('tweets_new')
+                else:
                     self.n_dupes += 1
-                    self.session.rollback()
-                    pass
-                except:
+                    metrics.count('tweets_duplicate')
+            except IntegrityError:
+                self.n_dupes += 1
+                metrics.count('tweets_duplicate')
+                self.rollback()
+                pass
+            except:
+                raise
+            self.committed()
+            self.add_media()
+            self.status_update()
+        self.retire()
+
+    def run_batched(self):
+        while self.in_hand() or not self.retiring():
+            try:
+                batch = self.next_batch()
+            except Empty:
+                break
+            if batch:
+                last_tweets, last_dupes = self.n_tweets, self.n_dupes
+                try:
+                    with metrics.time('write_batch'):
+                        n_new, n_dupes = self.write_batch(batch)
+                    self.n_tweets += n_new
+                    self.n_dupes += n_dupes
+                except SQLAlchemyError as e:
+                    '''
+                    another consumer beat us to one of the batch's users,
+                    tweets or lexicon entries (or kept deadlocking with
+                    us); fall back to adding the batch one tweet at a time
+                    '''
+                    if not isinstance(e, IntegrityError) and \
+                       not retryable(e):
+                        raise
+                    metrics.count('batch_fallbacks')
+                    self.rollback()
+                    for status in batch:
+                        try:
+                            add_user(status.author, self.session,
+                                     self.user_cache)
+                            if add_tweet(status, self.session,
+                                         self.get_images, self.image_path,
+                                         self.https, self.hashtag_lexicon,
+                                         self.word_lexicon, self.fetcher,
+                                         self.image_store, self.trends):
+                                self.n_tweets += 1
+                            else:
+                                self.n_dupes += 1
+                        except IntegrityError:
+                            self.n_dupes += 1
+                            self.rollback()
+                        except OperationalError as e:
+                            if not retryable(e):
+                                raise
+                            log.info('Dropping tweet %d which could not be '
+                                     'written: %s' % (status.id, str(e.orig)))
+                            metrics.count('tweets_dropped')
+                            self.rollback()
+                metrics.count('tweets_new', self.n_tweets - last_tweets)
+                metrics.count('tweets_duplicate', self.n_dupes - last_dupes)
+                self.committed()
+            self.add_media()
+            self.status_update()
+
+    def write_batch(self, batch, attempts=3):
+        '''
+        add_tweets, rolling back and running the transaction again (up to
+        attempts times in all) while it loses out to a concurrent one
+        '''
+        for attempt in range(attempts):
+            try:
+                return add_tweets(batch, self.session, self.get_images,
+                                  self.image_path, self.https,
+                                  self.hashtag_lexicon, self.word_lexicon,
+                                  self.user_cache, self.fetcher,
+                                  self.image_store, trends=self.trends)
+            except OperationalError as e:
+                if not retryable(e) or attempt == attempts - 1:
                     raise
+                metrics.count('write_retries')
+                log.info('Retrying a batch of %d tweets: %s' %
+                         (len(batch), str(e.orig)))
+                self.rollback()
+
+    def run_fanin(self):
+        while self.in_hand() or not self.retiring():
+            try:
+                batch = self.next_batch()
+            except Empty:
+                break
+            rows, authors = tweet_rows(batch, self.user_cache,
+                                       self.get_images)
+            self.n_batches += 1
+            # segments read to the end are in this batch or earlier ones
+            segments = []
+            if self.spill is not None:
+                segments = self.spill.take_finished()
+            self.unacked.append((self.n_batches, authors, segments))
+            with metrics.time('enqueue_rows'):
+                self.row_queue.put((self.slot, (self.name, self.n_batches),
+                                    rows))
+            self.n_tweets += len(rows['tweets'])
+            metrics.count('tweets_handed_over', len(rows['tweets']))
+            self.acknowledged()
             self.status_update()
 
+    def acknowledged(self, block=False):
+        '''
+        Take the writer's acknowledgements of the batches it has committed
+        (or given up on), in the order they were handed over: the authors
+        of committed batches now count as written, and the spill segments
+        a batch finished can be deleted
+        '''
+        while self.unacked:
+            try:
+                name, batchid, written = self.ack_queue.get(
+                    block, self.metrics_interval)
+            except Empty:
+                return
+            if name != self.name:
+                # left in the slot by a consumer which has exited
+                continue
+            while self.unacked and self.unacked[0][0] <= batchid:
+                n, authors, segments = self.unacked.popleft()
+                if written and n == batchid:
+                    self.user_cache.written(authors)
+                if segments:
+                    self.spill.release(segments)
+
+    def idle(self):
+        '''
+        Nothing in hand: write the images fetched meanwhile, publish
+        metrics and, fanning in, catch up on acknowledgements, deleting
+        segments finished since the last batch once everything handed over
+        has been acknowledged
+        '''
+        self.add_media()
+        if self.ack_queue is not None:
+            self.acknowledged()
+            if self.spill is not None and not self.unacked:
+                self.spill.release()
+        self.publish_metrics()
+
+    def add_media(self):
+        # write the Media rows of any images the fetchers have finished
+        if self.fetcher is None:
+            return
+        rows = self.fetcher.completed()
+        if rows:
+            missing = add_media(self.session, rows)
+            self.session.commit()
+            self.fetcher.written(rows, missing)
+
+    def retiring(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def in_hand(self):
+        # statuses taken off the queue or spill which are still to be written
+        return bool(self.pending) or (self.spill is not None and
+                                      self.spill.filename is not None)
+
+    def retire(self):
+        '''
+        Stopped with everything taken so far written: write the images
+        still being fetched (waiting as long as one fetch may take), and
+        report the last of the metrics
+        '''
+        log.info('Consumer retiring.')
+        while self.unacked:
+            # wait for the writer to commit everything handed over
+            self.acknowledged(block=True)
+            self.publish_metrics()
+        if self.fetcher is not None:
+            deadline = time.time() + self.fetchdata.get('timeout', 10) * \
+                (1 + self.fetchdata.get('retries', 2))
+            while self.fetcher.busy() and time.time() < deadline:
+                time.sleep(0.1)
+            self.add_media()
+        self.committed()
+        if self.session is not None:
+            self.session.close()
+        metrics.publish(force=True)
+
+    def committed(self):
+        '''
+        Everything handed out by next_status has been written, so spill
+        segments which have been read to the end can be deleted and the
+        new tweets can be posted to the trend server
+        '''
+        if self.spill is not None and not self.pending:
+            self.spill.release()
+        if self.trends is not None:
+            self.trends.flush()
+
+    def rollback(self):
+        # lexicon ids added by the rolled back transaction are now invalid
+        self.session.rollback()
+        self.hashtag_lexicon.clear()
+        self.word_lexicon.clear()
+
+    def next_batch(self):
+        '''
+        Block for the first tweet, then keep pulling until the batch is
+        full or the flush interval has passed
+        '''
+        batch = [self.next_status()]
+        deadline = time.time() + self.batch_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.next_status(remaining))
+            except Empty:
+                break
+        return batch
+
+    def next_status(self, timeout=None):
+        '''
+        Producers send lists of encoded statuses, unpack them one at a
+        time, replaying any batches spilled to disk first.  Raises Empty
+        if nothing arrives within timeout seconds.
+        '''
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self.pending:
+            if self.retiring() and (self.spill is None or
+                                    self.spill.filename is None):
+                # stopping: take nothing more, bar the rest of a segment
+                raise Empty
+            if self.spill is None:
+                '''
+                while idle, wake up now and then to publish metrics and
+                see whether we've been asked to stop
+                '''
+                wait = timeout
+                if wait is None and (self.metrics_queue is not None or
+                                     self.stop_event is not None):
+                    wait = self.metrics_interval
+                start = time.time()
+                try:
+                    batch = self.queue.get(True, wait)
+                except Empty:
+                    if timeout is not None:
+                        raise
+                    self.idle()
+                    continue
+                '''
+                time blocked waiting for the next batch, which is mostly
+                idle time (the Queue unpickles the batch inside get, too)
+                '''
+                metrics.observe('queue_wait', time.time() - start)
+                self.pending.extend(batch)
+                break
+            batch = self.spill.next_batch(claim=not self.retiring())
+            if batch is None:
+                if self.retiring():
+                    raise Empty
+                # don't block on the queue for long, in case a segment
+                # gets sealed meanwhile
+                wait = self.spill.poll_interval
+                if timeout is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        raise Empty
+                start = time.time()
+                try:
+                    batch = self.queue.get(True, wait)
+                except Empty:
+                    if timeout is None:
+                        self.idle()
+                    else:
+                        self.publish_metrics()
+                    continue
+                metrics.observe('queue_wait', time.time() - start)
+            self.pending.extend(batch)
+        with metrics.time('decode'):
+            return decode(self.pending.popleft())
+
+    def publish_metrics(self):
+        if metrics.due():
+            metrics.set('queue_depth', self.queue.qsize())
+            metrics.publish()
+
     def status_update(self):
         '''
         Method for keeping track of the rate at which each tweet consumer is
         processing the queue
         '''
+        self.publish_metrics()
+
         elapsed_time = (dt.now() - self.last_time).total_seconds()
-        if elapsed_time > self.log_interval:
+        if elapsed_time > self.log_interval and self.row_queue is not None:
+            log.info("Handing %f tweets/second to the writer, %d batches "
+                     "of rows waiting." % (self.n_tweets/elapsed_time,
+                                           self.row_queue.qsize()))
+            self.last_time = dt.now()
+            self.n_tweets = 0
+        elif elapsed_time > self.log_interval:
             log.info("Consuming %f tweets/second (%f/sec discarded as duplicates)." %
                      (self.n_tweets/elapsed_time, self.n_dupes/elapsed_time))
-            log.info("Reporting %d tweets remaining in queue." %
+            log.info("Lexicon cache hits/misses: %d/%d words, "
+                     "%d/%d hashtags." %
+                     (self.word_lexicon.hits, self.word_lexicon.misses,
+                      self.hashtag_lexicon.hits, self.hashtag_lexicon.misses))
+            log.info("User cache skipped %d of %d user writes." %
+                     (self.user_cache.skips,
+                      self.user_cache.skips + self.user_cache.writes))
+            pool = self.session.get_bind().pool
+            if isinstance(pool, TimedQueuePool):
+                log.info("Waited %f seconds for %d database connections." %
+                         (pool.wait_time, pool.n_checkouts))
+                pool.reset_counters()
+            if self.fetcher is not None:
+                log.info("Fetched %d images (%d failed, %d dropped), "
+                         "%d waiting." % (self.fetcher.reset_counters() +
+                                          (self.fetcher.jobs.qsize(),)))
+            log.info("Reporting %d batches of tweets remaining in queue." %
                      self.queue.qsize())
+            if self.spill is not None:
+                log.info("Replayed %d spilled tweets, %d segments waiting." %
+                         (self.spill.n_replayed,
+                          pending_segments(self.spill.path)))
+                self.spill.n_replayed = 0
+            if self.trends is not None and self.trends.n_dropped:
+                log.info("Trend server behind, dropped %d tweets." %
+                         self.trends.n_dropped)
+                self.trends.n_dropped = 0
             self.last_time = dt.now()
             self.n_tweets = 0
             self.n_dupes = 0
+            self.word_lexicon.reset_counters()
+            self.hashtag_lexicon.reset_counters()
+            self.user_cache.reset_counters()
+
+
+class tweet_writer(Process):
+    '''
+    Fan-in mode, for SQLite (which allows one writer at a time): consumers
+    decode, filter and tokenize tweets and turn them into rows, and this
+    single process owns the database connection and writes them in large
+    transactions
+    '''
+
+    # open https pool for grabbing url data
+    https = urllib3.PoolManager(cert_reqs="CERT_REQUIRED",
+                                ca_certs=certifi.where())
+
+    def __init__(self, row_queue, parmdata, name=None, trend_queue=None,
+                 metrics_queue=None, ack_queues=()):
+        Process.__init__(self, name=name)
+
+        log.info("Starting tweet writer.")
+
+        # this is meant to be a daemon process, exiting when the program closes
+        self.daemon = True
+
+        self.log_interval = parmdata['settings']['log_interval']
+        self.parmdata = parmdata
+        self.session = None
+        self.row_queue = row_queue
+
+        '''
+        consumers send their rows as (slot, batch id, rows), and each batch
+        is acknowledged on the slot's ack queue once it is committed (or
+        has been given up on)
+        '''
+        self.ack_queues = ack_queues
+
+        '''
+        write whatever has piled up in the queue while the last
+        transaction was being written, in one transaction of up to
+        commit_size tweets, collected for at most commit_interval
+        milliseconds
+        '''
+        fanindata = parmdata['settings'].get('fanin') or {}
+        self.commit_size = fanindata.get('commit_size', 5000)
+        self.commit_interval = fanindata.get('commit_interval', 1000) / 1000
+        self.max_retry_wait = fanindata.get('max_retry_wait', 10000) / 1000
+        self.max_retries = fanindata.get('max_retries', 10)
+        log.info('Writing tweets in transactions of up to %d.' %
+                 self.commit_size)
+
+        self.get_images = parmdata['settings']['get_images']
+        self.image_path = None
+        if parmdata['settings']['image_storage']['method'].upper() == 'FILE':
+            self.image_path = parmdata['settings']['image_storage']['path']
+        self.fetchdata = parmdata['settings'].get('media_fetch')
+        self.fetcher = None
+        self.image_store = ImageStore(self.image_path,
+                                      (self.fetchdata or {}).
+                                      get('url_cache_size', 100000))
+
+        cachedata = parmdata['settings'].get('lexicon_cache') or {}
+        self.hashtag_lexicon = new_hashtag_lexicon(cachedata.get('size',
+                                                                 100000))
+        self.word_lexicon = new_word_lexicon(cachedata.get('size', 100000))
+        self.warm_lexicons = cachedata.get('warm', False)
+
+        self.trends = None
+        if trend_queue is not None:
+            self.trends = TrendFeed(trend_queue)
+
+        self.metrics_queue = metrics_queue
+        self.metrics_interval = (parmdata['settings'].get('metrics') or
+                                 {}).get('interval', 5)
+
+        # some diagnostic variables
+        self.last_time = dt.now()
+        self.n_tweets = 0
+        self.n_dupes = 0
+        self.n_commits = 0
+
+    def run(self):
+        if self.metrics_queue is not None:
+            metrics.configure(self.metrics_queue, self.name,
+                              self.metrics_interval)
+
+        log.info('Establishing database session..')
+        self.session = get_sql_session(self.parmdata)
+
+        if self.get_images:
+            warm_image_store(self.session, self.image_store)
+
+        if self.get_images and self.fetchdata is not None:
+            self.fetcher = MediaFetcher(self.https, self.image_store,
+                                        self.fetchdata.get('threads', 4),
+                                        self.fetchdata.get('queue_size',
+                                                           1000),
+                                        self.fetchdata.get('per_host', 4),
+                                        self.fetchdata.get('timeout', 10),
+                                        self.fetchdata.get('retries', 2))
+
+        if self.warm_lexicons:
+            log.info('Warmed lexicon caches with %d hashtags and %d words.' %
+                     (self.hashtag_lexicon.warm(self.session),
+                      self.word_lexicon.warm(self.session)))
+            self.session.commit()
+
+        while True:
+            batches = self.next_rows()
+            if batches:
+                self.write(batches)
+            self.add_media()
+            self.status_update()
+
+    def write(self, batches):
+        last_tweets, last_dupes = self.n_tweets, self.n_dupes
+        written = [True] * len(batches)
+        try:
+            with metrics.time('write_batch'):
+                n_new, n_dupes = self.write_rows(merge_rows(
+                    [rows for slot, batchid, rows in batches]))
+            self.n_tweets += n_new
+            self.n_dupes += n_dupes
+        except SQLAlchemyError:
+            '''
+            something else (eg bulkload) wrote some of the rows first; try
+            the consumers' batches one at a time, giving up on any which
+            still fail
+            '''
+            metrics.count('batch_fallbacks')
+            self.rollback()
+            for i, (slot, batchid, rows) in enumerate(batches):
+                try:
+                    n_new, n_dupes = self.write_rows(rows)
+                    self.n_tweets += n_new
+                    self.n_dupes += n_dupes
+                except SQLAlchemyError:
+                    log.exception('Dropping %d tweets which could not be '
+                                  'written.' % len(rows['tweets']))
+                    metrics.count('tweets_dropped', len(rows['tweets']))
+                    self.rollback()
+                    written[i] = False
+        self.n_commits += 1
+        metrics.count('tweets_new', self.n_tweets - last_tweets)
+        metrics.count('tweets_duplicate', self.n_dupes - last_dupes)
+        for (slot, batchid, rows), ok in zip(batches, written):
+            if slot is not None:
+                self.ack_queues[slot].put(batchid + (ok,))
+        if self.trends is not None:
+            self.trends.flush()
+
+    def write_rows(self, rows):
+        '''
+        Write and commit rows.  While the database is locked (or can't be
+        reached) the transaction is retried, backing off up to
+        max_retry_wait, up to max_retries times.  Any other error (eg a
+        missing table) is raised straight away, for write to give up on
+        the rows.
+        '''
+        wait = 0.1
+        for attempt in range(self.max_retries + 1):
+            try:
+                return write_rows(self.session, rows, self.image_path,
+                                  self.https, self.hashtag_lexicon,
+                                  self.word_lexicon, self.fetcher,
+                                  self.image_store, trends=self.trends)
+            except OperationalError as e:
+                if attempt == self.max_retries or \
+                   not (retryable(e) or e.connection_invalidated):
+                    raise
+                self.rollback()
+                metrics.count('write_retries')
+                log.info('Retrying a write in %.1f seconds: %s' %
+                         (wait, str(e.orig)))
+                time.sleep(wait)
+                wait = min(2 * wait, self.max_retry_wait)
+
+    def next_rows(self):
+        '''
+        Block (up to the metrics interval) for the first batch of rows,
+        then take any more which are waiting, until there are commit_size
+        tweets or the commit interval has passed
+        '''
+        try:
+            batches = [self.row_queue.get(True, self.metrics_interval)]
+        except Empty:
+            return []
+        n = len(batches[0][2]['tweets'])
+        deadline = time.time() + self.commit_interval
+        while n < self.commit_size and time.time() < deadline:
+            try:
+                batches.append(self.row_queue.get_nowait())
+            except Empty:
+                break
+            n += len(batches[-1][2]['tweets'])
+        return batches
+
+    def add_media(self):
+        # write the Media rows of any images the fetchers have finished
+        if self.fetcher is None:
+            return
+        rows = self.fetcher.completed()
+        if rows:
+            missing = add_media(self.session, rows)
+            self.session.commit()
+            self.fetcher.written(rows, missing)
+
+    def rollback(self):
+        # lexicon ids added by the rolled back transaction are now invalid
+        self.session.rollback()
+        self.hashtag_lexicon.clear()
+        self.word_lexicon.clear()
+
+    def status_update(self):
+        if metrics.due():
+            metrics.set('row_queue_depth', self.row_queue.qsize())
+            metrics.publish()
+
+        elapsed_time = (dt.now() - self.last_time).total_seconds()
+        if elapsed_time > self.log_interval:
+            log.info("Writing %f tweets/second (%f/sec discarded as "
+                     "duplicates) in %d transactions." %
+                     (self.n_tweets/elapsed_time, self.n_dupes/elapsed_time,
+                      self.n_commits))
+            log.info("Lexicon cache hits/misses: %d/%d words, "
+                     "%d/%d hashtags." %
+                     (self.word_lexicon.hits, self.word_lexicon.misses,
+                      self.hashtag_lexicon.hits, self.hashtag_lexicon.misses))
+            if self.fetcher is not None:
+                log.info("Fetched %d images (%d failed, %d dropped), "
+                         "%d waiting." % (self.fetcher.reset_counters() +
+                                          (self.fetcher.jobs.qsize(),)))
+            log.info("Reporting %d batches of rows remaining in queue." %
+                     self.row_queue.qsize())
+            if self.trends is not None and self.trends.n_dropped:
+                log.info("Trend server behind, dropped %d tweets." %
+                         self.trends.n_dropped)
+                self.trends.n_dropped = 0
+            self.last_time = dt.now()
+            self.n_tweets = 0
+            self.n_dupes = 0
+            self.n_commits = 0
+            self.word_lexicon.reset_counters()
+            self.hashtag_lexicon.reset_counters()
 
 
 class tweet_producer(Process):
-    def __init__(self, auth, queue, parmdata, name=None):
+    def __init__(self, auth, queue, parmdata, name=None, metrics_queue=None):
         # initialize the thread
         Process.__init__(self, name=name)
 
@@ -317,16 +1906,33 @@ class tweet_producer(Process):
         self.parmdata = parmdata
         self.daemon = True
         self.active = True
+        self.metrics_queue = metrics_queue
+        self.stream = None
 
     def run(self):
+        if self.metrics_queue is not None:
+            metrics.configure(self.metrics_queue, self.name,
+                              (self.parmdata['settings'].get('metrics') or
+                               {}).get('interval', 5))
+        try:
+            self.stream_tweets()
+        finally:
+            # leave nothing spilled unreadable until the next start
+            self.seal()
+
+    def stream_tweets(self):
         while self.active:
             try:
                 # set up twitter api
                 self.api = tweepy.API(self.auth)
                 
                 # set up stream listener
+                wiredata = self.parmdata['settings'].get('wire') or {}
                 self.myListener = database_listener(self.api, self.queue,
-                                                    self.parmdata['settings']['log_interval'])
+                                                    self.parmdata['settings']['log_interval'],
+                                                    wiredata.get('batch_size', 1),
+                                                    wiredata.get('interval', 500),
+                                                    self.parmdata['settings']['langs'])
                 
                 self.stream =  tweepy.streaming.Stream(self.auth,
                                                        self.myListener, timeout=60)
@@ -338,10 +1944,17 @@ class tweet_producer(Process):
                 log.error(str(e))
                 pass
  
+    def seal(self):
+        # seal the segment being spilled to, if there is one
+        if hasattr(self.queue, 'seal'):
+            self.queue.seal()
+
     def close(self):
         log.info("Disconnecting Twitter stream.")
-        self.stream.disconnect()
+        if self.stream is not None:
+            self.stream.disconnect()
         self.active = False
+        self.seal()
         self.join()
 
 ###########################################################
@@ -349,17 +1962,56 @@ class tweet_producer(Process):
 ###########################################################
 
 
+def language_set(langs):
+    # the (normalized) languages to keep, or None to keep everything
+    if langs is None or any(lang.upper() == 'ALL' for lang in langs):
+        return None
+    return frozenset(normalize_lang(lang) for lang in langs)
+
+
 class database_listener(tweepy.StreamListener):
     '''
     Takes data received from the streaming API and places it in the
-    queue to be processed by tweet_handlers
+    queue to be processed by tweet_handlers.  Statuses are sent in the
+    compact wire format (or as they are, without wire, for a queue within
+    the process), in lists of up to batch_size at a time.
     '''
 
     def on_status(self, status):
-        self.queue.put(status)
+        # language filter
+        lang = normalize_lang(status.lang)
+        if self.languages is not None and lang not in self.languages:
+            self.n_dropped[lang] = self.n_dropped.get(lang, 0) + 1
+            metrics.count('tweets_filtered')
+            # don't hold a partial batch (or an aged spill segment) until
+            # the next accepted status
+            if time.time() - self.last_flush > self.batch_interval:
+                self.flush()
+            return True
+        self.n_accepted[lang] = self.n_accepted.get(lang, 0) + 1
+        metrics.count('tweets_accepted')
+
+        if self.wire:
+            with metrics.time('encode'):
+                status = encode(status)
+        self.batch.append(status)
         self.n_count += 1
+        if len(self.batch) >= self.batch_size or \
+           time.time() - self.last_flush > self.batch_interval:
+            self.flush()
         self.status_update()
         return True
+
+    def flush(self):
+        if self.batch:
+            # blocks while the queue is full (without spilling)
+            with metrics.time('enqueue'):
+                self.queue.put(self.batch)
+            self.batch = []
+        self.last_flush = time.time()
+        # with spilling, seal a segment which has aged while nothing came
+        if hasattr(self.queue, 'expire'):
+            self.queue.expire()
  
     def on_error(self, status_code):
         log.info('Got an error with status code: ' + str(status_code))
@@ -367,23 +2019,56 @@ class database_listener(tweepy.StreamListener):
  
     def on_timeout(self):
         log.info('Listener timeout.')
+        self.flush()
         return True   # To continue listening
 
+    def on_disconnect(self, notice):
+        log.info('Stream disconnected: %s' % str(notice))
+        self.flush()
+
     def status_update(self):
         '''
         Method for keeping track of the rate at which each tweet producer is
         feeding the queue
         '''
+        metrics.publish()
         elapsed_time = (dt.now() - self.last_time).total_seconds()
         if elapsed_time > self.log_interval:
             log.info("Producing %f tweets/second." %
                      (self.n_count/elapsed_time))
+            log.info("Accepted/dropped by language: %s." %
+                     ', '.join('%s %d/%d' % (lang,
+                                              self.n_accepted.get(lang, 0),
+                                              self.n_dropped.get(lang, 0))
+                               for lang in sorted(set(self.n_accepted) |
+                                                  set(self.n_dropped))))
             self.last_time = dt.now()
             self.n_count = 0
+            self.n_accepted = {}
+            self.n_dropped = {}
 
-    def __init__(self, api, queue, log_interval):
+    def __init__(self, api, queue, log_interval, batch_size=1,
+                 batch_interval=500, langs=None, wire=True):
         self.api = api
         self.queue = queue
+        self.wire = wire
+
+        '''
+        twitter's stream filtering for languages is currently (March 2015)
+        broken (you need to have a search term in addition to a language
+        in order to filter), but we want the full stream so we'll do the
+        language filter ourselves, before anything is queued
+        '''
+        self.languages = language_set(langs)
+        for lang in (langs or ['ALL']):
+            log.info('Logging tweets of language \'%s\'.' % lang)
+        self.n_accepted = {}
+        self.n_dropped = {}
+
+        self.batch = []
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval / 1000
+        self.last_flush = time.time()
         self.n_count = 0
         self.log_interval = log_interval
         self.last_time = dt.now()
@@ -401,8 +2086,17 @@ class Hashtag(Base):
                      unique=False, index=True)
     hashtagid = Column('hashtagid', Integer, ForeignKey("HashtagLexicon.hashtagid"),
                        unique=False, index=True)
+    # the tweet's date, which child rows are partitioned on
+    date = Column('date', DateTime)
         
-    def __init__(self, tweet, tag, session):
+    def __init__(self, tweet, tag, session, lexicon=None):
+        self.tweetid = tweet.id
+        self.date = tweet.created_at
+        if lexicon is not None:
+            ids = lexicon.lookup(session, [tag['text']])
+            self.hashtagid = ids[tag['text']]
+            return
+
         # check if the hashtag is already in the lexicon
         try:
             lexobj = session.query(HashtagLexicon).\
@@ -446,8 +2140,15 @@ class TweetWord(Base):
     tweetid = Column('tweetid', BigInteger, ForeignKey("Tweet.tweetid"),
                      unique=False, index=True)
     wordid = Column('wordid', Integer, index=True)
+    date = Column('date', DateTime)
+
+    def __init__(self, tweetid, word, session, lexicon=None, date=None):
+        self.date = date
+        if lexicon is not None:
+            self.tweetid = tweetid
+            self.wordid = lexicon.lookup(session, [word])[word]
+            return
 
-    def __init__(self, tweetid, word, session):
         jobdone = False
         while not jobdone:
             try:
@@ -470,6 +2171,17 @@ class TweetWord(Base):
         self.wordid = wordobj.wordid
 
 
+class HashtagRollup(Base):
+    """Hashtag counts per minute and language"""
+    __tablename__ = "HashtagRollup"
+    bucket = Column('bucket', DateTime, primary_key=True)
+    lang = Column('lang', String, primary_key=True)
+    hashtagid = Column('hashtagid', Integer,
+                       ForeignKey("HashtagLexicon.hashtagid"),
+                       primary_key=True)
+    count = Column('count', Integer, default=0)
+
+
 class Media(Base):
     """Binary Media Data"""
     __tablename__ = "Media"
@@ -481,29 +2193,22 @@ class Media(Base):
                              nullable=True)
     local_filename = Column('local_filename', String, unique=False,
                             nullable=True)
-    
-    def __init__(self, tweet, media, idx, image_path=None, https=None):
-        self.tweetid = tweet.id
-        rawdata = https.request('GET', media['media_url_https']).data
-        extension = os.path.splitext(media['media_url_https'])[1]
-        self.native_filename = os.path.split(media['media_url_https'])[1]
-        if image_path is None:
-            self.blob = zlib.compress(rawdata)
-            self.filename = None
-        else:
-            self.blob = None
-            md5hash = md5.new()
-            md5hash.update(str(tweet.id) + str(idx))
-            hashdata = md5hash.hexdigest()
-            self.local_filename = image_path + os.path.sep + hashdata[0:2] +\
-                                  os.path.sep + hashdata[3:5] + os.path.sep +\
-                                  hashdata[6:8] + os.path.sep + hashdata[9:] \
-                                  + extension
-            if not os.path.exists(os.path.dirname(self.local_filename)):
-                os.makedirs(os.path.dirname(self.local_filename), mode=0777)
-            with open(self.local_filename, 'wb') as f:
-                f.write(rawdata)
-            
+    url = Column('url', String, unique=False, nullable=True, index=True)
+    contenthash = Column('contenthash', String(40),
+                         ForeignKey("ImageData.contenthash"), unique=False,
+                         nullable=True, index=True)
+
+
+class ImageData(Base):
+    """Content-Addressed Image Data"""
+    __tablename__ = "ImageData"
+    contenthash = Column('contenthash', String(40), primary_key=True)
+    blob = Column('blob', Binary, unique=False, nullable=True)
+    local_filename = Column('local_filename', String, unique=False,
+                            nullable=True)
+    size = Column('size', Integer)
+    refcount = Column('refcount', Integer, default=0, index=True)
+
 
 class URLData(Base):
     """URL Data"""
@@ -512,9 +2217,11 @@ class URLData(Base):
     tweetid = Column('tweetid', BigInteger, ForeignKey("Tweet.tweetid"),
                      unique=False, index=True)
     url = Column('url', String, unique=False)
+    date = Column('date', DateTime)
     
     def __init__(self, tweet, url):
         self.tweetid = tweet.id
+        self.date = tweet.created_at
         self.url = url['expanded_url']
 
 
@@ -526,9 +2233,11 @@ class Mention(Base):
                      unique=False, index=True)
     source = Column('source', BigInteger, unique=False, index=True)
     target = Column('target', BigInteger, unique=False, index=True)
+    date = Column('date', DateTime)
     
     def __init__(self, tweet, mention):
         self.tweetid = tweet.id
+        self.date = tweet.created_at
         self.source = tweet.author.id
         self.target = mention['id']
  
@@ -541,11 +2250,16 @@ class Geotag(Base):
                      unique=False, index=True)
     latitude = Column('latitude', Float, unique=False)
     longitude = Column('longitude', Float, unique=False)
+    # fixed grid cell (see geogrid), for bounding box and tile queries
+    cell = Column('cell', BigInteger, index=True)
+    date = Column('date', DateTime)
     
     def __init__(self, tweet):
         self.tweetid = tweet.id
+        self.date = tweet.created_at
         self.latitude = tweet.geo['coordinates'][0]
         self.longitude = tweet.geo['coordinates'][1]
+        self.cell = geo_cell(self.latitude, self.longitude)
 
 
 class Tweet(Base):
@@ -567,13 +2281,22 @@ class Tweet(Base):
     urls = relationship(URLData, lazy="dynamic",  backref='tweet')
     media = relationship(Media, lazy="dynamic", backref='tweet')
 
+    '''
+    for paging through time windows in (date, tweetid) order, of all
+    languages or of one (lang is stored normalized, see normalize_lang, so
+    queries compare it directly and get a range scan)
+    '''
+    __table_args__ = (Index('ix_Tweet_date_tweetid', 'date', 'tweetid'),
+                      Index('ix_Tweet_lang_date_tweetid', 'lang', 'date',
+                            'tweetid'))
+
     def __init__(self, tweet):
         self.tweetid = tweet.id
         self.userid = tweet.author.id
         self.text = tweet.text
         self.rtcount = tweet.retweet_count
         self.fvcount = tweet.favorite_count
-        self.lang = tweet.lang
+        self.lang = normalize_lang(tweet.lang)
         self.date = tweet.created_at
         self.source = tweet.source
 
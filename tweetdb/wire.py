@@ -0,0 +1,135 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Compact wire format for statuses passed between processes."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+'''
+Producers put whole tweepy Status objects on the queue, which means
+pickling the nested author, the entities and the raw _json of every
+tweet.  encode() flattens a status down to a tuple of just the fields the
+database classes read, and decode() turns that back into a slim object
+with the same attribute names, so add_tweet/add_user don't know the
+difference.
+'''
+
+import time
+import calendar
+from datetime import datetime as dt
+
+
+def _timestamp(date):
+    return None if date is None else calendar.timegm(date.utctimetuple())
+
+
+def _datetime(timestamp):
+    return None if timestamp is None else dt.utcfromtimestamp(timestamp)
+
+
+def _parse_timestamp(text):
+    # twitter's created_at format, always in UTC
+    return calendar.timegm(time.strptime(text, '%a %b %d %H:%M:%S +0000 %Y'))
+
+
+def _parse_source(source):
+    # strip the link from source, as tweepy's Status does
+    if source is not None and '<' in source:
+        return source[source.find('>') + 1:source.rfind('<')]
+    return source
+
+
+class WireUser(object):
+    __slots__ = ('id', 'screen_name', 'name', 'location', 'description',
+                 'followers_count', 'friends_count', 'statuses_count',
+                 'created_at', 'time_zone', 'geo_enabled', 'verified')
+
+    def __init__(self, record):
+        (self.id, self.screen_name, self.name, self.location,
+         self.description, self.followers_count, self.friends_count,
+         self.statuses_count, created_at, self.time_zone,
+         self.geo_enabled, self.verified) = record
+        self.created_at = _datetime(created_at)
+
+
+class WireStatus(object):
+    __slots__ = ('id', 'text', 'lang', 'created_at', 'source',
+                 'retweet_count', 'favorite_count', 'geo', 'entities',
+                 'author')
+
+    def __init__(self, record):
+        (self.id, self.text, self.lang, created_at, self.source,
+         self.retweet_count, self.favorite_count, coordinates, hashtags,
+         mentions, urls, media, author) = record
+        self.created_at = _datetime(created_at)
+        self.geo = None if coordinates is None else \
+            {'coordinates': list(coordinates)}
+        self.entities = {'hashtags': [{'text': text} for text in hashtags],
+                         'user_mentions': [{'id': userid}
+                                           for userid in mentions],
+                         'urls': [{'expanded_url': url} for url in urls]}
+        if media is not None:
+            self.entities['media'] = [{'media_url_https': url}
+                                      for url in media]
+        self.author = WireUser(author)
+
+
+def encode_user(user):
+    return (user.id, user.screen_name, user.name, user.location,
+            user.description, user.followers_count, user.friends_count,
+            user.statuses_count, _timestamp(user.created_at),
+            user.time_zone, user.geo_enabled, user.verified)
+
+
+def encode(status):
+    # flatten a tweepy Status (or WireStatus) into a tuple
+    entities = status.entities
+    media = None
+    if 'media' in entities:
+        media = tuple(item['media_url_https'] for item in entities['media'])
+    return (status.id, status.text, status.lang,
+            _timestamp(status.created_at), status.source,
+            status.retweet_count, status.favorite_count,
+            None if status.geo is None else
+            tuple(status.geo['coordinates']),
+            tuple(tag['text'] for tag in entities['hashtags']),
+            tuple(mention['id'] for mention in entities['user_mentions']),
+            tuple(url['expanded_url'] for url in entities['urls']),
+            media, encode_user(status.author))
+
+
+def decode(record):
+    return WireStatus(record)
+
+
+def encode_json_user(user):
+    return (user['id'], user['screen_name'], user['name'],
+            user.get('location'), user.get('description'),
+            user.get('followers_count'), user.get('friends_count'),
+            user.get('statuses_count'),
+            _parse_timestamp(user['created_at']), user.get('time_zone'),
+            user.get('geo_enabled'), user.get('verified'))
+
+
+def encode_json(data):
+    '''
+    Encode the raw json of a status (as captured from the streaming API)
+    directly, without building a tweepy Status first
+    '''
+    entities = data.get('entities') or {}
+    media = None
+    if 'media' in entities:
+        media = tuple(item['media_url_https'] for item in entities['media'])
+    geo = data.get('geo')
+    return (data['id'], data['text'], data.get('lang'),
+            _parse_timestamp(data['created_at']),
+            _parse_source(data.get('source')),
+            data.get('retweet_count'), data.get('favorite_count'),
+            None if geo is None else tuple(geo['coordinates']),
+            tuple(tag['text'] for tag in entities.get('hashtags', [])),
+            tuple(mention['id']
+                  for mention in entities.get('user_mentions', [])),
+            tuple(url['expanded_url'] for url in entities.get('urls', [])),
+            media, encode_json_user(data['user']))
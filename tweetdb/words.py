@@ -0,0 +1,55 @@
+from __future__ import division
+NAME = "tweetdb"
+VERSION = "0.1"
+DESCRIPTION = "Compiled, batched tokenizer for tweet text."
+AUTHOR = "Russell Miller"
+AUTHOR_EMAIL = ""
+URL = "https://github.com/starkshift/tweetdb"
+LICENSE = "MIT"
+
+import re
+
+
+class TweetTokenizer(object):
+    '''
+    Drop-in equivalent of tweet_words with its patterns compiled once.
+    The whitespace collapsing, trimming, splitting, per-word stripping and
+    word test of tweet_words are fused into a single findall, which keeps
+    a whitespace delimited token when, after stripping quotes and
+    punctuation from its ends, it is a letter followed by at least two
+    letters/digits.
+    '''
+
+    url = re.compile('((www\.[^\s]+)|(https?://[^\s]+))')
+    mention = re.compile('@[^\s]+')
+    hashtag = re.compile(r'#([^\s]+)')
+
+    '''
+    str.split() and unicode.split() disagree on what whitespace is, so
+    use the flavour of \s that matches the text we were given
+    '''
+    word = r'(?:^|(?<=\s))[\'"?,.!;:]*([a-zA-Z][a-zA-Z0-9]{2,})' \
+        r'[\'"?,.!;:]*(?=\s|$)'
+    unicode_word = re.compile(word, re.UNICODE)
+    str_word = re.compile(word)
+
+    def tokenize(self, text, unique=False):
+        text = text.lower()
+        text = self.url.sub('', text)
+        text = self.mention.sub('', text)
+        text = self.hashtag.sub(r'\1', text)
+        if isinstance(text, unicode):
+            words = self.unicode_word.findall(text)
+        else:
+            words = self.str_word.findall(text)
+        if unique:
+            # keep the first occurrence of each word
+            seen = set()
+            words = [word for word in words
+                     if not (word in seen or seen.add(word))]
+        return words
+
+    def tokenize_batch(self, texts, unique=True):
+        # word lists for a batch of texts, ready for the lexicon lookup
+        tokenize = self.tokenize
+        return [tokenize(text, unique) for text in texts]